@@ -24,6 +24,9 @@ from os import listdir
 from os.path import isdir, join
 from shutil import rmtree
 
+# input files are parsed the same way as in OPPNI
+from cPRONTO import input_records
+
 def time_stamp():
     t = datetime.now()
     t = mktime(t.timetuple()) + 1e-6 * t.microsecond
@@ -98,20 +101,16 @@ def check_pipeline_file(pipeline):
                 print "Check file: "+pipeline
                 exit(1)
 
-def check_input_lines(line):
-    line = line.rstrip()
-    uline = line.split(' ')
-    for temp in uline:
-        t = temp.split("=")
-        if ("IN=" in temp.upper()):
-            t = temp.split("=")
-            if not os.path.isfile(t[1]):
-                print "Input file "+t[1]+" not found"
-                exit(1)
-        if ("TASK=" in temp.upper()):
-            if not os.path.isfile(t[1]):
-                print "Input file "+t[1]+" not found"
-                exit(1)
+def check_input_lines(record):
+    if record.errors:
+        print "Invalid input line: "+record.line.rstrip()
+        for error in record.errors:
+            print error
+        exit(1)
+    for path in (record.nii, record.task):
+        if path is not None and not os.path.isfile(path):
+            print "Input file "+path+" not found"
+            exit(1)
 def check_pid(pid):        
     try:
         os.kill(pid, 0)
@@ -266,17 +265,16 @@ else:
         lines = f.readlines()
         for line in lines:
             current_subject = current_subject  + 1
-            check_input_lines(line)
+            record = input_records.parse_input_line(line)
+            check_input_lines(record)
             F2 = open("{0}/%04d.txt".format(input_files_temp) % current_subject,"w")
             F2.write(line)
             F2.close()
             # we have to know how many unique structrul MRI exists in the maps so
-            uline = line.split(' ')
-            for temp in uline:
-                if ("STRUCT=" in temp.upper()):
-                    struct.append(temp) 
-                if ("OUT=" in temp.upper()):
-                    outdir.append(os.path.split(temp)[0])
+            if record.struct is not None:
+                struct.append(record.struct)
+            if record.out is not None:
+                outdir.append(record.out)
             
     os.remove("{0}/default.txt".format(input_files_temp)) 
     # find unique structures
@@ -0,0 +1 @@
+# Python modules of OPPNI, run as scripts from this folder
@@ -10,7 +10,81 @@ CODES_INPUT_SECTIONS = ['IN', 'OUT', 'DROP', 'STRUCT', 'PHYSIO', 'TASK', 'CUSTOM
 
 TASK_MANDATORY_FIELDS = ['UNIT', 'TR_MSEC', 'TYPE']
 
-CODES_PRONTO_STEPS = [ 'PART1', 'QC1', 'PART2', 'QC2', 'GMASK', 'SPNORM' ]
+CODES_PRONTO_STEPS = [ 'PILOT', 'PRUNE', 'SELECT', 'BASE', 'MERGE', 'PART1', 'QC1', 'PART2SEL', 'PART2SUB', 'PART2', 'QC2', 'GMASK', 'SPNORM' ]
+# steps operating on the dataset as a whole, rather than one job per subject/run
+CODES_DATASET_LEVEL_STEPS = [ 'QC1', 'PART2SEL', 'PART2', 'QC2', 'GMASK', 'PRUNE', 'SELECT' ]
+
+# names of the different clusters known to OPPNI, grouped by the scheduler they run
+HPC_TYPES_SGE = ('ROTMAN', 'ROTMAN-SGE', 'SGE', 'CAC', 'HPCVL', 'QUEENSU', 'BRAINCODE-SGE', 'BRAINCODE', 'BCODE')
+HPC_TYPES_TORQUE = ('SCINET', 'TORQUE')
+HPC_TYPES_PBS = ('PBS', )
+HPC_TYPES_SLURM = ('SLURM', )
+# simulated cluster, running no jobs (see executors.MockExecutor)
+HPC_TYPES_MOCK = ('MOCK', )
+
+# commands of each scheduler: to submit jobs, list the jobs in the queue, report on finished jobs and cancel jobs
+SCHEDULER_COMMANDS = {'SGE'   : {'submit': 'qsub', 'queue': 'qstat', 'accounting': None, 'cancel': 'qdel'},
+                      'TORQUE': {'submit': 'qsub', 'queue': 'qstat', 'accounting': None, 'cancel': 'qdel'},
+                      'PBS'   : {'submit': 'qsub', 'queue': 'qstat', 'accounting': None, 'cancel': 'qdel'},
+                      'SLURM' : {'submit': 'sbatch', 'queue': 'squeue', 'accounting': 'sacct', 'cancel': 'scancel'}}
+
+# directives of each scheduler included in all jobs: exporting the environment, and joining stdout and stderr
+HPC_COMMON_DIRECTIVES = {'SGE'   : ('-V', '-b y', '-j y'),
+                         'TORQUE': ('-V', '-j oe'),
+                         'PBS'   : ('-V', '-j oe'),
+                         'SLURM' : ('--export=ALL', )}
+
+# for each scheduler, the directives naming a job and setting its working directory (None if not supported)
+JOB_NAME_DIRECTIVES = {'SGE'   : ('-N {}', '-wd {}'),
+                       'TORQUE': ('-N {}', '-d {}'),
+                       'PBS'   : ('-N {}', None),
+                       'SLURM' : ('--job-name={}', '--chdir={}')}
+
+# for each scheduler, the option to submit an array of N tasks, and the variable holding the index of the task
+ARRAY_JOB_SPEC = {'SGE'   : ('-t 1-{}', 'SGE_TASK_ID'),
+                  'TORQUE': ('-t 1-{}', 'PBS_ARRAYID'),
+                  'PBS'   : ('-J 1-{}', 'PBS_ARRAY_INDEX'),
+                  'SLURM' : ('--array=1-{}', 'SLURM_ARRAY_TASK_ID')}
+
+# parameters of the simulated cluster: slots running jobs, real seconds taken by each submission,
+#   seconds a job waits in the queue before it can start, duration of the jobs (mean, standard deviation),
+#   fraction of the jobs failing, simulated seconds passing per real second, and the seed of the simulation
+MOCK_SCHEDULER = {'num_slots'         : 100,
+                  'submit_latency_sec': 0.0,
+                  'queue_latency_sec' : 30.0,
+                  'job_duration_sec'  : (1800.0, 600.0),
+                  'failure_rate'      : 0.0,
+                  'time_scale'        : 3600.0,
+                  'seed'              : 0}
+
+# models of the resources needed by a job of each step, from the size of the runs it processes
+#   (run_gb: voxels x volumes, in double precision; volume_gb: the same for a single volume)
+#   and the number of pipeline combinations in the pipeline file:
+#   memory (GB)      = safety * (mem_base  + mem_per_gb  * run_gb + mem_per_pipeline  * num_pipelines * volume_gb)
+#   walltime (hours) = safety * (time_base + time_per_gb * run_gb + time_per_pipeline * num_pipelines * run_gb)
+# the jobs of steps operating on the whole dataset process the runs of all the subjects.
+#   Part 2 is split into the selection of the pipelines (PART2SEL, on the stats only), the outputs of each subject
+#   (PART2SUB) and their summary (PART2).
+ResourceModel = namedtuple('ResourceModel', 'mem_base mem_per_gb mem_per_pipeline '
+                                            'time_base time_per_gb time_per_pipeline safety')
+RESOURCE_MODELS = {'PART1' : ResourceModel(1.5, 6.0, 0.5, 0.5, 1.0, 0.5, 1.5),
+                   'SPNORM': ResourceModel(1.5, 4.0, 0.0, 0.5, 2.0, 0.0, 1.5),
+                   'PART2SEL': ResourceModel(2.0, 0.0, 0.0, 0.5, 0.0, 0.01, 1.5),
+                   'PART2SUB': ResourceModel(2.0, 0.5, 1.0, 0.5, 0.2, 0.1, 1.5),
+                   'PART2' : ResourceModel(2.0, 0.05, 0.0, 0.5, 0.05, 0.0, 1.5),
+                   'QC1'   : ResourceModel(2.0, 0.5, 0.5, 0.5, 0.2, 0.02, 1.5),
+                   'QC2'   : ResourceModel(2.0, 0.5, 0.0, 0.5, 0.2, 0.0, 1.5),
+                   'GMASK' : ResourceModel(2.0, 1.0, 0.0, 0.5, 0.5, 0.0, 1.5)}
+RESOURCE_MIN_MEMORY_GB = 2
+# margin over the usage predicted from the runtime ledger (see runtime_ledger.py), once it has enough jobs of a step
+RESOURCE_LEDGER_MARGIN = 1.2
+RESOURCE_MIN_WALLTIME_HOURS = 1
+
+# for each scheduler, the directives requesting the memory (in GB) and walltime (HH:MM:SS) of a job
+RESOURCE_DIRECTIVES = {'SGE'   : ('-l mf={}G', '-l h_rt={}'),
+                       'TORQUE': ('-l mem={}gb', '-l walltime={}'),
+                       'PBS'   : ('-l mem={}gb', '-l walltime={}'),
+                       'SLURM' : ('--mem={}G', '--time={}')}
 
 CODES_ANALYSIS_MODELS = ['None', 'LDA', 'GNB', 'GLM', 'erCVA', 'erGNB', 'erGLM', 'SCONN']
 
@@ -0,0 +1,484 @@
+#!/usr/bin/env python
+# Backends running the jobs of OPPNI: on this node, through the schedulers supported, or on a simulated cluster.
+
+import heapq
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+import cfg_front as cfg_pronto
+import local_executor
+import queue_status
+
+# state of the simulated cluster, saved in the output folder so --status can query it later
+file_name_mock_queue = 'mock_queue.json'
+
+
+class Executor(object):
+    """
+    Interface of the backends running the jobs generated by OPPNI:
+        prepare - directives heading the job file of a job
+        submit  - queues a job to run once the jobs it depends on succeeded, returning its id
+        status  - states of many jobs, in a single query (see queue_status.JOB_STATES)
+        cancel  - removes jobs from the queue
+
+    The config of the cluster (prefix of the directives, header common to all jobs, spec of the resources)
+        is the hpc dict of oppni.py, shared with the backend.
+    """
+
+    # scheduler whose directives the job files use (see cfg_front)
+    syntax = None
+    # whether individual tasks of array jobs can wait for the same task of another array job
+    task_dependencies = False
+
+    def __init__(self, hpc):
+
+        self.hpc = hpc
+
+    def prepare(self, job_name, job_dir, resources=None):
+        """
+        Directives of a job, naming it and running it in job_dir. The memory and walltime in resources
+            (see oppni.estimate_resources), if given, replace the memory requested for all the jobs.
+        """
+
+        prefix = self.hpc['prefix']
+        if resources is None:
+            directives = list(self.hpc['header'])
+        else:
+            memory_directive = '{0} {1}'.format(prefix, self.hpc['spec']['memory'][0])
+            directives = [line for line in self.hpc['header'] if not line.startswith(memory_directive)]
+            memory_option, walltime_option = cfg_pronto.RESOURCE_DIRECTIVES[self.syntax]
+            directives.append('{0} {1}'.format(prefix, memory_option.format(resources['memory_gb'])))
+            directives.append('{0} {1}'.format(prefix, walltime_option.format(
+                '{:d}:00:00'.format(resources['walltime_hours']))))
+
+        name_option, dir_option = cfg_pronto.JOB_NAME_DIRECTIVES[self.syntax]
+        directives.append('{0} {1}'.format(prefix, name_option.format(job_name)))
+        if dir_option is not None:
+            directives.append('{0} {1}'.format(prefix, dir_option.format(job_dir)))
+
+        return directives
+
+    def array_spec(self):
+        """Option submitting an array of N tasks, and the variable holding the index of the task."""
+
+        return cfg_pronto.ARRAY_JOB_SPEC[self.syntax]
+
+    def submit(self, job_args, depends_on=(), task_depends_on=()):
+        """
+        Queues a job, returning its id.
+
+        :param job_args: options of the submission, followed by the path to the job file
+        :param depends_on: ids of the jobs that must succeed before it starts
+        :param task_depends_on: ids of array jobs, whose tasks must succeed before the same task of this one starts
+        """
+        raise NotImplementedError
+
+    def status(self, job_ids):
+        """States of the given jobs (dict of job id -> list of states), or None if they could not be queried."""
+        raise NotImplementedError
+
+    def cancel(self, job_ids):
+        """Removes the given jobs from the queue, returning whether it succeeded."""
+        raise NotImplementedError
+
+    def report(self):
+        """Summary of the jobs submitted, to print once all of them are (None if there is nothing to add)."""
+        return None
+
+    def save_state(self, out_dir):
+        """Saves what the backend needs to report the status of its jobs in a later session (nothing, usually)."""
+        pass
+
+    def load_state(self, out_dir):
+        pass
+
+
+class LocalExecutor(Executor):
+    """Runs the jobs on this node, as a graph executed once all of them are submitted (see local_executor)."""
+
+    syntax = 'LOCAL'
+
+    def __init__(self, hpc):
+
+        super(LocalExecutor, self).__init__(hpc)
+        self.jobs = OrderedDict()
+        self.exit_codes = dict()
+
+    def prepare(self, job_name, job_dir, resources=None):
+
+        # no directives are needed, just the shell to run them in.
+        return [self.hpc['shell'], 'cd {0}'.format(job_dir)]
+
+    def submit(self, job_args, depends_on=(), task_depends_on=()):
+
+        job_id = len(self.jobs) + 1
+        self.jobs[job_id] = {'path': job_args[-1], 'depends_on': list(depends_on)}
+
+        return job_id
+
+    def run(self, num_procs, exec_func):
+        """Runs all the jobs submitted, keeping num_procs running at all times, and returns their exit codes."""
+
+        self.exit_codes = local_executor.run_job_graph(self.jobs, num_procs, exec_func)
+        self.jobs = OrderedDict()
+
+        return self.exit_codes
+
+    def status(self, job_ids):
+
+        states = dict()
+        for job_id in job_ids:
+            if job_id in self.jobs:
+                states[job_id] = ['queued']
+            elif job_id in self.exit_codes:
+                exit_code = self.exit_codes[job_id]
+                states[job_id] = ['done' if exit_code == 0 else ('error' if exit_code is None else 'failed')]
+
+        return states
+
+    def cancel(self, job_ids):
+
+        for job_id in job_ids:
+            self.jobs.pop(job_id, None)
+
+        return True
+
+
+class SchedulerExecutor(Executor):
+    """Submits the jobs through the commands of a scheduler (see cfg_front.SCHEDULER_COMMANDS)."""
+
+    # options making the submission command report just the id of the job
+    submit_flags = ()
+
+    def dependency_options(self, depends_on, task_depends_on):
+        """Options of the submission command making a job wait for others."""
+        raise NotImplementedError
+
+    def parse_job_id(self, output):
+
+        return output.strip()
+
+    def submit(self, job_args, depends_on=(), task_depends_on=()):
+
+        cmd = [cfg_pronto.SCHEDULER_COMMANDS[self.syntax]['submit']] + list(self.submit_flags) + \
+              self.dependency_options(map(str, depends_on), map(str, task_depends_on)) + list(job_args)
+
+        # the submissions are made from several threads, which must not inherit the pipes of one another
+        return self.parse_job_id(subprocess.check_output(cmd, close_fds=True))
+
+    def status(self, job_ids):
+
+        return queue_status.job_states(self.syntax, job_ids)
+
+    def cancel(self, job_ids):
+
+        if len(job_ids) < 1:
+            return True
+        cmd = [cfg_pronto.SCHEDULER_COMMANDS[self.syntax]['cancel']] + map(str, job_ids)
+
+        return subprocess.call(cmd, close_fds=True) == 0
+
+
+class SGEExecutor(SchedulerExecutor):
+
+    syntax = 'SGE'
+    task_dependencies = True
+    submit_flags = ('-terse', )
+
+    def dependency_options(self, depends_on, task_depends_on):
+
+        options = list()
+        if depends_on:
+            options.extend(['-hold_jid', ','.join(depends_on)])
+        if task_depends_on:
+            options.extend(['-hold_jid_ad', ','.join(task_depends_on)])
+
+        return options
+
+    def parse_job_id(self, output):
+
+        # qsub -terse reports array jobs as id.first-last:step
+        return output.strip().split('.')[0]
+
+
+class PBSExecutor(SchedulerExecutor):
+    """
+    PBS (and TORQUE) have no dependency between the tasks of the same index in two array jobs,
+        hence an array job waits for all the tasks of the arrays it depends on.
+    """
+
+    syntax = 'PBS'
+
+    def dependency(self, job_id):
+        """Dependency on successful completion of a job (or of all the tasks of an array job)."""
+
+        return 'afterok:' + job_id
+
+    def dependency_options(self, depends_on, task_depends_on):
+
+        if not depends_on:
+            return list()
+
+        return ['-W', 'depend=' + ','.join(map(self.dependency, depends_on))]
+
+
+class TorqueExecutor(PBSExecutor):
+
+    syntax = 'TORQUE'
+
+    def dependency(self, job_id):
+
+        if '[]' in job_id:
+            return 'afterokarray:' + job_id
+        return 'afterok:' + job_id
+
+
+class SLURMExecutor(SchedulerExecutor):
+
+    syntax = 'SLURM'
+    task_dependencies = True
+    submit_flags = ('--parsable', )
+
+    def dependency_options(self, depends_on, task_depends_on):
+
+        # all of the dependencies must be satisfied
+        dependencies = list()
+        if depends_on:
+            dependencies.append('afterok:' + ':'.join(depends_on))
+        if task_depends_on:
+            dependencies.append('aftercorr:' + ':'.join(task_depends_on))
+        if not dependencies:
+            return list()
+
+        return ['--dependency=' + ','.join(dependencies)]
+
+    def parse_job_id(self, output):
+
+        # reported along with the cluster, on federated clusters: id;cluster
+        return output.strip().split(';')[0]
+
+
+class MockExecutor(Executor):
+    """
+    Simulated cluster, to benchmark and test the submission and scheduling of large graphs of jobs without one.
+        Jobs use the directives of SGE, and are never run: the scheduler is simulated instead (cfg_front.MOCK_SCHEDULER).
+        Each task of a job becomes eligible queue_latency_sec after its submission, once the tasks it depends on
+        have succeeded. It then waits for one of num_slots free slots, and runs for a duration drawn from
+        job_duration_sec (mean, standard deviation), failing with probability failure_rate.
+        Jobs depending on failed ones never run, as in SLURM (afterok).
+        Submissions take submit_latency_sec of real time, and simulated time passes time_scale times faster
+        than real time, from the first submission onwards.
+    """
+
+    syntax = 'SGE'
+    task_dependencies = True
+
+    def __init__(self, hpc, **params):
+
+        super(MockExecutor, self).__init__(hpc)
+        self.params = dict(cfg_pronto.MOCK_SCHEDULER)
+        self.params.update(params)
+        self.random = random.Random(self.params['seed'])
+        self.jobs = OrderedDict()
+        # jobs are submitted by many threads at once (see submission.py)
+        self.lock = threading.Lock()
+        # real time of the first submission
+        self.started = None
+        self.submit_time_sec = 0.0
+
+    def submit(self, job_args, depends_on=(), task_depends_on=()):
+
+        submit_start = time.time()
+        with self.lock:
+            if self.started is None:
+                self.started = submit_start
+        if self.params['submit_latency_sec'] > 0:
+            time.sleep(self.params['submit_latency_sec'])
+
+        num_tasks = 1
+        array_option = self.array_spec()[0].split(' ')[0]
+        if array_option in job_args:
+            # e.g. -t 1-10
+            num_tasks = int(job_args[job_args.index(array_option) + 1].split('-')[-1])
+
+        mean, sd = self.params['job_duration_sec']
+        with self.lock:
+            job_id = str(len(self.jobs) + 1)
+            self.jobs[job_id] = {'name': os.path.splitext(os.path.basename(job_args[-1]))[0],
+                                 'submitted': self.now(),
+                                 'depends_on': map(str, depends_on),
+                                 'task_depends_on': map(str, task_depends_on),
+                                 'durations': [max(1.0, self.random.gauss(mean, sd)) for _ in range(num_tasks)],
+                                 'fails': [self.random.random() < self.params['failure_rate']
+                                           for _ in range(num_tasks)],
+                                 'cancelled': False}
+            # from the first submission to the last, as they may overlap
+            self.submit_time_sec = time.time() - self.started
+
+        return job_id
+
+    def now(self):
+        """Simulated time since the first submission, in seconds."""
+
+        if self.started is None:
+            return 0.0
+        return (time.time() - self.started) * self.params['time_scale']
+
+    def schedule(self):
+        """
+        Simulates the run of all the jobs submitted, on num_slots slots.
+
+        :returns: dict of (job id, task index) -> (start, end) in simulated seconds,
+            for the tasks that ran (not those depending on failed or cancelled jobs)
+        """
+
+        tasks = OrderedDict()
+        for job_id, job in self.jobs.items():
+            if job['cancelled']:
+                continue
+            for idx in range(len(job['durations'])):
+                deps = list()
+                for dep in job['depends_on']:
+                    if dep in self.jobs:
+                        deps.extend((dep, dep_idx) for dep_idx in range(len(self.jobs[dep]['durations'])))
+                for dep in job['task_depends_on']:
+                    if dep in self.jobs and idx < len(self.jobs[dep]['durations']):
+                        deps.append((dep, idx))
+                tasks[(job_id, idx)] = deps
+
+        waiting_on = dict()
+        dependents = dict((key, list()) for key in tasks)
+        for key, deps in tasks.items():
+            # dependencies cancelled are never satisfied
+            waiting_on[key] = set(deps)
+            for dep in deps:
+                if dep in dependents:
+                    dependents[dep].append(key)
+
+        latency = self.params['queue_latency_sec']
+        ready = list()
+        for seq, key in enumerate(tasks):
+            if not waiting_on[key]:
+                heapq.heappush(ready, (self.jobs[key[0]]['submitted'] + latency, seq, key))
+        order = dict((key, seq) for seq, key in enumerate(tasks))
+
+        run_times = dict()
+        running = list()
+        free_slots = max(1, int(self.params['num_slots']))
+        now = 0.0
+        while ready or running:
+            next_release = ready[0][0] if ready and free_slots > 0 else float('inf')
+            next_end = running[0][0] if running else float('inf')
+            if next_release <= next_end:
+                release, seq, key = heapq.heappop(ready)
+                now = max(now, release)
+                end = now + self.jobs[key[0]]['durations'][key[1]]
+                run_times[key] = (now, end)
+                heapq.heappush(running, (end, key))
+                free_slots -= 1
+            else:
+                now, key = heapq.heappop(running)
+                free_slots += 1
+                if self.jobs[key[0]]['fails'][key[1]]:
+                    continue
+                for child in dependents[key]:
+                    waiting_on[child].discard(key)
+                    if not waiting_on[child]:
+                        child_release = max(now, self.jobs[child[0]]['submitted'] + latency)
+                        heapq.heappush(ready, (child_release, order[child], child))
+
+        return run_times
+
+    def status(self, job_ids):
+
+        run_times = self.schedule()
+        now = self.now()
+        states = dict()
+        for job_id in map(str, job_ids):
+            job = self.jobs.get(job_id)
+            if job is None or job['cancelled']:
+                continue
+            job_states = list()
+            for idx, fails in enumerate(job['fails']):
+                start, end = run_times.get((job_id, idx), (None, None))
+                if start is None:
+                    # depends on a job that failed or was cancelled
+                    job_states.append('error')
+                elif end <= now:
+                    job_states.append('failed' if fails else 'done')
+                elif start <= now:
+                    job_states.append('running')
+                elif now < job['submitted'] + self.params['queue_latency_sec']:
+                    job_states.append('queued')
+                else:
+                    job_states.append('held')
+            states[job_id] = job_states
+
+        return states
+
+    def cancel(self, job_ids):
+
+        for job_id in map(str, job_ids):
+            if job_id in self.jobs:
+                self.jobs[job_id]['cancelled'] = True
+
+        return True
+
+    def report(self):
+        """Summary of the simulation: submission throughput, makespan and utilization of the slots."""
+
+        run_times = self.schedule()
+        num_tasks = sum(len(job['durations']) for job in self.jobs.values() if not job['cancelled'])
+        lines = ['Simulated {} jobs ({} tasks) on {} slots:'.format(len(self.jobs), num_tasks,
+                                                                   self.params['num_slots'])]
+        if len(self.jobs) > 0:
+            lines.append('\tsubmitted in {:.2f} sec ({:.0f} jobs/sec)'.format(
+                self.submit_time_sec, len(self.jobs) / max(self.submit_time_sec, 1e-6)))
+        if len(run_times) > 0:
+            makespan = max(end for start, end in run_times.values())
+            busy = sum(end - start for start, end in run_times.values())
+            lines.append('\tall done after {:.1f} hours, with the slots {:.0f}% busy'.format(
+                makespan / 3600.0, 100.0 * busy / (makespan * max(1, int(self.params['num_slots'])))))
+        if len(run_times) < num_tasks:
+            lines.append('\t{} tasks never ran, as jobs they depend on failed'.format(num_tasks - len(run_times)))
+
+        return '\n'.join(lines)
+
+    def save_state(self, out_dir):
+
+        with open(os.path.join(out_dir, file_name_mock_queue), 'w') as mq:
+            json.dump({'params': self.params, 'started': self.started, 'jobs': self.jobs}, mq)
+
+    def load_state(self, out_dir):
+
+        mock_queue = os.path.join(out_dir, file_name_mock_queue)
+        if not os.path.isfile(mock_queue):
+            return
+        with open(mock_queue, 'r') as mq:
+            saved = json.load(mq)
+        self.params.update(saved['params'])
+        self.started = saved['started']
+        self.jobs = OrderedDict(sorted(saved['jobs'].items(), key=lambda item: int(item[0])))
+
+
+# backend of each scheduler, as named by oppni.get_hpc_family
+EXECUTORS = {'LOCAL': LocalExecutor,
+             'SGE': SGEExecutor,
+             'PBS': PBSExecutor,
+             'TORQUE': TorqueExecutor,
+             'SLURM': SLURMExecutor,
+             'MOCK': MockExecutor}
+
+
+def make_executor(hpc_family, hpc):
+    """Backend running the jobs through the given scheduler."""
+
+    if hpc_family not in EXECUTORS:
+        raise ValueError('HPC type {} unrecognized or not implemented.'.format(hpc_family))
+
+    return EXECUTORS[hpc_family](hpc)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Single-pass parser of the input files of OPPNI, yielding a compact record for each line (run).
+
+import os
+import re
+
+# fields of a line, and the record attribute each is stored in
+input_fields = {'IN': 'nii', 'OUT': 'out', 'DROP': 'drop', 'TASK': 'task',
+                'PHYSIO': 'physio', 'STRUCT': 'struct', 'CUSTOMREG': 'mask'}
+
+# characters allowed in the paths, as Parse_Input_File.m is not robust to others
+reValue = re.compile(r"^[\w\./+_-]+$")
+reDropValue = re.compile(r"^\[(\d+),(\d+)\]$")
+
+
+class RunRecord(object):
+    """
+    Fields of a single line of the input file.
+        out is the output folder and prefix the basename of OUT=, as in the output prefix of the run.
+        Optional fields not specified are None.
+        header holds the fields of the NIfTI header of the run, once read (see nifti_header.parse_header).
+    """
+
+    __slots__ = ('nii', 'out', 'prefix', 'drop_beg', 'drop_end', 'task', 'physio', 'struct', 'mask',
+                 'line', 'line_num', 'errors', 'header')
+
+    def __init__(self, line='', line_num=None):
+
+        for field in self.__slots__:
+            setattr(self, field, None)
+        self.line = line
+        self.line_num = line_num
+        self.errors = list()
+
+    # records are pickled along with the options of each processing
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        # fields added since the record was saved remain None
+        for field in self.__slots__:
+            setattr(self, field, None)
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def __repr__(self):
+        return 'RunRecord({!r}, {!r})'.format(self.prefix, self.out)
+
+    def files(self):
+        """Files referred to in the line, whose existence must be checked."""
+
+        files = [fp for fp in (self.nii, self.task, self.struct, self.mask) if fp is not None]
+        if self.physio is not None:
+            files.extend([self.physio + '.puls.1D', self.physio + '.resp.1D'])
+
+        return files
+
+    @classmethod
+    def from_dict(cls, subject):
+        """Record of a subject parsed by older versions of OPPNI, which saved them as dicts."""
+
+        record = cls(subject.get('line', ''))
+        for field in cls.__slots__:
+            if field in subject:
+                setattr(record, field, subject[field])
+        if record.errors is None:
+            record.errors = list()
+
+        return record
+
+
+def strip_nifti_ext(prefix):
+    """
+    Output prefix of a run without the .nii extension it is sometimes specified with (as PRONTO strips it).
+        Only that extension is stripped, as the prefixes may contain other dots.
+    """
+
+    if prefix.endswith('.nii'):
+        return prefix[:-len('.nii')]
+    return prefix
+
+
+def parse_input_line(line, line_num=None):
+    """
+    Tokenizes a line of the input file in a single pass, without checking the files it refers to.
+        Problems found with the line are listed in the errors of the record.
+
+    :rtype: RunRecord
+    """
+
+    record = RunRecord(line, line_num)
+    for token in line.split():
+        key, sep, value = token.partition('=')
+        field = input_fields.get(key.upper())
+        if not sep or field is None:
+            # not a field of the input file
+            continue
+
+        if field == 'drop':
+            drop = reDropValue.match(value)
+            if drop is None:
+                record.errors.append('DROP indices must be two non-negative integers, like DROP=[2,2].')
+            else:
+                record.drop_beg, record.drop_end = drop.groups()
+            continue
+
+        if reValue.match(value) is None:
+            record.errors.append('{} contains an invalid path that can not be parsed. Only alphanumeric, '
+                                 'underscore (_), hyphen (-) and plus (+) characters are allowed.'.format(key))
+            continue
+
+        if field == 'out':
+            record.out, record.prefix = os.path.split(value)
+        else:
+            setattr(record, field, value)
+
+    return record
+
+
+def read_run_records(input_file):
+    """Yields the record of each line of an input file, one at a time, numbering the lines from 1."""
+
+    with open(input_file, 'r') as ipf:
+        for line_num, line in enumerate(ipf, 1):
+            yield parse_input_line(line, line_num)
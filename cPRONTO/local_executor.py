@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Bounded executor to run a graph of OPPNI job scripts on the current node.
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+# long (but finite) timeout, so the main thread still responds to Ctrl+C while waiting
+wait_timeout_sec = 60 * 60 * 24 * 365
+
+
+def run_one_job(exec_func, job_id, job_path, finished):
+    """Runs a single job and reports back its exit code, no matter how it ended."""
+
+    try:
+        ret_code = exec_func(job_path)
+    except Exception as exc:
+        print('Error executing job {}: {}'.format(job_path, exc))
+        ret_code = -1
+
+    finished.put((job_id, ret_code))
+
+
+def run_job_graph(jobs, num_workers, exec_func):
+    """
+    Runs each job as soon as all the jobs it depends on finished successfully,
+        keeping up to num_workers jobs running at any time.
+
+    :param jobs: dict of job_id -> {'path': script path, 'depends_on': list of job ids}
+    :param num_workers: maximum number of jobs running simultaneously
+    :param exec_func: callable taking the path to a job script and returning its exit code
+    :returns: dict of job_id -> exit code (None for jobs skipped due to a failed dependency)
+    :rtype: OrderedDict
+
+    """
+
+    num_workers = max(1, int(num_workers))
+
+    waiting_on = dict()
+    dependents = dict((job_id, list()) for job_id in jobs)
+    for job_id, job in jobs.items():
+        # dependencies outside this graph (finished in previous sessions) need no waiting
+        deps = set([dep for dep in job['depends_on'] if dep in jobs])
+        waiting_on[job_id] = deps
+        for dep in deps:
+            dependents[dep].append(job_id)
+
+    ready = [job_id for job_id in jobs if not waiting_on[job_id]]
+    exit_codes = OrderedDict()
+    finished = Queue()
+    num_running = 0
+
+    pool = ThreadPool(num_workers)
+    try:
+        while ready or num_running > 0:
+            while ready and num_running < num_workers:
+                job_id = ready.pop(0)
+                pool.apply_async(run_one_job, (exec_func, job_id, jobs[job_id]['path'], finished))
+                num_running += 1
+
+            job_id, ret_code = finished.get(True, wait_timeout_sec)
+            num_running -= 1
+            exit_codes[job_id] = ret_code
+
+            if ret_code == 0:
+                for child in dependents[job_id]:
+                    waiting_on[child].discard(job_id)
+                    if not waiting_on[child]:
+                        ready.append(child)
+            else:
+                print('Job {} failed with exit code {}.'.format(jobs[job_id]['path'], ret_code))
+                skip_dependents(job_id, dependents, exit_codes, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    return exit_codes
+
+
+def skip_dependents(failed_job_id, dependents, exit_codes, jobs):
+    """Marks all the jobs downstream of a failed job as skipped."""
+
+    to_skip = list(dependents[failed_job_id])
+    while to_skip:
+        job_id = to_skip.pop()
+        if job_id in exit_codes:
+            continue
+        exit_codes[job_id] = None
+        print('\t skipping {} as one of its dependencies failed.'.format(jobs[job_id]['path']))
+        to_skip.extend(dependents[job_id])
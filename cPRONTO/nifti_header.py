@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Reads the headers of NIfTI-1/2 files, without reading (or decompressing) the data that follows them.
+
+import gzip
+import mmap
+import os
+import struct
+from multiprocessing.pool import ThreadPool
+
+nifti1_header_size = 348
+nifti2_header_size = 540
+
+# headers read simultaneously - reads from network filesystems are mostly waiting
+num_header_threads = 16
+
+# bits per voxel of the datatypes the pipelines can read (complex and RGB types are not supported)
+supported_datatypes = {2: 8, 4: 16, 8: 32, 16: 32, 64: 64, 256: 8, 512: 16, 768: 32}
+
+# multipliers of the time unit in xyzt_units, to express TR in msec (unknown units are taken to be seconds, like AFNI)
+time_units_msec = {0: 1000.0, 8: 1000.0, 16: 1.0, 24: 1.0e-3}
+
+# headers read so far, by path, mtime and size
+header_cache = dict()
+
+
+def read_header_bytes(nii_path):
+    """
+    Reads just the bytes of the header: memory-mapping the start of .nii files,
+        and decompressing only as much as needed of .nii.gz files.
+    """
+
+    if nii_path.endswith('.gz'):
+        gz = gzip.open(nii_path, 'rb')
+        try:
+            return gz.read(nifti2_header_size)
+        finally:
+            gz.close()
+
+    with open(nii_path, 'rb') as nii:
+        size = os.fstat(nii.fileno()).st_size
+        if size < nifti1_header_size:
+            return nii.read()
+        mapped = mmap.mmap(nii.fileno(), min(size, nifti2_header_size), access=mmap.ACCESS_READ)
+        try:
+            return mapped[:]
+        finally:
+            mapped.close()
+
+
+def parse_header(raw):
+    """
+    Decodes the fields of a NIfTI-1/2 header needed to plan the processing of a run.
+
+    :returns: dict with version, dims and pixdim (without dim[0]), datatype, bitpix, vox_offset,
+        slice_code, slice_duration, has_extension and tr_msec (0 if not set)
+    :rtype: dict
+    """
+
+    for endian in ('<', '>'):
+        if len(raw) >= nifti1_header_size and struct.unpack(endian + 'i', raw[0:4])[0] == nifti1_header_size:
+            dims = struct.unpack(endian + '8h', raw[40:56])
+            datatype, bitpix = struct.unpack(endian + '2h', raw[70:74])
+            pixdim = struct.unpack(endian + '8f', raw[76:108])
+            vox_offset = struct.unpack(endian + 'f', raw[108:112])[0]
+            slice_code, xyzt_units = struct.unpack('2B', raw[122:124])
+            slice_duration = struct.unpack(endian + 'f', raw[132:136])[0]
+            version, extension_at = 1, nifti1_header_size
+            break
+        if len(raw) >= nifti2_header_size and struct.unpack(endian + 'i', raw[0:4])[0] == nifti2_header_size:
+            datatype, bitpix = struct.unpack(endian + '2h', raw[12:16])
+            dims = struct.unpack(endian + '8q', raw[16:80])
+            pixdim = struct.unpack(endian + '8d', raw[104:168])
+            vox_offset = struct.unpack(endian + 'q', raw[168:176])[0]
+            slice_duration = struct.unpack(endian + 'd', raw[208:216])[0]
+            slice_code, xyzt_units = struct.unpack(endian + '2i', raw[496:504])
+            version, extension_at = 2, None
+            break
+    else:
+        raise ValueError('not a NIfTI-1/2 file')
+
+    ndim = dims[0]
+    if not 1 <= ndim <= 7:
+        raise ValueError('invalid number of dimensions: {}'.format(ndim))
+
+    # the extender flag follows the header of NIfTI-1 files (not read for NIfTI-2, which has larger headers)
+    has_extension = extension_at is not None and raw[extension_at:extension_at + 1] not in ('', '\x00')
+
+    tr_msec = 0.0
+    if ndim >= 4 and pixdim[4] > 0:
+        tr_msec = pixdim[4] * time_units_msec.get(xyzt_units & 0x38, 1000.0)
+
+    return {'version': version,
+            'dims': list(dims[1:ndim + 1]),
+            'pixdim': list(pixdim[1:ndim + 1]),
+            'datatype': datatype,
+            'bitpix': bitpix,
+            'vox_offset': int(vox_offset),
+            'slice_code': slice_code,
+            'slice_duration': slice_duration,
+            'has_extension': has_extension,
+            'tr_msec': tr_msec}
+
+
+def read_header(nii_path):
+    """Header of a NIfTI file, read only once for each version of the file (by mtime and size)."""
+
+    st = os.stat(nii_path)
+    key = (nii_path, st.st_mtime, st.st_size)
+    if key not in header_cache:
+        header = parse_header(read_header_bytes(nii_path))
+        header['file_size'] = st.st_size
+        header_cache[key] = header
+
+    return header_cache[key]
+
+
+def try_read_header(nii_path):
+    """Returns the header along with the reason it could not be read, if any."""
+
+    try:
+        return read_header(nii_path), None
+    except (IOError, OSError, ValueError, struct.error) as exc:
+        return None, str(exc)
+
+
+def read_headers(nii_paths, num_threads=num_header_threads):
+    """
+    Reads the headers of many NIfTI files concurrently, each only once.
+
+    :returns: dict of path -> (header or None, reason it could not be read or None)
+    """
+
+    unique_paths = list(set(nii_paths))
+    if len(unique_paths) < 1:
+        return dict()
+
+    pool = ThreadPool(max(1, min(num_threads, len(unique_paths))))
+    try:
+        headers = pool.map(try_read_header, unique_paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(unique_paths, headers))
+
+
+def data_end(header):
+    """Size the file must have to hold all the data declared in the header (uncompressed)."""
+
+    num_elements = 1
+    for dim in header['dims']:
+        num_elements *= max(1, dim)
+
+    return header['vox_offset'] + num_elements * header['bitpix'] // 8
+
+
+def num_voxels(header):
+    """Number of voxels in a single volume."""
+
+    count = 1
+    for dim in header['dims'][0:3]:
+        count *= max(1, dim)
+
+    return count
+
+
+def num_volumes(header):
+    """Number of volumes (time points), 1 for 3D images."""
+
+    if len(header['dims']) < 4:
+        return 1
+    return max(1, header['dims'][3])
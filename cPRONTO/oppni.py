@@ -4,8 +4,12 @@
 # Version 0.6 (May 2016)
 
 import argparse
+import glob
+import itertools
 import json
+import logging
 import os
+import socket
 import pickle
 import random
 import re
@@ -13,23 +17,67 @@ import stat
 import subprocess
 import sys
 import tempfile
+import threading
 import math
 import time
 import warnings
 from collections import OrderedDict
 from copy import copy
+from functools import partial
+from logging.handlers import RotatingFileHandler
+from multiprocessing.pool import ThreadPool
 from distutils.spawn import find_executable
-from multiprocessing import Pool
 from shutil import rmtree
 from time import localtime, strftime
 
 # OPPNI related
 import cfg_front as cfg_pronto
+import executors
+import nifti_header
+import pipeline_search
+import preproc_cache
+import queue_status
+import runtime_ledger
+import submission
+from input_records import RunRecord, parse_input_line, read_run_records, strip_nifti_ext
 import proc_status_front as check_proc_status
 
 file_name_hpc_config = 'hpc_config.json'
 file_name_job_ids_by_group = 'pronto_job_ids_by_step_prefix.json'
 file_name_prev_options = 'pronto-options.pkl'
+file_name_status_index = 'status_index.json'
+file_name_runtime_ledger = 'runtime_ledger.jsonl'
+dir_name_local_logs = 'logs'
+dir_name_sentinels = 'sentinels'
+
+# variable holding the path to the input file of the current task in array jobs
+array_input_var = 'OPPNI_INPUT_FILE'
+array_input_arg = '${' + array_input_var + '}'
+# variables holding the args appended for some of the tasks only, numbered from 1 (empty for the other tasks)
+array_extra_var = 'OPPNI_TASK_ARG'
+# args of the job taken from a variable set by each task of an array job
+reArrayArg = re.compile(r'^\$\{(OPPNI_\w+)\}$')
+
+# work queue pulled by the persistent workers (--workers), with a subfolder per state of the tasks
+dir_name_work_queue = 'work_queue'
+work_queue_states = ('pending', 'running', 'done', 'failed')
+# how long the workers wait on tasks blocked by tasks running elsewhere, before giving up
+worker_max_idle_sec = 1800
+
+# files checked simultaneously when validating the input file - checks on network filesystems are mostly waiting
+num_validation_threads = 16
+
+# size of each log file of a local job, and the number of rotated logs to keep
+local_log_max_bytes = 50 * 1024 * 1024
+local_log_backup_count = 3
+
+# cache of the preprocessing shared by the processing folders of an output folder, unless specified otherwise
+dir_name_preproc_cache = 'preprocessing_cache'
+# step of the jobs preprocessing the runs for the other analyses submitted along with the first one
+step_shared_preproc = 'PREPROC'
+
+# memory requested for the jobs whose resources could not be estimated (when --memory is not specified)
+default_memory_gb = '4'
 
 # descriptive variables
 NOT_DONE = False
@@ -44,21 +92,35 @@ hpc = {'type': 'SGE',
        'header': '',
        'dry_run': False,
        'hold_jobid_list': [],
-       'job_ids_grouped': {}}
+       'job_ids_grouped': {},
+       'array_tasks': {},
+       'ledger_path': None,
+       'submit_threads': 4,
+       'submit_rate': 10,
+       'max_queued': 0}
+
+# backend running the jobs (see executors.py), made for the hpc config by get_executor()
+global executor
+executor = None
+# paces the submissions to the backend (see submission.py), made by get_submitter()
+global submitter
+submitter = None
+# to keep the lines printed by concurrent jobs from interleaving
+print_lock = threading.Lock()
 
 # defining regexes that may be useful in various functions
-# regex to extract the relevant parts of the input file
-reIn = re.compile(r"IN=([\w\./+_-]+)[\s]*")
-reOut = re.compile(r"OUT=([\w\./+_-]+)[\s]*")
-reDrop = re.compile(r"DROP=\[(\d+),(\d+)\][\s]*")
-reTask = re.compile(r"TASK=([\w\./+_-]+)[\s]*")
+# (the lines of the input file are parsed by input_records.parse_input_line)
 # to parse the task files
 reName = re.compile(r"NAME=\[([\w\./+_-]+)\][\s]*")
 
+# task files parsed so far, by path and mtime, as many runs usually share the same task file
+task_file_cache = dict()
+reTR = re.compile(r"TR_MSEC=\[([\d\.]+)\]")
 
-rePhysio = re.compile(r"PHYSIO=([\w\./+_-]+)[\s]*")
-reStruct = re.compile(r"STRUCT=([\w\./+_-]+)[\s]*")
-reCustReg = re.compile(r"CUSTOMREG=([\w\./+_-]+)[\s]*")
+# volumes that must remain in each run after dropping those specified in DROP=
+min_volumes_retained = 2
+# relative difference tolerated between the TR in the NIfTI header and TR_MSEC
+tr_tolerance = 0.01
 
 # for the pipeline file
 rePip = re.compile('([0-9A-Z\s]+)=.+', re.IGNORECASE)
@@ -66,7 +128,8 @@ rePip2 = re.compile(r'([0-9A-Z\s]+)=\[([\d,]*)\][\s]*')
 
 
 def get_out_dir_line(line):
-    return os.path.abspath(reOut.search(line).group(1))
+    record = parse_input_line(line)
+    return os.path.abspath(os.path.join(record.out, record.prefix))
 
 
 def get_out_dir_first_line(input_file):
@@ -110,25 +173,48 @@ def validate_pipeline_file(pipeline_file):
     return steps_dict
 
 
+def read_task_file(task_path):
+    """
+    Reads a task file, only once for each version of it (by mtime).
+
+    :returns: task spec and the names of conditions defined in it
+    :rtype: str, list
+    """
+
+    key = (task_path, os.path.getmtime(task_path))
+    if key not in task_file_cache:
+        with open(task_path, 'r') as tf:
+            task_spec = tf.read().splitlines()
+            # task_spec = [ line.strip('\n ') for line in task_spec ]
+        task_spec = '\n'.join(task_spec)
+        tr_msec = reTR.search(task_spec)
+        task_file_cache[key] = {'spec': task_spec, 'names': reName.findall(task_spec), 'valid_for': set(),
+                                'tr_msec': float(tr_msec.group(1)) if tr_msec is not None else None}
+
+    return task_file_cache[key]
+
+
 def validate_task_file(task_path, cond_names_in_contrast=None):
     """Basic validation of task spec file."""
 
-    with open(task_path, 'r') as tf:
-        task_spec = tf.read().splitlines()
-        # task_spec = [ line.strip('\n ') for line in task_spec ]
-    task_spec = '\n'.join(task_spec)
+    task = read_task_file(task_path)
+    contrast_key = None if cond_names_in_contrast is None else tuple(cond_names_in_contrast)
+    if contrast_key in task['valid_for']:
+        return True
 
+    task_spec = task['spec']
     for field in cfg_pronto.TASK_MANDATORY_FIELDS:
         if field + '=' not in task_spec:
             raise TypeError('{} is not defined in task file'.format(field))
 
     if cond_names_in_contrast is not None:
-        cond_names_in_file = reName.findall(task_spec)
+        cond_names_in_file = task['names']
         for name in cond_names_in_contrast:
             if name not in cond_names_in_file:
                 raise ValueError("Condition {} in contrast is not defined in task file:"
                                  "\n {} \n Defined: {}".format(name, task_path, cond_names_in_file))
 
+    task['valid_for'].add(contrast_key)
     return True
 
 
@@ -146,9 +232,34 @@ def validate_user_env(opt):
             validate_env_var('MCR_PATH')
 
 
-def validate_input_file(input_file, options=None, new_input_file=None, cond_names_in_contrast=None, validate_only=False):
+def check_files_exist(files, num_threads=num_validation_threads):
+    """
+    Checks the existence of many files concurrently, each only once.
+
+    :returns: dict of path -> whether it is an existing file
+    """
+
+    unique_files = list(set(files))
+    if len(unique_files) < 1:
+        return dict()
+
+    pool = ThreadPool(max(1, min(num_threads, len(unique_files))))
+    try:
+        found = pool.map(os.path.isfile, unique_files)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(zip(unique_files, found))
+
+
+def validate_input_file(input_file, options=None, new_input_file=None, cond_names_in_contrast=None, validate_only=False,
+                        report_timings=False):
     """Key function to ensure input file is valid, and creates a copy of the input file in the output folders.
-        Also handles the reorganization of output files depending on options chosen."""
+        Also handles the reorganization of output files depending on options chosen.
+
+    :param report_timings: prints the time taken by each phase of the validation.
+    """
 
     if (new_input_file is None) or (options is None) or (options.use_prev_processing_for_QC):
         # in case of resubmission, or when applying QC on an existing processing from older versions of OPPNI,
@@ -164,51 +275,73 @@ def validate_input_file(input_file, options=None, new_input_file=None, cond_name
     invalid_lines = list()
     line_count = 0
     dupl_prefix_count = 0
-    with open(input_file, 'r') as ipf:
-        for line in ipf.readlines():
-            line_count += 1
-            subject, new_line = validate_input_line(line, cur_suffix, cond_names_in_contrast)
-            if subject is False or subject is None:
-                print('Error in line number {}.'.format(line_count))
-                invalid_lines.append(line_count)
-                continue
-            else:
-                subject['line'] = new_line
-
-                # make an output folder only when neeed (not when just validating the input file)
-                if not validate_only and not os.path.exists(subject['out']):
-                    os.makedirs(subject['out'])
-
-                # if the key doesnt exist, dict returns None
-                if unique_subjects.get(subject['prefix']) is not None:
-                    print "Potential duplicate prefix in line {}: {}".format(line_count, subject['prefix'])
-                    print " \t Previously processed line contained this prefix."
-                    dupl_prefix_count += 1
-                unique_subjects[subject['prefix']] = subject
-                new_file.write(new_line)
-
-            # options = None is when this helper script is called from outside of OPPNI
-            if options is not None and options.contrast_specified:
-                assert subject['task'] is not None, \
-                    'Contrast specified, but not a task file in line number {}.'.format(line_count)
-            if options is not None and options.reference_specified:
-                assert subject['struct'] is not None, \
-                    'Reference atlas is specified, but not a structural scan in line number {}.'.format(line_count)
-            # if one of the physiological methods are requested
-            if options is not None and options.physio_correction_requested:
-                assert subject['physio'] is not None, \
-                    'RETROICOR and/or PHYPLUS are specified but not the physiological files! Line number {}.'.format(
-                        line_count)
-            if options is not None and options.custom_mask_requested:
-                assert subject['mask'] is not None, \
-                    'CUSOMREG is specified but not a binary mask! Line number {}.'.format(line_count)
+
+    time_start = time.time()
+    # first pass, only to list the files to check - records are streamed, rather than held for both passes
+    files_to_check = set()
+    for record in read_run_records(input_file):
+        files_to_check.update(record.files())
+    time_read = time.time()
+
+    # checking all the files at once, rather than one at a time line by line
+    files_found = check_files_exist(files_to_check)
+    file_exists = lambda fp: files_found[fp] if fp in files_found else os.path.isfile(fp)
+    time_checked = time.time()
+
+    for record in read_run_records(input_file):
+        line_count = record.line_num
+        subject, new_line = validate_input_line(record, cur_suffix, cond_names_in_contrast, file_exists)
+        if subject is False or subject is None:
+            print('Error in line number {}.'.format(line_count))
+            invalid_lines.append(line_count)
+            continue
+        else:
+            subject.line = new_line
+
+            # make an output folder only when neeed (not when just validating the input file)
+            if not validate_only and not os.path.exists(subject.out):
+                os.makedirs(subject.out)
+
+            # if the key doesnt exist, dict returns None
+            if unique_subjects.get(subject.prefix) is not None:
+                print "Potential duplicate prefix in line {}: {}".format(line_count, subject.prefix)
+                print " \t Previously processed line contained this prefix."
+                dupl_prefix_count += 1
+            unique_subjects[subject.prefix] = subject
+            new_file.write(new_line)
+
+        # options = None is when this helper script is called from outside of OPPNI
+        if options is not None and options.contrast_specified:
+            assert subject.task is not None, \
+                'Contrast specified, but not a task file in line number {}.'.format(line_count)
+        if options is not None and options.reference_specified:
+            assert subject.struct is not None, \
+                'Reference atlas is specified, but not a structural scan in line number {}.'.format(line_count)
+        # if one of the physiological methods are requested
+        if options is not None and options.physio_correction_requested:
+            assert subject.physio is not None, \
+                'RETROICOR and/or PHYPLUS are specified but not the physiological files! Line number {}.'.format(
+                    line_count)
+        if options is not None and options.custom_mask_requested:
+            assert subject.mask is not None, \
+                'CUSOMREG is specified but not a binary mask! Line number {}.'.format(line_count)
 
     new_file.close()
+    time_validated = time.time()
+
+    # headers of all the runs at once, so problems with the data surface before any job waits in the queue
+    header_problems = preflight_nifti_headers(unique_subjects, options)
+    for line_num, problems in header_problems.items():
+        for problem in problems:
+            print(problem)
+        print('Error in line number {}.'.format(line_num))
+        invalid_lines.append(line_num)
+    time_preflight = time.time()
 
     # if the optional fields are specified, making sure they are specified for all the subjects
     optional_fields = ['task', 'struct', 'physio']
     for optf in optional_fields:
-        bool_all_subjects = [sub[optf] is not None for ix, sub in unique_subjects.items()]
+        bool_all_subjects = [getattr(sub, optf) is not None for ix, sub in unique_subjects.items()]
         num_runs_specified = sum([1 for ii in bool_all_subjects if ii is True])
         if not (num_runs_specified == 0 or num_runs_specified == len(bool_all_subjects)):
             print('Optional fields can either be specified for ALL the subjects, or NONE at all. ')
@@ -223,126 +356,161 @@ def validate_input_file(input_file, options=None, new_input_file=None, cond_name
         if dupl_prefix_count > 0:
             print('\t excluding {} duplicate prefixes: {} lines'.format(dupl_prefix_count, len(unique_subjects)))
 
+    if report_timings:
+        print('Time taken (sec): reading {:.2f}, checking {} files {:.2f}, validating lines {:.2f}, '
+              'reading {} NIfTI headers {:.2f}'.format(time_read - time_start, len(files_found),
+                                                       time_checked - time_read, time_validated - time_checked,
+                                                       len(unique_subjects), time_preflight - time_validated))
+
     return unique_subjects
 
 
-def validate_input_line(ip_line, suffix='', cond_names_in_contrast=None):
-    """Method where the real validation of the input line happens!"""
+def preflight_nifti_headers(subjects, options=None):
+    """
+    Reads the NIfTI header of all the runs (and nothing but the header) in parallel, checking that they suit
+        the processing requested. The headers are kept in the records of the runs, to plan their jobs.
+
+    :returns: problems found with the runs, by line number
+    :rtype: OrderedDict
+    """
 
-    line = ip_line.strip()
-    LINE = line.upper()
+    headers = nifti_header.read_headers([subject.nii for subject in subjects.values()])
 
-    # defining an empty subject or run
-    subject = {
-        'nii': None,
-        'prefix': None,
-        'out': None,
-        'drop_beg': None,
-        'drop_end': None,
-        'task': None,  # optional from here onwards
-        'physio': None,
-        'struct': None,
-        'mask': None
-    }
+    problems = OrderedDict()
+    for subject in subjects.values():
+        header, reason = headers[subject.nii]
+        subject.header = header
+        found = check_run_header(subject, header, reason, options)
+        if len(found) > 0:
+            problems[subject.line_num] = found
 
-    in_flag = True
-    out_flag = True
-    drop_flag = True
+    return problems
+
+
+def check_run_header(subject, header, reason=None, options=None):
+    """
+    Checks the NIfTI header of a run against its DROP, TR_MSEC and slice-timing requirements.
+
+    :returns: list of the problems found
+    """
+
+    if header is None:
+        return ['Unable to read the NIfTI header of {}: {}'.format(subject.nii, reason)]
+
+    problems = list()
+    if header['datatype'] not in nifti_header.supported_datatypes:
+        problems.append('Unsupported NIfTI datatype {} in {}'.format(header['datatype'], subject.nii))
+
+    num_volumes = nifti_header.num_volumes(header)
+    if len(header['dims']) < 4 or num_volumes < 2:
+        problems.append('{} is not a 4D time series: its dimensions are {}'.format(subject.nii, header['dims']))
+    elif num_volumes - int(subject.drop_beg) - int(subject.drop_end) < min_volumes_retained:
+        problems.append('DROP=[{},{}] leaves less than {} of the {} volumes in {}'.format(
+            subject.drop_beg, subject.drop_end, min_volumes_retained, num_volumes, subject.nii))
+
+    # --TR_MSEC overrides the TR_MSEC of the task files
+    tr_msec = None
+    if options is not None and options.TR_MSEC not in [None, 'None', '']:
+        tr_msec = float(options.TR_MSEC)
+    elif subject.task is not None:
+        tr_msec = read_task_file(subject.task)['tr_msec']
+
+    if tr_msec is None and header['tr_msec'] <= 0:
+        problems.append('TR is neither set in the header of {} nor specified with TR_MSEC '
+                        '(in the task file or with --TR_MSEC)'.format(subject.nii))
+    elif tr_msec is not None and header['tr_msec'] > 0 and abs(header['tr_msec'] - tr_msec) > tr_tolerance * tr_msec:
+        print('Warning: TR in the header of {} ({:.0f} msec) differs from TR_MSEC={:.0f}'.format(
+            subject.nii, header['tr_msec'], tr_msec))
+
+    steps = getattr(options, 'pipeline_steps', None)
+    if steps is not None and 1 in steps.get('TIMECOR', []) and options.TPATTERN.lower() == 'auto_hdr':
+        # AFNI may also find the timing in its own extension of the header
+        if header['slice_code'] == 0 and header['slice_duration'] <= 0 and not header['has_extension']:
+            problems.append('Slice timing is to be read from the header (--TPATTERN auto_hdr), but {} has none. '
+                            'Specify the acquisition pattern with --TPATTERN instead.'.format(subject.nii))
+
+    return problems
+
+
+def validate_input_line(ip_line, suffix='', cond_names_in_contrast=None, file_exists=os.path.isfile):
+    """Method where the real validation of the input line happens!
+
+    :param ip_line: line of the input file, or its RunRecord from parse_input_line.
+    :param file_exists: callable checking whether a file exists, to reuse the results of checks done beforehand.
+    :returns: the record of the line, and the line to process it with
+    """
+
+    if isinstance(ip_line, RunRecord):
+        record = ip_line
+    else:
+        record = parse_input_line(ip_line)
+
+    for error in record.errors:
+        print error
+    if len(record.errors) > 0:
+        return (False, "")
 
     # IN part
-    if "IN=" not in LINE:
+    if record.nii is None:
         print "IN= section not defined."
         return (False, "")
-    else:
-        nii = reIn.search(line).group(1)
-        if not os.path.isfile(nii):
-            print "Input file not found: " + nii
-            return (False, "")
-        else:
-            subject['nii'] = nii
+    elif not file_exists(record.nii):
+        print "Input file not found: " + record.nii
+        return (False, "")
 
     # OUT part
-    if "OUT=" not in LINE:
+    if record.out is None:
         print "OUT= section not defined."
         return (False, "")
     else:
-        out = reOut.search(line).group(1)
-        base_out_dir = os.path.dirname(out)
+        base_out_dir = record.out
         # adding another directory level based on input file name and analysis model
         if suffix not in [None, '']:
-            subject['out'] = os.path.join(base_out_dir, suffix)
-        else:
-            # in case of resubmission, don't alter the previous setup
-            subject['out'] = base_out_dir
+            record.out = os.path.join(base_out_dir, suffix)
 
         # prepending it with OUT= to restrict the sub to only OUT, and not elsewhere such as TASK=
         prev_dir = 'OUT={}'.format(base_out_dir)
-        curr_dir = 'OUT={}'.format(subject['out'])
-        new_line = re.sub(prev_dir, curr_dir, ip_line)
+        curr_dir = 'OUT={}'.format(record.out)
+        new_line = re.sub(prev_dir, curr_dir, record.line)
 
-        subject['prefix'] = os.path.basename(out)
         # Parse_Input_File.m is not robust with parsing e.g. an extra / at the end will mess up everything
         # so checking to make sure prefix is not empty
-        assert (subject['prefix'] not in [None, '']), \
+        assert (record.prefix not in [None, '']), \
             'subject prefix can not be empty!'
 
     # DROP part
-    if "DROP=" not in LINE:
+    if record.drop_beg is None:
         print "DROP= section not defined."
         return (False, "")
-    else:
-        idx = reDrop.search(line).groups()
-        if not len(idx) == 2:
-            print "Atleast two indices must be specified to drop from the start and end."
-            return (False, "")
-        elif (not all([ii.isdigit() for ii in idx])):
-            print "DROP indices must be numeric!"
-            return (False, "")
-        elif not all([ii >= 0 for ii in idx]):
-            print("All the DROP indices must be non-negative.")
-        else:
-            subject['drop_beg'] = idx[0]
-            subject['drop_end'] = idx[1]
 
     # the following parts are not mandatory, errors will be raised later on, when inconsistencies are found.
     # TASK part
-    if "TASK=" in line:
-        task = reTask.search(line).group(1)
-        if not os.path.isfile(task):
-            print "Task file " + task + " not found."
+    if record.task is not None:
+        if not file_exists(record.task):
+            print "Task file " + record.task + " not found."
             return None, None
         else:
-            validate_task_file(task, cond_names_in_contrast)
-            subject['task'] = task
+            validate_task_file(record.task, cond_names_in_contrast)
 
     # PHYSIO part
-    if "PHYSIO=" in LINE:
-        physio = rePhysio.search(line).group(1)
-        if not os.path.isfile(physio + '.puls.1D') or not os.path.isfile(physio + '.resp.1D'):
-            print "PHYSIO files (puls and/or resp) at " + physio + " not found."
+    if record.physio is not None:
+        if not file_exists(record.physio + '.puls.1D') or not file_exists(record.physio + '.resp.1D'):
+            print "PHYSIO files (puls and/or resp) at " + record.physio + " not found."
             return None, None
-        else:
-            subject['physio'] = physio
 
     # STRUCT part
-    if "STRUCT=" in LINE:
-        struct = reStruct.search(line).group(1)
-        if not os.path.isfile(struct):
-            print "STRUCT file " + struct + " not found."
+    if record.struct is not None:
+        if not file_exists(record.struct):
+            print "STRUCT file " + record.struct + " not found."
             return None, None
-        else:
-            subject['struct'] = struct
 
-    # PHYSIO part
-    if "CUSTOMREG=" in LINE:
-        mask = reCustReg.search(line).group(1)
-        if not os.path.isfile(mask):
-            print "Binary mask " + mask + " not found."
+    # CUSTOMREG part
+    if record.mask is not None:
+        if not file_exists(record.mask):
+            print "Binary mask " + record.mask + " not found."
             return None, None
-        else:
-            subject['mask'] = mask
 
-    return subject, new_line
+    return record, new_line
 
 
 def parse_args_check():
@@ -380,8 +548,9 @@ def parse_args_check():
 
     parser.add_argument("-a", "--analysis", action="store", dest="analysis",
                         default="None",
-                        choices=cfg_pronto.CODES_ANALYSIS_MODELS,
-                        help="Choose an analysis model :" + ",".join(cfg_pronto.CODES_ANALYSIS_MODELS))
+                        help="Choose an analysis model :" + ",".join(cfg_pronto.CODES_ANALYSIS_MODELS) +
+                             ". Several models can be listed, separated by commas (e.g. LDA,GNB), to analyse each "
+                             "contrast with each of them, sharing a single preprocessing of the runs.")
     parser.add_argument("-m", "--metric", action="store", dest="metric",
                         default="dPR",
                         choices=cfg_pronto.CODES_METRIC_LIST,
@@ -392,6 +561,26 @@ def parse_args_check():
                         choices=cfg_pronto.CODES_OPTIM_SCHEMES_OPTIONS,
                         help="Optimization scheme to decide on which pipelines to be produced.")
 
+    parser.add_argument("--adaptive_rounds", action="store", dest="adaptive_rounds", type=int,
+                        default=0,
+                        help="Searches the pipeline combinations adaptively in this many rounds, rather than "
+                             "preprocessing every run with all of them: each round evaluates the combinations left "
+                             "on a pilot subset of the runs, twice the size of that of the previous round, and drops "
+                             "the losing options of the steps until about half the combinations remain (on the "
+                             "metric chosen with -m). All the runs are then processed with the combinations "
+                             "surviving the last round. Default 0, for an exhaustive search.")
+    parser.add_argument("--pilot_fraction", action="store", dest="pilot_fraction", type=float,
+                        default=0.1,
+                        help="Fraction of the runs evaluated in the first round of the adaptive search, or that the "
+                             "pipelines are selected on with --pilot_selection (default 0.1). "
+                             "The pilot runs are sampled across the task files and acquisitions.")
+    parser.add_argument("--pilot_selection", action="store_true", dest="pilot_selection",
+                        default=False,
+                        help="With --os FIX or CON, selects the pipelines on a pilot subset of the runs "
+                             "(see --pilot_fraction), processed with all the combinations, before processing the "
+                             "rest of the runs with the combinations of the FIX and CON pipelines selected only "
+                             "(both are needed by QC).")
+
     # parser.add_argument("--autodetect", action="store_true", dest="autodetect",
     #                    help="Automatically detect subjects and optimize for each subject independently, "
     #                         "the lines in input files that have same structrul image (STRUCT) and "
@@ -408,7 +597,9 @@ def parse_args_check():
     parser.add_argument("--contrast", action="store", dest="contrast_list_str",
                         default="None",
                         help="desired task contrast in form of task-baseline, using names as defined in the task file. "
-                             "Multi-contrast analysis is disabled for now.")
+                             "Several contrasts can be listed, separated by commas (e.g. task1-fixation,task2-task1), "
+                             "each analysed separately in its own processing folder, "
+                             "sharing a single preprocessing of the runs.")
 
     # # TODO multi-contrast : doesn't work right now.
     # parser.add_argument("--contrast", action="store", dest="contrast_list_str",
@@ -502,12 +693,34 @@ def parse_args_check():
                         help="(optional) determine which software to use to run the code: matlab or compiled(default)")
 
     parser.add_argument("--cluster", action="store", dest="hpc_type",
-                        default=None, choices=('ROTMAN', 'BRAINCODE', 'CAC', 'SCINET', 'SHARCNET', 'CBRAIN', 'SGE'),
-                        help="Please specify the type of cluster you're running the code on.")
+                        default=None, choices=('ROTMAN', 'BRAINCODE', 'CAC', 'SCINET', 'SHARCNET', 'CBRAIN', 'SGE',
+                                               'TORQUE', 'PBS', 'SLURM', 'MOCK'),
+                        help="Please specify the type of cluster you're running the code on. "
+                             "MOCK simulates one, running no jobs, to test the submission of large studies.")
 
     parser.add_argument("--memory", action="store", dest="memory",
-                        default="4",
-                        help="(optional) determine the minimum amount RAM needed for the job, e.g. --memory 8 (in gigabytes)!")
+                        default=None,
+                        help="(optional) determine the minimum amount RAM needed for the job, e.g. --memory 8 (in gigabytes)! "
+                             "When not specified, the memory and walltime of each job are estimated from the size "
+                             "of its runs (as per their NIfTI headers) and the number of pipelines.")
+    parser.add_argument("--ledger", action="store", dest="ledger_path",
+                        default=None,
+                        help="(optional) runtime ledger, to which every job appends the resources it used, and from "
+                             "which those of the jobs to come are predicted. Default: runtime_ledger.jsonl in the "
+                             "output folder. Point studies to the same ledger to share what is learned across them.")
+    parser.add_argument("--resource_quantile", action="store", dest="resource_quantile", type=float,
+                        default=0.95,
+                        help="(optional) quantile of the usage of the past jobs in the ledger to request for new jobs "
+                             "(default 0.95), when --memory is not specified.")
+    parser.add_argument("--preproc_cache", action="store", dest="preproc_cache",
+                        default=None,
+                        help="(optional) folder caching the AFNI preprocessing of each run, reused by all the "
+                             "analysis models and contrasts processing the same runs with the same preprocessing "
+                             "options. Default: preprocessing_cache in the output folder of the first run. "
+                             "Point studies to the same folder to share it across them.")
+    parser.add_argument("--no_preproc_cache", action="store_true", dest="no_preproc_cache",
+                        default=False,
+                        help="Preprocesses all the runs, without looking them up in (or adding them to) the cache.")
     parser.add_argument("-n", "--numcores", action="store", dest="numcores",
                         default=1,
                         help=argparse.SUPPRESS)
@@ -521,6 +734,50 @@ def parse_args_check():
                         default=None,
                         help="(optional) Name of the parallel environment under which the multi-core jobs gets executed. This must be specified explicitly when numcores > 1.")
 
+    parser.add_argument("--array_jobs", action="store_true", dest="array_jobs",
+                        default=False,
+                        help="Submits the per-subject steps (preprocessing and spatial normalization) as a single "
+                             "array job per step, instead of one job per subject. Recommended for large datasets. "
+                             "On SGE and SLURM, each task waits only for the task of the same subject in the "
+                             "previous array; PBS and TORQUE can not express that, so each array waits for all the "
+                             "tasks of the previous one.")
+
+    parser.add_argument("--subjects_per_job", action="store", dest="subjects_per_job", type=int,
+                        default=1,
+                        help="Packs the per-subject steps (preprocessing and spatial normalization) of this many "
+                             "subjects into a single job. Recommended on clusters allocating whole nodes, "
+                             "or limiting the number of jobs per user.")
+    parser.add_argument("--concurrent_subjects", action="store", dest="concurrent_subjects", type=int,
+                        default=1,
+                        help="Number of subjects processed concurrently within each job when --subjects_per_job > 1."
+                             " They are processed one after another by default. "
+                             "Make sure the jobs are allocated as many cores.")
+    parser.add_argument("--part1_shards", action="store", dest="part1_shards", type=int,
+                        default=1,
+                        help="Splits Part 1 of each subject into this many jobs: the AFNI steps are run once per "
+                             "subject, then each shard computes the metrics of a subset of the pipeline combinations "
+                             "in parallel, and a last job merges their outputs. "
+                             "Capped by the number of combinations.")
+
+    parser.add_argument("--workers", action="store", dest="num_workers", type=int,
+                        default=0,
+                        help="Runs all the steps through N persistent workers, each starting MATLAB (or the MCR) only once "
+                             "and processing the queued step invocations until none are left. Recommended when "
+                             "the start up of MATLAB/MCR takes longer than the steps themselves.")
+
+    parser.add_argument("--submit_threads", action="store", dest="submit_threads", type=int,
+                        default=4,
+                        help="Number of jobs submitted to the cluster concurrently (default 4).")
+    parser.add_argument("--submit_rate", action="store", dest="submit_rate", type=float,
+                        default=10,
+                        help="Maximum number of jobs submitted per second (default 10, 0 for no limit), "
+                             "for clusters rejecting bursts of submissions.")
+    parser.add_argument("--max_queued", action="store", dest="max_queued", type=int,
+                        default=0,
+                        help="Maximum number of jobs (or tasks of array jobs) of this submission in the queue at any "
+                             "time (default 0, for no limit). Jobs above it are held back, and submitted as earlier "
+                             "ones finish. Use it on clusters capping the jobs queued per user.")
+
     parser.add_argument("--run_locally", action="store_true", dest="run_locally",
                         default=False,
                         help="Run the pipeline on this computer without using SGE. This has not been fully tested yet, and is not recommended."
@@ -529,6 +786,10 @@ def parse_args_check():
                         default=False,
                         help=argparse.SUPPRESS)
                         # help="Same as --run_locally. Retained for backward compatibility.")
+    parser.add_argument("--tail_logs", action="store_true", dest="tail_logs",
+                        default=False,
+                        help="When running locally, prints the output of all the jobs to screen as it is produced, "
+                             "tagged with the job name. The output is always saved to logs/ in the job files folder.")
     parser.add_argument("--numprocess", action="store", dest="numprocess",
                         default=1,
                         help=argparse.SUPPRESS)
@@ -567,7 +828,7 @@ def parse_args_check():
     elif options.val_input_file_path is not None:
         # performing a basic validation
         try:
-            _ = validate_input_file(options.val_input_file_path, validate_only=True)
+            _ = validate_input_file(options.val_input_file_path, validate_only=True, report_timings=True)
             print " validation succesful."
         except:
             print " validation failed."
@@ -580,6 +841,43 @@ def parse_args_check():
     global hpc
 
     # sanity checks
+    if options.num_workers < 0:
+        raise ValueError('Number of workers must be positive.')
+    if options.num_workers > 0 and options.array_jobs:
+        raise ValueError('Conflicting options specified: specify either of --workers or --array_jobs.')
+    if options.subjects_per_job < 1 or options.concurrent_subjects < 1:
+        raise ValueError('Number of subjects per job and those processed concurrently must be positive.')
+    if options.part1_shards < 1:
+        raise ValueError('Number of shards of Part 1 must be positive.')
+    if options.subjects_per_job > 1 and (options.array_jobs or options.num_workers > 0):
+        raise ValueError('Conflicting options specified: --subjects_per_job can not be combined '
+                         'with --array_jobs or --workers.')
+
+    if not 0 < options.resource_quantile <= 1:
+        raise ValueError('Quantile of the resources must be within (0, 1].')
+    if options.submit_threads < 1 or options.submit_rate < 0 or options.max_queued < 0:
+        raise ValueError('Number of submission threads must be positive, '
+                         'and the rate of submission and the maximum number of jobs queued can not be negative.')
+
+    if options.adaptive_rounds < 0 or not 0 < options.pilot_fraction < 1:
+        raise ValueError('Number of adaptive rounds can not be negative, and the pilot fraction must be within (0, 1).')
+    if options.pilot_selection and (options.opt_scheme not in ('FIX', 'CON') or options.adaptive_rounds > 0):
+        raise ValueError('The pilot selection applies to the optimization schemes sharing the pipelines across runs '
+                         '(--os FIX or CON), and can not be combined with --adaptive_rounds.')
+    if pipeline_search.num_rounds(options) > 0 and (options.analysis == 'None' or
+                                                     options.use_prev_processing_for_QC):
+        raise ValueError('The search on pilot runs compares the pipelines on the metrics of an analysis model - '
+                         'specify one with -a (it can not be combined with --use_prev_processing_for_QC).')
+
+    hpc['submit_threads'] = options.submit_threads
+    hpc['submit_rate'] = options.submit_rate
+    hpc['max_queued'] = options.max_queued
+
+    # resources are estimated for each job, unless the user specified how much memory all jobs need
+    setattr(options, 'auto_resources', options.memory is None and not options.run_locally)
+    if options.memory is None:
+        setattr(options, 'memory', default_memory_gb)
+
     # on HPC inputs and obtaining the cfg of hpc
     hpc['type'] = options.hpc_type
     if options.run_locally is False:
@@ -591,9 +889,18 @@ def parse_args_check():
 
         hpc['type'] = find_hpc_type(options.hpc_type, options.run_locally)
         hpc['spec'], hpc['header'], hpc['prefix'] = get_hpc_spec(hpc['type'], options)
+        if options.array_jobs and not executors.EXECUTORS[get_hpc_family(hpc['type'])].task_dependencies:
+            warnings.warn('{} can not make the tasks of an array job wait just for their counterparts in another - '
+                          'each array job waits for all the tasks of the previous step.'.format(hpc['type']))
     else:
         if not hpc['type'] in (None, 'LOCAL'):
             raise ValueError('Conflicting options specified: specify either of --run_locally or --cluster CLUSTERTYPE.')
+        if options.array_jobs:
+            warnings.warn('--array_jobs is meant for clusters - ignoring it, as the jobs are run locally.')
+            setattr(options, 'array_jobs', False)
+        if options.subjects_per_job > 1:
+            warnings.warn('--subjects_per_job is meant for clusters - ignoring it, as the jobs are run locally.')
+            setattr(options, 'subjects_per_job', 1)
 
     if hpc['type'] in (None, 'LOCAL'):
         if options.run_locally == False:
@@ -607,7 +914,7 @@ def parse_args_check():
             # which will be executed in a subshell
             hpc['type'] = 'SGE'
     else:
-        print "Submitting jobs to Sun Grid Engine (SGE)"
+        print "Submitting jobs to the {} scheduler".format(get_hpc_family(hpc['type']))
 
     if options.dry_run:
         hpc['dry_run'] = True
@@ -641,20 +948,104 @@ def parse_args_check():
     setattr(options, 'vasc_mask_requested', vasc_mask_requested)
     setattr(options, 'custom_mask_requested', custom_mask_requested)
 
+    # each combination of the models and contrasts requested is analysed in its own processing folder,
+    #   the runs being preprocessed once, by the first analysis of those that can share it
+    analyses = list()
+    preproc_sources = dict()
+    for analysis, contrast in expand_analyses(options):
+        analysis_options = copy(options)
+        analysis_options.analysis = analysis
+        analysis_options.contrast_list_str = contrast
+
+        sharing_key = get_preproc_sharing_key(analysis_options)
+        setattr(analysis_options, 'preproc_source', preproc_sources.get(sharing_key))
+        analyses.append(setup_analysis(analysis_options))
+        if sharing_key is not None:
+            preproc_sources.setdefault(sharing_key, analysis_options.suffix)
+
+    return analyses
+
+
+def expand_analyses(options):
+    """
+    Combinations of the analysis models and contrasts requested (each a comma-separated list), in the order given.
+
+    :returns: list of (analysis model, contrast)
+    """
+
+    models = list(OrderedDict.fromkeys(model.strip() for model in options.analysis.split(',') if model.strip()))
+    contrasts = list(OrderedDict.fromkeys(con.strip() for con in options.contrast_list_str.split(',') if con.strip()))
+    if len(models) < 1:
+        models = ['None']
+    if len(contrasts) < 1:
+        contrasts = ['None']
+
+    for model in models:
+        if model not in cfg_pronto.CODES_ANALYSIS_MODELS:
+            raise ValueError('Invalid analysis model: {}. Choose from {}'.format(
+                model, ','.join(cfg_pronto.CODES_ANALYSIS_MODELS)))
+    if 'None' in models and (len(models) > 1 or len(contrasts) > 1):
+        raise ValueError('Without an analysis model (preprocessing only), neither several models '
+                         'nor several contrasts can be analysed.')
+
+    analyses = [(model, contrast) for model in models for contrast in contrasts]
+    if len(analyses) > 1:
+        print('{} analyses requested: {}'.format(len(analyses), ', '.join(
+            '{} ({})'.format(model, contrast) for model, contrast in analyses)))
+
+    return analyses
+
+
+def get_preproc_sharing_key(options):
+    """
+    Analyses with the same key have the same preprocessing, which can be shared among them (None if it can't be).
+        The adaptive smoothing (--BlurToFWHM) regresses out the design, so it depends on the contrast.
+    """
+
+    # with --dospnormfirst the preprocessing is normalized in place, and the workers can not wait on
+    #   the tasks of another processing folder
+    if options.dospnormfirst or options.use_prev_processing_for_QC or options.num_workers > 0:
+        return None
+    # the search on pilot runs keeps the pipelines performing best in each analysis
+    if pipeline_search.num_rounds(options) > 0:
+        return None
+
+    if options.BlurToFWHM == '1':
+        return options.contrast_list_str
+
+    return ''
+
+
+def setup_analysis(options):
+    """
+    Sets up the processing folder of a single analysis (model and contrast) and validates the input file for it.
+
+    :returns: unique subjects, options, the new input file, the processing folder, the time stamp and the output folder.
+    """
+
     cur_garage, time_stamp, proc_out_dir, suffix = organize_output_folders(options)
     setattr(options, 'out_dir_common', cur_garage)
     setattr(options, 'suffix', suffix)
 
+    if options.ledger_path is None:
+        setattr(options, 'ledger_path', os.path.join(cur_garage, file_name_runtime_ledger))
+
+    # the preprocessing is spatially normalized in place with --dospnormfirst, so it can not be shared
+    if options.no_preproc_cache or options.dospnormfirst or options.use_prev_processing_for_QC:
+        setattr(options, 'preproc_cache', None)
+    elif options.preproc_cache is None:
+        setattr(options, 'preproc_cache', os.path.join(proc_out_dir, dir_name_preproc_cache))
+    else:
+        setattr(options, 'preproc_cache', os.path.abspath(options.preproc_cache))
+
     if options.dospnormfirst and not options.reference_specified:
         raise ValueError('Spatial normalization requested, but a reference atlas is not specified.')
 
-    # assert a single contrast to ensure QC doesnt fail either
+    # a single contrast per analysis ensures QC doesnt fail either
     options.contrast_list_str = options.contrast_list_str.strip()
     assert '-' in options.contrast_list_str, "Minus not found in the contrast string. Syntax: conditionA-conditionB"
     cond_names_in_contrast = options.contrast_list_str.split('-')
 
-    assert ',' not in options.contrast_list_str, "Multiple contrasts are specified with a comma! Only 1 contrast is allowed for now."
-
     # ensuring the validity of input file, given the options and pipeline file
     # and compiling a list of unique subjects into a new file with output folder modified
     new_input_file = os.path.join(cur_garage, 'input_file.txt')
@@ -683,6 +1074,25 @@ def parse_args_check():
         print "  OPPNI will only generate the preprocessed data"
         options.contrast_list_str = "None"
 
+    if options.preproc_source is not None:
+        print('The runs are preprocessed in {} and shared with this analysis.'.format(options.preproc_source))
+
+    # the pipeline file of the whole dataset is written by the last round of the search on pilot runs
+    num_rounds = pipeline_search.num_rounds(options)
+    if num_rounds > 0:
+        search_dir = os.path.join(cur_garage, pipeline_search.dir_name_search)
+        if not os.path.exists(search_dir):
+            os.makedirs(search_dir)
+        setattr(options, 'full_pipeline_file', os.path.abspath(options.pipeline_file))
+        options.pipeline_file = pipeline_search.round_pipeline_file(cur_garage, num_rounds)
+        sizes = pipeline_search.round_sizes(len(unique_subjects), num_rounds, options.pilot_fraction)
+        if options.pilot_selection:
+            print('The {} pipeline is selected on {} of the {} runs.'.format(
+                options.opt_scheme, sizes[0], len(unique_subjects)))
+        else:
+            print('Adaptive search over the pipeline combinations in {} rounds, on {} of the {} runs.'.format(
+                num_rounds, ', '.join(map(str, sizes)), len(unique_subjects)))
+
     if hasattr(options, 'DEOBLIQUE') and (options.DEOBLIQUE == 1 or options.DEOBLIQUE is True):
         options.DEOBLIQUE = "1"
     else:
@@ -746,7 +1156,11 @@ def parse_args_check():
     ## -------------- END checking the parameters --------------
 
 
-    os.environ["PIPELINE_NUMBER_OF_CORES"] = str(options.numcores)
+    if options.run_locally:
+        # the cores are shared out among the jobs running concurrently, each of them single-threaded
+        os.environ["PIPELINE_NUMBER_OF_CORES"] = "1"
+    else:
+        os.environ["PIPELINE_NUMBER_OF_CORES"] = str(options.numcores)
     os.environ["FSLOUTPUTTYPE"] = "NIFTI"
 
     print("Chosen options: ")
@@ -775,7 +1189,7 @@ def organize_output_folders(options):
         cur_garage = proc_out_dir
         suffix = ''
     else:
-        # TODO need a way to pass the suffix to matlab core so it can reuse preprocessing for multiple analysis models and contrasts.
+        # the preprocessing is reused across analysis models and contrasts through the cache (see preproc_cache.py)
         suffix = os.path.splitext(os.path.basename(options.input_data_orig))[0]
         if options.analysis is not "None":
             suffix = suffix + '_' + options.analysis
@@ -809,17 +1223,17 @@ def find_hpc_type(user_supplied_type=None, run_locally=False):
     """Helper to determine (in a hacky way) the type of HPC environment is running on. """
 
     if user_supplied_type is None and run_locally is False:
-        if find_executable('qsub') is None:
-            raise SystemError('Requested processing on SGE, but command qsub is not found!')
+        if find_executable('qsub') is None and find_executable('sbatch') is None:
+            raise SystemError('Requested processing on a cluster, but neither qsub nor sbatch is found!')
 
         sge_root = os.getenv("SGE_ROOT")
         if sge_root is not None and find_executable('qconf') is not None:
             h_type = 'SGE'
-        elif find_executable('qmgr') is not None and \
-                (find_executable('qconf') is None and find_executable('sbatch') is None):
-            h_type = 'TORQUE'
         elif find_executable('sbatch') is not None and find_executable('srun') is not None:
+            # SLURM clusters may provide a qsub wrapper as well
             h_type = 'SLURM'
+        elif find_executable('qmgr') is not None and find_executable('qconf') is None:
+            h_type = 'TORQUE'
         else:
             raise ValueError('Can not determine the type of cluster you are one.\n Please specify it with --cluster')
     else:
@@ -828,6 +1242,50 @@ def find_hpc_type(user_supplied_type=None, run_locally=False):
     return h_type
 
 
+def get_hpc_family(h_type):
+    """Returns the type of scheduler (SGE, TORQUE, PBS or SLURM) run by a given cluster."""
+
+    h_type = h_type.upper()
+    if h_type in cfg_pronto.HPC_TYPES_SGE:
+        return 'SGE'
+    elif h_type in cfg_pronto.HPC_TYPES_TORQUE:
+        return 'TORQUE'
+    elif h_type in cfg_pronto.HPC_TYPES_PBS:
+        return 'PBS'
+    elif h_type in cfg_pronto.HPC_TYPES_SLURM:
+        return 'SLURM'
+    elif h_type in cfg_pronto.HPC_TYPES_MOCK:
+        return 'MOCK'
+    else:
+        raise ValueError('HPC type {} unrecognized or not implemented.'.format(h_type))
+
+
+def get_executor():
+    """Backend running the jobs as per the current hpc config, made once per config (see executors.py)."""
+    global executor
+
+    if hpc['type'].upper() == 'LOCAL':
+        hpc_family = 'LOCAL'
+    else:
+        hpc_family = get_hpc_family(hpc['type'])
+
+    if executor is None or executor.hpc is not hpc or not isinstance(executor, executors.EXECUTORS[hpc_family]):
+        executor = executors.make_executor(hpc_family, hpc)
+
+    return executor
+
+
+def get_submitter():
+    """Paces the submissions to the backend as per the hpc config, made once per backend (see submission.py)."""
+    global submitter
+
+    if submitter is None or submitter.executor is not get_executor():
+        submitter = submission.Submitter(get_executor(), hpc.get('submit_threads', 1), hpc.get('submit_rate', 0),
+                                         hpc.get('max_queued', 0))
+
+    return submitter
+
+
 def set_defaults_hpc(options, input_memory, input_queue, input_numcores, input_parallel_env):
     """Assigns known defaults to HPC parameters"""
 
@@ -858,8 +1316,7 @@ def set_defaults_hpc(options, input_memory, input_queue, input_numcores, input_p
 
 
 def get_hpc_spec(h_type=None, options=None):
-    """Helper to provide the HPC directives for different HPC environments, such as SGE and Torque.
-    SLURM is not fully supported yet."""
+    """Helper to provide the HPC directives for different HPC environments, such as SGE, Torque and SLURM."""
 
     if h_type is None:
         h_type = find_hpc_type().upper()
@@ -867,7 +1324,7 @@ def get_hpc_spec(h_type=None, options=None):
     # assigning defaults to make it easy for the end user
     # TODO need to tease out the lists of names for different HPC environments into cfg_oppni.py
     if options is not None:
-        if h_type in ('ROTMAN', 'ROTMAN-SGE', 'SGE'):
+        if h_type in ('ROTMAN', 'ROTMAN-SGE', 'SGE', 'MOCK'):
             memory, queue, numcores, parallel_env = set_defaults_hpc(options, 2, 'all.q', 1, 'npairs')
         elif h_type in ('CAC', 'HPCVL', 'QUEENSU'):
             memory, queue, numcores, parallel_env = set_defaults_hpc(options, 2, 'abaqus.q', 1, 'shm.pe')
@@ -876,9 +1333,9 @@ def get_hpc_spec(h_type=None, options=None):
         elif h_type in ('SCINET', 'PBS', 'TORQUE'):
             warnings.warn('HPC {} has not been tested fully. Use at your own risk!'.format(h_type))
             memory, queue, numcores, parallel_env = set_defaults_hpc(options, 2, 'batch', 1, '')
-        elif h_type in ('SLURM'):
-            warnings.warn('HPC {} has not been tested fully. Use at your own risk!'.format(h_type))
-            memory, queue, numcores, parallel_env = set_defaults_hpc(options, 2, '', 1, '')
+        elif h_type in cfg_pronto.HPC_TYPES_SLURM:
+            # jobs go to the default partition, unless specified
+            memory, queue, numcores, parallel_env = set_defaults_hpc(options, 2, None, 1, '')
     else:
         memory = '2'
         numcores = 1
@@ -887,7 +1344,7 @@ def get_hpc_spec(h_type=None, options=None):
 
     spec = {'memory': None, 'numcores': None, 'queue': None}
 
-    if h_type in ('ROTMAN', 'ROTMAN-SGE', 'SGE'):
+    if h_type in ('ROTMAN', 'ROTMAN-SGE', 'SGE', 'MOCK'):
         prefix = '#$'
         spec['memory'] = ('-l mf=', memory + 'G')
         spec['numcores'] = ('-pe {} '.format(parallel_env), numcores)
@@ -907,21 +1364,21 @@ def get_hpc_spec(h_type=None, options=None):
         spec['memory'] = ('-l mem=', memory)
         spec['numcores'] = ('-l ppn=', numcores)
         spec['queue'] = ('-q ', queue)
-    elif h_type in ('SLURM'):
+    elif h_type in cfg_pronto.HPC_TYPES_SLURM:
         prefix = '#SBATCH'
-        spec['memory'] = ('--mem=', memory)
-        spec['numcores'] = ('--n ', numcores)
-        spec['queue'] = ('-p ', queue)
+        # in MB, unless a unit is given
+        spec['memory'] = ('--mem=', memory + 'G')
+        spec['numcores'] = ('--cpus-per-task=', numcores)
+        spec['queue'] = ('--partition=', queue)
     else:
         raise ValueError('HPC type {} unrecognized or not implemented.'.format(h_type))
 
     header = list()
-    header.append('{0} -V'.format(prefix))
-    header.append('{0} -b y'.format(prefix))
-    header.append('{0} -j y'.format(prefix))
+    for directive in cfg_pronto.HPC_COMMON_DIRECTIVES[executors.EXECUTORS[get_hpc_family(h_type)].syntax]:
+        header.append('{0} {1}'.format(prefix, directive))
     for key, val in spec.items():
         # avoiding unnecessary specifications
-        if (key == 'numcores' and int(numcores) == 1) or (key == 'queue' and queue is None):
+        if (key == 'numcores' and int(numcores) == 1) or (key == 'queue' and queue in (None, '')):
             continue
         else:
             header.append('{0} {1}{2}'.format(prefix, val[0], val[1]))
@@ -958,8 +1415,17 @@ def update_status_and_exit(out_dir):
 
     assert os.path.exists(out_dir), "Processing folder to traverse doesn't exist or not readable!"
 
-    # print('Queue status update requested ... ')
-    # update_Q_status(out_dir)
+    report_queue_status(out_dir)
+    report_local_job_failures(out_dir)
+    report_failed_tasks(out_dir)
+
+    with open(os.path.join(out_dir, file_name_prev_options), 'rb') as of:
+        prev_options = pickle.load(of)[1]
+    if not pipeline_search.report_progress(out_dir, prev_options):
+        print('The search on the pilot runs is incomplete, and the outputs of all the runs can only be checked once '
+              'it is done. Once its jobs have left the queue, rerun the same command to resume it.')
+        sys.exit(0)
+
     print('\nNow checking the outputs on disk ...')
     try:
         prev_proc_status, prev_options, prev_input_file_all, \
@@ -997,103 +1463,86 @@ def update_proc_status(out_dir):
 
     with open(opt_file, 'rb') as of:
         all_subjects, options, new_input_file, _ = pickle.load(of)
-        proc_status, failed_sub_file, failed_spnorm_file = check_proc_status.run(
-            [new_input_file, options.pipeline_file, '--skip_validation'])
+        # subjects were saved as dicts by older versions
+        for sub_key, subject in all_subjects.items():
+            if isinstance(subject, dict):
+                all_subjects[sub_key] = RunRecord.from_dict(subject)
+        status_args = [new_input_file, options.pipeline_file, '--skip_validation',
+                       '--sentinel_dir', os.path.join(out_dir, 'job_files', dir_name_sentinels),
+                       '--status_index', os.path.join(out_dir, file_name_status_index)]
+        # the runs the pipelines were selected on are reported apart
+        pilot_runs_file = pipeline_search.pilot_runs_file(out_dir, options)
+        if pilot_runs_file is not None:
+            status_args.extend(['--pilot_runs', pilot_runs_file])
+        proc_status, failed_sub_file, failed_spnorm_file = check_proc_status.run(status_args)
     return proc_status, options, new_input_file, failed_sub_file, failed_spnorm_file, all_subjects
 
 
-# def update_Q_status(out_dir):
-#     """Helper to track the status of the submitted jobs on the queue."""
-#     if find_executable('qstat') is None:
-#         print('\t qstat is not found - perhaps you are not on a headnode for the cluster. \n'
-#               '\t Unable to query queue statuses. Run it on headnode to get the complete report.')
-#         return
-#
-#     scheduler = drmaa.Session()
-#     scheduler.initialize()
-#
-#     job_id_file = os.path.join(out_dir, file_name_job_ids_by_group)
-#     try:
-#         with open(job_id_file, 'rb') as jobs_list:
-#             jobs_list_grouped = json.load(jobs_list)
-#
-#             for step, id_dict in jobs_list_grouped.items():
-#                 print('  --> {}'.format(step))
-#                 num_jobs_rqh, num_jobs_err = q_status(scheduler, id_dict)
-#
-#     except IOError as ioe:
-#         print('Trouble reading the job IDs saved from last session. Check queue status manually. \n {}'.format(ioe))
-#
-#     # exiting the session
-#     scheduler.exit()
-#
-#
-# def q_status(scheduler, job_ids):
-#     """
-#      Display the status of each job, and count the number of jobs in error/Okay state
-#
-#     :param scheduler: drmma scheduler object
-#     :param job_ids: dict of job IDs to track
-#     :return: number of jobs running or in queue, and failed.
-#
-#     """
-#
-#     # decode_status = {drmaa.JobState.UNDETERMINED: 'status cannot be determined',
-#     #                  drmaa.JobState.QUEUED_ACTIVE: 'queued and active',
-#     #                  drmaa.JobState.SYSTEM_ON_HOLD: 'queued and in system hold',
-#     #                  drmaa.JobState.USER_ON_HOLD: 'queued and in user hold',
-#     #                  drmaa.JobState.USER_SYSTEM_ON_HOLD: 'queued and in user and system hold',
-#     #                  drmaa.JobState.RUNNING: 'running',
-#     #                  drmaa.JobState.SYSTEM_SUSPENDED: 'suspended by system',
-#     #                  drmaa.JobState.USER_SUSPENDED: 'suspended by user',
-#     #                  drmaa.JobState.DONE: 'finished normally',
-#     #                  drmaa.JobState.FAILED: 'finished, but failed'}
-#
-#     num_jobs_rqh = 0  # num. jobs running or in queue
-#     num_jobs_err = 0  # num. jobs in error state
-#
-#     for prefix, job_id in job_ids.items():
-#         try:
-#             job_state = scheduler.jobStatus(str(job_id))
-#         except drmaa.InvalidJobException:
-#             # when jobid has been flushed out of the scheduler memory!
-#             job_state = drmaa.JobState.UNDETERMINED
-#         else:
-#             print "error quering the job status"
-#             raise
-#
-#         print('\t {}: {} '.format(prefix, job_state))
-#
-#         # if job_state != 'unknown':
-#         #     if 'e' in job_state:
-#         #         num_jobs_err += 1
-#         #
-#         #     if 'r' in job_state or 'q' in job_state:
-#         #         num_jobs_rqh += 1
-#
-#     # if num_jobs_rqh > 0:
-#     #     print(' {} jobs are still either running, held or waiting to be processing.'.format(num_jobs_rqh))
-#     #
-#     # if num_jobs_err > 0:
-#     #     print('{} jobs are stuck in error state. Manage them manually'.format(num_jobs_err))
-#
-#     return num_jobs_rqh, num_jobs_err
-
-def make_job_file_and_1linecmd(file_path):
-    """Generic job file generator, and returns one line version too."""
-
-    hpc_directives = list()
+def report_queue_status(out_dir):
+    """Reports the state of the jobs submitted in the last session, per step, with a single query of the scheduler."""
+
+    hpc_cfg_file = os.path.join(out_dir, file_name_hpc_config)
+    job_id_file = os.path.join(out_dir, file_name_job_ids_by_group)
+    opt_file = os.path.join(out_dir, file_name_prev_options)
+    if not all(os.path.isfile(fp) for fp in (hpc_cfg_file, job_id_file, opt_file)):
+        return
+
+    with open(opt_file, 'rb') as of:
+        options = pickle.load(of)[1]
+    with open(hpc_cfg_file, 'r') as hpc_f:
+        prev_hpc = json.load(hpc_f)
+    if options.run_locally or prev_hpc.get('dry_run'):
+        # no scheduler to ask
+        return
+
+    with open(job_id_file, 'r') as jobs_list:
+        job_ids_grouped = json.load(jobs_list)
+    job_ids = set(str(jid) for id_dict in job_ids_grouped.values() for jid in id_dict.values())
+    if len(job_ids) < 1:
+        return
+
+    hpc_family = get_hpc_family(prev_hpc['type'])
+    prev_executor = executors.make_executor(hpc_family, prev_hpc)
+    prev_executor.load_state(out_dir)
+    states = prev_executor.status(job_ids)
+    if states is None:
+        print('\nUnable to query the {} scheduler - perhaps you are not on a head node of the cluster.\n'
+              'Run it on a head node to get the state of the jobs in the queue.'.format(hpc_family))
+        return
+
+    print('\nJobs of the last submission, as per the {} scheduler:'.format(hpc_family))
+    for step, counts in queue_status.summarize_by_step(job_ids_grouped, states).items():
+        print('\t{:>6} : {}'.format(step, ', '.join('{} {}'.format(count, state) for state, count in counts.items())))
+
+    stuck = queue_status.jobs_in_error(job_ids_grouped, states)
+    if len(stuck) > 0:
+        print('\n{} jobs are stuck in error state, holding back all the jobs depending on them:'.format(len(stuck)))
+        for step, job_id, prefixes in stuck:
+            print('\t{:>6} : job {} ({})'.format(step, job_id, ', '.join(prefixes)))
+        stuck_ids = ' '.join(sorted(set(job_id for step, job_id, prefixes in stuck)))
+        if hpc_family == 'SGE':
+            print('Clear their error state with "qmod -cj {0}" once the cause is fixed (see "qstat -j <job id>"), '
+                  'or delete them with "qdel {0}" and resubmit.'.format(stuck_ids))
+        elif hpc_family in cfg_pronto.SCHEDULER_COMMANDS:
+            print('Cancel them with "{0} {1}" and resubmit.'.format(
+                cfg_pronto.SCHEDULER_COMMANDS[hpc_family]['cancel'], stuck_ids))
+
+
+def make_job_file_and_1linecmd(file_path, script=False, resources=None):
+    """
+    Generic job file generator, and returns one line version too.
+        Job files submitted as such (script=True), rather than as a one line command, begin with the shell to use.
+        The memory and walltime estimated for the job (see estimate_resources), if any, replace the memory
+        requested for all the jobs.
+    """
+
     job_name = os.path.splitext(os.path.basename(file_path))[0]
-    if not hpc['type'].upper() == "LOCAL":
-        # hpc_directives.append('{0} -S '.format(hpc['shell']))
-        hpc_directives.extend(hpc['header'])
-        hpc_directives.append('{0} -N {1}'.format(hpc['prefix'], job_name))
-        hpc_directives.append('{0} -wd {1}'.format(hpc['prefix'], os.path.dirname(file_path)))
-    else:
-        # for jobs to run locally, no hpc directives are needed.
-        hpc_directives.append('{0} -S '.format(hpc['shell']))
+    # for jobs to run locally, no hpc directives are needed, just the shell to run them in.
+    hpc_directives = get_executor().prepare(job_name, os.path.dirname(file_path), resources)
 
     with open(file_path, 'w') as jID:
+        if script and not hpc['type'].upper() == "LOCAL":
+            jID.write(hpc['shell'] + '\n')
         # one directive per line
         jID.write('\n'.join(hpc_directives))
 
@@ -1103,21 +1552,97 @@ def make_job_file_and_1linecmd(file_path):
     return hpc_directives
 
 
+def count_pipelines(opt):
+    """Number of pipeline combinations processed for each run, as per the pipeline file."""
+
+    num_pipelines = 1
+    for choices in (getattr(opt, 'pipeline_steps', None) or dict()).values():
+        num_pipelines *= max(1, len(choices))
+
+    return num_pipelines
+
+
+def estimate_resources(opt, step_id, runs):
+    """
+    Estimates the memory and walltime needed by a job of a step processing the given runs,
+        from the dimensions in their NIfTI headers and the number of pipelines (see cfg_front.RESOURCE_MODELS).
+        Once the runtime ledger holds enough jobs of the step, they are predicted from the usage of those jobs
+        instead, at the quantile given by --resource_quantile.
+
+    :returns: dict with memory_gb and walltime_hours, or None when the resources requested for all jobs apply
+        (--memory specified, jobs run locally, unknown step or headers not read)
+    """
+
+    model = cfg_pronto.RESOURCE_MODELS.get(step_id.upper())
+    if not getattr(opt, 'auto_resources', False) or model is None:
+        return None
+
+    headers = [getattr(run, 'header', None) for run in runs]
+    if None in headers:
+        return None
+
+    voxels, elements = runtime_ledger.run_features(headers)
+    num_pipelines = count_pipelines(opt)
+    memory_gb, walltime_hours = runtime_ledger.model_usage(model, voxels, elements, num_pipelines)
+    memory_gb, walltime_hours = model.safety * memory_gb, model.safety * walltime_hours
+
+    predictor = runtime_ledger.load_predictor(hpc.get('ledger_path'), getattr(opt, 'resource_quantile', 0.95))
+    predicted_memory, predicted_walltime = predictor.predict(step_id, voxels, elements, num_pipelines)
+    if predicted_memory is not None:
+        memory_gb = cfg_pronto.RESOURCE_LEDGER_MARGIN * predicted_memory
+    if predicted_walltime is not None:
+        walltime_hours = cfg_pronto.RESOURCE_LEDGER_MARGIN * predicted_walltime
+
+    return {'memory_gb': max(cfg_pronto.RESOURCE_MIN_MEMORY_GB, int(math.ceil(memory_gb))),
+            'walltime_hours': max(cfg_pronto.RESOURCE_MIN_WALLTIME_HOURS, int(math.ceil(walltime_hours)))}
+
+
+def get_job_profile(opt, step_id, runs):
+    """Size of a job processing the given runs, to record in the runtime ledger (None if any header was not read)."""
+
+    headers = [getattr(run, 'header', None) for run in runs]
+    if len(headers) < 1 or None in headers:
+        return None
+
+    return runtime_ledger.job_profile(step_id, headers, count_pipelines(opt))
+
+
+def combine_resources(resources_list, concurrent=1):
+    """
+    Resources of a job processing several invocations, up to concurrent of them at a time.
+        None if the resources of any of them are not known.
+    """
+
+    if len(resources_list) < 1 or None in resources_list:
+        return None
+
+    concurrent = max(1, min(concurrent, len(resources_list)))
+    memory_gb = max(res['memory_gb'] for res in resources_list) * concurrent
+    # even when the longest one starts last
+    longest = max(res['walltime_hours'] for res in resources_list)
+    total = sum(res['walltime_hours'] for res in resources_list)
+    walltime_hours = int(math.ceil(total / float(concurrent) + longest * (1 - 1.0 / concurrent)))
+
+    return {'memory_gb': memory_gb, 'walltime_hours': walltime_hours}
+
+
+def largest_resources(resources_list):
+    """Resources enough for any of the invocations, for jobs running one of them each (e.g. array tasks)."""
+
+    if len(resources_list) < 1 or None in resources_list:
+        return None
+
+    return {'memory_gb': max(res['memory_gb'] for res in resources_list),
+            'walltime_hours': max(res['walltime_hours'] for res in resources_list)}
+
+
 def make_job_file(file_path):
     """Generic job file generator"""
 
-    hpc_directives = list()
     job_name = os.path.splitext(os.path.basename(file_path))[0]
-    if not hpc['type'].upper() == "LOCAL":
-        if hpc.get('spec') is None:
-            hpc['spec'], hpc['header'], hpc['prefix'] = get_hpc_spec(hpc['type'])
-
-        hpc_directives.extend(hpc['header'])
-        hpc_directives.append('{0} -N {1}'.format(hpc['prefix'], job_name))
-        hpc_directives.append('{0} -wd {1}'.format(hpc['prefix'], os.path.dirname(file_path)))
-    else:
-        # for jobs to run locally, no directives are needed.
-        hpc_directives.append('{0} -S '.format(hpc['shell']))
+    if not hpc['type'].upper() == "LOCAL" and hpc.get('spec') is None:
+        hpc['spec'], hpc['header'], hpc['prefix'] = get_hpc_spec(hpc['type'])
+    hpc_directives = get_executor().prepare(job_name, os.path.dirname(file_path))
 
     with open(file_path, 'w') as jID:
         jID.write('\n'.join(hpc_directives))
@@ -1126,27 +1651,103 @@ def make_job_file(file_path):
     os.chmod(file_path, st.st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
 
 
-def local_exec(script_path):
+def local_exec(script_path, print_to_screen=False):
     """
-    Runs a job script locally using subprocess, optionally returning stdout
+    Runs a job script locally using subprocess, streaming its output line by line to a rotating log file
+        (logs/<job name>.log in the job folder), and optionally to screen also, tagged with the job name.
+        The exit code and wall time are recorded in logs/<job name>.exit.json. Returns the exit code.
     """
 
-    # logger = logging.getLogger(script_path + '.log')
+    job_name = os.path.splitext(os.path.basename(script_path))[0]
+    log_dir = os.path.join(os.path.dirname(script_path), dir_name_local_logs)
+    if not os.path.exists(log_dir):
+        try:
+            os.mkdir(log_dir)
+        except OSError:
+            # another job may have created it in the mean time
+            if not os.path.isdir(log_dir):
+                raise
+
+    # not registering with the logging module, to avoid holding on to one logger for each job
+    logger = logging.Logger(job_name)
+    log_handler = RotatingFileHandler(os.path.join(log_dir, job_name + '.log'), maxBytes=local_log_max_bytes,
+                                      backupCount=local_log_backup_count)
+    logger.addHandler(log_handler)
 
     # make it executable
     st = os.stat(script_path)
     os.chmod(script_path, st.st_mode | stat.S_IXGRP)
 
-    proc = subprocess.Popen(script_path, shell=True, stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    time_start = time.time()
+    try:
+        proc = subprocess.Popen(script_path, shell=True, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        proc.stdin.close()
+
+        # never holding more than a line of output in memory
+        for line in iter(proc.stdout.readline, ''):
+            line = line.rstrip('\n')
+            logger.info(line)
+            if print_to_screen:
+                with print_lock:
+                    print('[{}] {}'.format(job_name, line))
+        proc.stdout.close()
+        ret_code = proc.wait()
+    finally:
+        log_handler.close()
+
+    exit_record = {'job': job_name,
+                   'exit_code': ret_code,
+                   'wall_time_sec': round(time.time() - time_start, 3),
+                   'finished': strftime('%Y-%m-%d %H:%M:%S', localtime()),
+                   'host': socket.gethostname()}
+    with open(os.path.join(log_dir, job_name + '.exit.json'), 'w') as exf:
+        json.dump(exit_record, exf, indent=2)
+
+    # the exit code decides whether the jobs depending on this one can run
+    return ret_code
+
+
+def report_local_job_failures(garage):
+    """Reports the jobs run locally or within bundles (as recorded in their logs) that did not finish successfully."""
+
+    log_dir = os.path.join(garage, 'job_files', dir_name_local_logs)
+    if not os.path.isdir(log_dir):
+        return
+
+    failed = list()
+    for exit_file in sorted(os.listdir(log_dir)):
+        if exit_file.endswith('.exit.json'):
+            with open(os.path.join(log_dir, exit_file)) as exf:
+                exit_record = json.load(exf)
+            if exit_record['exit_code'] != 0:
+                failed.append(exit_record)
+
+    if len(failed) > 0:
+        print('\n{} of the jobs exited with an error: '.format(len(failed)))
+        for exit_record in failed:
+            print('\t {job} : exit code {exit_code} after {wall_time_sec} sec on {host}'.format(**exit_record))
+        print('\t their output is saved in {}'.format(log_dir))
+
+
+def run_local_jobs(num_procs, print_to_screen=False):
+    """
+    Runs all the jobs added to the local graph, each as soon as its own dependencies are done,
+        keeping num_procs jobs running at all times. Returns True only if all the jobs succeeded.
+    """
+    local_backend = get_executor()
+    if len(local_backend.jobs) < 1:
+        return True
+
+    print('Running {} jobs locally on {} cores ..'.format(len(local_backend.jobs), num_procs))
+    exit_codes = local_backend.run(num_procs, partial(local_exec, print_to_screen=print_to_screen))
 
-    # communicate waits for the subprocess to finish
-    std_output, _ = proc.communicate()
-    # # print outputs and logs
-    # logger.info('\n%s\n', std_output)
-    print std_output
+    num_failed = len([code for code in exit_codes.values() if code not in [0, None]])
+    num_skipped = len([code for code in exit_codes.values() if code is None])
+    print('{} jobs finished: {} failed and {} skipped due to failed dependencies.'.format(len(exit_codes),
+                                                                                          num_failed, num_skipped))
 
-    return -random.randrange(1000)  # proc.returncode
+    return num_failed == 0 and num_skipped == 0
 
 
 def reprocess_failed_subjects(prev_proc_status, prev_options, failed_sub_file, failed_spnorm_file,
@@ -1163,12 +1764,20 @@ def reprocess_failed_subjects(prev_proc_status, prev_options, failed_sub_file, f
         raise
 
     hpc['dry_run'] = False
+    # the backend keeps numbering the jobs from where the previous session left (a simulated cluster, at least)
+    get_executor().load_state(garage)
+    if prev_options.run_locally:
+        # the local jobs of the previous session have all finished, and their ids are numbered afresh in this one
+        hpc['job_ids_grouped'] = dict()
 
     if prev_proc_status.preprocessing is NOT_DONE:
         failed_sub_p1 = validate_input_file(failed_sub_file, prev_options, None)
+        # only the pipeline combinations missing for each subject need to be preprocessed again
+        afni_pipelines = make_reduced_pipeline_files(prev_options.pipeline_file, failed_sub_file, failed_sub_p1,
+                                                     garage)
         # running the failed subjects throught part 1
         print('Resubmitting preprocessing jobs .. ')
-        status_p1, jobs_p1 = run_preprocessing(failed_sub_p1, prev_options, failed_sub_file, garage)
+        status_p1, jobs_p1 = run_preprocessing(failed_sub_p1, prev_options, failed_sub_file, garage, afni_pipelines)
 
     if prev_proc_status.optimization is NOT_DONE:
         # but optimization will be done entire dataset
@@ -1191,6 +1800,14 @@ def reprocess_failed_subjects(prev_proc_status, prev_options, failed_sub_file, f
         print('Resubmitting jobs for QC 2 .. ')
         status_qc2, jobs_qc2 = run_qc_part_two(all_subjects, prev_options, prev_input_file_all, garage)
 
+    if getattr(prev_options, 'num_workers', 0) > 0:
+        start_workers(prev_options, garage)
+
+    if prev_options.run_locally and not run_local_jobs(int(prev_options.numcores),
+                                                       getattr(prev_options, 'tail_logs', False)):
+        print('Some of the jobs resubmitted failed again.')
+
+    get_executor().save_state(garage)
     # saving the job ids to facilitate a status update in future
     job_id_file = os.path.join(garage, file_name_job_ids_by_group)
     if os.path.isfile(job_id_file):
@@ -1199,11 +1816,133 @@ def reprocess_failed_subjects(prev_proc_status, prev_options, failed_sub_file, f
         json.dump(hpc['job_ids_grouped'], jlist)
 
 
-def run_preprocessing(subjects, opt, input_file, garage):
+def make_reduced_pipeline_files(pipeline_file, failed_sub_file, subjects, garage):
+    """
+    Writes a pipeline file for each subject to resubmit, limiting its AFNI steps to the pipeline combinations
+        found missing or stale when checking the status. Stale files are removed, to be regenerated.
+
+    :returns: dict of subject prefix -> path to its reduced pipeline file,
+        only for the subjects with some (but not all) of the combinations to redo.
+    """
+
+    pipelines_file = check_proc_status.resubmit_pipelines_file(failed_sub_file)
+    if not os.path.isfile(pipelines_file):
+        return dict()
+    with open(pipelines_file, 'r') as pipes:
+        pipelines_to_redo = json.load(pipes)
+
+    with open(pipeline_file, 'r') as pip_f:
+        pipeline_spec = pip_f.read()
+    num_codes = len(check_proc_status.afni_pipeline_codes(pipeline_file))
+    step_flags = cfg_pronto.CODES_PREPROCESSING_STEPS[0:5]
+
+    input_dir = os.path.join(garage, 'input_files')
+    if not os.path.exists(input_dir):
+        os.mkdir(input_dir)
+
+    afni_pipelines = dict()
+    for sub_key, subject in subjects.items():
+        sub_prefix = strip_nifti_ext(subject.prefix)
+        to_redo = pipelines_to_redo.get(sub_prefix)
+        if to_redo is None:
+            continue
+
+        afni_dir = os.path.join(subject.out, 'intermediate_processed', 'afni_processed')
+        for code in to_redo['stale']:
+            stale_path = os.path.join(afni_dir, '{}_{}.nii'.format(sub_prefix, code))
+            print('removing the incomplete {}'.format(stale_path))
+            os.remove(stale_path)
+
+        codes = to_redo['missing'] + to_redo['stale']
+        if len(codes) < 1 or len(codes) >= num_codes:
+            continue
+
+        # the choices of each step among the combinations to redo - the AFNI steps skip those already done
+        reduced_spec = pipeline_spec
+        for ix, flag in enumerate(step_flags):
+            choices = sorted(set([int(re.findall(r'\d+', code)[ix]) for code in codes]))
+            reduced_spec = re.sub(flag + r'=\[[\d,]+\]', '{}=[{}]'.format(flag, ','.join(map(str, choices))),
+                                  reduced_spec)
+
+        reduced_file = os.path.join(input_dir, 'part1_{}.afni_pipelines.txt'.format(sub_prefix))
+        with open(reduced_file, 'w') as rpf:
+            rpf.write(reduced_spec)
+        afni_pipelines[sub_key] = reduced_file
+        print('{}: {} of {} pipeline combinations to redo.'.format(sub_prefix, len(codes), num_codes))
+
+    return afni_pipelines
+
+
+def make_shard_pipeline_files(pipeline_file, num_shards, garage, job_tag=''):
+    """
+    Splits the pipeline combinations into (at most) num_shards subsets of about the same size, each written
+        as a pipeline file. The choices of the steps are split in their order, as long as the subsets can be:
+        all the choices of a step, or contiguous groups of them in the last step split.
+
+    :returns: list of the paths to the pipeline files of the shards, empty if the combinations can not be split.
+    """
+
+    # the few combinations selected on pilot runs are not worth splitting, and might leave some shards without any
+    if check_proc_status.selected_pipelines(pipeline_file) is not None:
+        return list()
+
+    with open(pipeline_file, 'r') as pip_f:
+        pipeline_spec = pip_f.read()
+
+    # the groups of choices of each step split
+    step_groups = list()
+    num_groups = 1
+    for flag in cfg_pronto.CODES_PREPROCESSING_STEPS:
+        choices = check_proc_status.pipeline_step_choices(pipeline_file, flag)
+        if num_groups * len(choices) <= num_shards:
+            step_groups.append((flag, [[choice] for choice in choices]))
+            num_groups *= len(choices)
+        else:
+            num_chunks = num_shards // num_groups
+            if num_chunks > 1:
+                step_groups.append((flag, [choices[ix * len(choices) // num_chunks:(ix + 1) * len(choices) // num_chunks]
+                                           for ix in range(num_chunks)]))
+                num_groups *= num_chunks
+            break
+
+    if num_groups < 2:
+        return list()
+
+    input_dir = os.path.join(garage, 'input_files')
+    if not os.path.exists(input_dir):
+        os.mkdir(input_dir)
+
+    shard_files = list()
+    for ix, groups in enumerate(itertools.product(*[groups for flag, groups in step_groups]), 1):
+        shard_spec = pipeline_spec
+        for (flag, _), choices in zip(step_groups, groups):
+            shard_spec = re.sub(flag + r'=\[[\d,]+\]', '{}=[{}]'.format(flag, ','.join(map(str, choices))),
+                                shard_spec)
+
+        shard_file = os.path.join(input_dir, 'part1{}_shard{}of{}.pipeline.txt'.format(job_tag, ix, num_groups))
+        with open(shard_file, 'w') as spf:
+            spf.write(shard_spec)
+        shard_files.append(shard_file)
+
+    return shard_files
+
+
+def run_preprocessing(subjects, opt, input_file, garage, afni_pipelines=None, pipeline_file=None,
+                      depends_on_step=None, job_tag='', prologue=None):
     """
     Generates a job script to run the preprocessing for all combinations of pipeline steps requested.
+
+    :param afni_pipelines: reduced pipeline files limiting the AFNI steps of some subjects (see
+        make_reduced_pipeline_files), when resubmitting.
+    :param pipeline_file: combinations to process instead of those of opt.pipeline_file
+        (a round of the search on pilot runs), which may only be written by the jobs it depends on.
+    :param depends_on_step: step(s) to wait for, writing the pipeline file.
+    :param prologue: shell command run by each job before the step (see process_module_generic).
     """
 
+    if pipeline_file is None:
+        pipeline_file = opt.pipeline_file
+
     if opt.dospnormfirst:
         str_dospnormfirst = '1'
     else:
@@ -1211,13 +1950,151 @@ def run_preprocessing(subjects, opt, input_file, garage):
 
     # matlab: Pipeline_PART1(InputStruct, input_pipeset, analysis_model, modelparam, niiout, contrast_list_str, dospnormfirst, DEOBLIQUE, TPATTERN, TOFWHM)
     # input file will be prepended in the process module
-    arg_list = [opt.pipeline_file, opt.analysis, opt.model_param_list_str, opt.output_nii_also,
+    arg_list = [pipeline_file, opt.analysis, opt.model_param_list_str, opt.output_nii_also,
                 opt.contrast_list_str, str_dospnormfirst, opt.DEOBLIQUE, opt.TPATTERN, opt.BlurToFWHM]
-    proc_status, job_id_list = process_module_generic(subjects, opt, 'PART1', 'Pipeline_PART1', arg_list, garage, None)
+    # the AFNI steps are skipped for the runs whose preprocessing is cached
+    #   (known only once the pipeline file is written, in the search on pilot runs)
+    if getattr(opt, 'preproc_cache', None) is not None and not hpc['dry_run'] and os.path.isfile(pipeline_file):
+        preproc_cache.reuse_cached_runs(subjects, opt, opt.preproc_cache,
+                                        check_proc_status.afni_pipeline_codes(pipeline_file))
+
+    # the runs preprocessed by another analysis are linked in by each job, once the preprocessing is done,
+    #   in addition to waiting for the steps writing the pipeline file (in the search on pilot runs)
+    if getattr(opt, 'preproc_source', None) is not None:
+        share_prologue = preproc_cache.share_cmd(opt.preproc_source, pipeline_file)
+        if prologue is None:
+            prologue = share_prologue
+        else:
+            prologue = '{} ; {}'.format(share_prologue, prologue)
+        if depends_on_step is None:
+            depends_on_step = step_shared_preproc
+        elif isinstance(depends_on_step, list):
+            depends_on_step = depends_on_step + [step_shared_preproc]
+        else:
+            depends_on_step = [depends_on_step, step_shared_preproc]
+
+    if getattr(opt, 'part1_shards', 1) > 1:
+        if os.path.isfile(pipeline_file):
+            return run_preprocessing_shards(subjects, opt, arg_list, garage, depends_on_step, job_tag, prologue)
+        print('\tthe combinations are only known once {} is written - Part 1 is not split into shards.'.format(
+            os.path.basename(pipeline_file)))
+
+    # the reduced pipeline file, if any, is appended as afni_pipeset
+    extra_args = dict((sub_key, [afni_file]) for sub_key, afni_file in (afni_pipelines or dict()).items())
+    proc_status, job_id_list = process_module_generic(subjects, opt, 'PART1', 'Pipeline_PART1', arg_list, garage,
+                                                      depends_on_step, job_tag, extra_args=extra_args,
+                                                      prologue=prologue)
 
     return proc_status, job_id_list
 
 
+def run_preprocessing_shards(subjects, opt, arg_list, garage, depends_on_step, job_tag='', prologue=None):
+    """
+    Submits Part 1 of each subject split into shards (see --part1_shards): a job running the AFNI steps for all
+        the combinations (BASE), then one job per shard computing the metrics of its subset of the combinations
+        (SHARD1, SHARD2...), and a last job merging their outputs (MERGE), which the later steps wait for as PART1.
+        The AFNI steps are not split, as their intermediate volumes are shared by the combinations.
+
+    :param arg_list: args of Pipeline_PART1 (see run_preprocessing), the pipeline file first.
+    :returns: status of the merge and its job IDs, as run_preprocessing.
+    """
+
+    pipeline_file = arg_list[0]
+    shard_files = make_shard_pipeline_files(pipeline_file, opt.part1_shards, garage, job_tag)
+    if len(shard_files) < 2:
+        print('\ta single pipeline combination - Part 1 is not split into shards.')
+        return process_module_generic(subjects, opt, 'PART1', 'Pipeline_PART1', arg_list, garage,
+                                      depends_on_step, job_tag, prologue=prologue)
+    num_shards = len(shard_files)
+    print('\tPart 1 of each subject split into {} shards.'.format(num_shards))
+
+    # matlab: Pipeline_PART1(..., TOFWHM, afni_pipeset, shard)
+    status, job_ids = process_module_generic(subjects, opt, 'BASE', 'Pipeline_PART1',
+                                             arg_list + [pipeline_file, 'base'], garage, depends_on_step,
+                                             job_tag, prologue=prologue)
+
+    shard_steps = list()
+    for ix, shard_file in enumerate(shard_files, 1):
+        shard_arg_list = [shard_file] + arg_list[1:] + [shard_file, 'shard{}of{}'.format(ix, num_shards)]
+        status_shard, job_ids = process_module_generic(subjects, opt, 'SHARD{}'.format(ix), 'Pipeline_PART1',
+                                                       shard_arg_list, garage, 'BASE', job_tag)
+        status = status and status_shard
+        shard_steps.append('SHARD{}'.format(ix))
+
+    # matlab: merge_part1_shards(InputStruct, input_pipeset, num_shards, niiout)
+    status_merge, job_ids = process_module_generic(subjects, opt, 'MERGE', 'merge_part1_shards',
+                                                   [pipeline_file, num_shards, opt.output_nii_also], garage,
+                                                   shard_steps, job_tag)
+
+    # the later steps wait for the merge
+    hpc['job_ids_grouped']['PART1'] = job_ids
+    if 'MERGE' in hpc.get('array_tasks', {}):
+        hpc['array_tasks']['PART1'] = hpc['array_tasks']['MERGE']
+    else:
+        hpc.get('array_tasks', {}).pop('PART1', None)
+
+    return status and status_merge, job_ids
+
+
+def run_pipeline_search(subjects, opt, garage):
+    """
+    Submits the rounds of the search over the pipeline combinations on pilot runs not done yet
+        (see pipeline_search.py), each preprocessing its new pilot runs with the combinations left by the previous
+        round, and pruning them (PRUNE), or selecting the FIX and CON pipelines (SELECT), on the metrics of all the
+        pilot runs so far. The preprocessing of the pilot runs is grouped as PILOT, and the preprocessing
+        of all the runs must wait for the last PRUNE or SELECT.
+
+    :returns: whether all the rounds submitted were successful (when running locally)
+    """
+
+    order = pipeline_search.pilot_order(subjects)
+    sizes = pipeline_search.round_sizes(len(order), pipeline_search.num_rounds(opt), opt.pilot_fraction)
+    step_id, step_cmd_matlab = pipeline_search.search_step(opt)
+
+    status = True
+    prev_size = 0
+    prev_pipeline_file = opt.full_pipeline_file
+    # the jobs concluding each round are kept, as the ids of a step are replaced on each submission
+    job_ids_search = OrderedDict()
+    for round_num, size in enumerate(sizes, 1):
+        round_pipeline_file = pipeline_search.round_pipeline_file(garage, round_num)
+        if os.path.isfile(round_pipeline_file):
+            print('\tround {}: done already.'.format(round_num))
+        else:
+            new_pilots = OrderedDict((key, subjects[key]) for key in order[prev_size:size])
+            all_pilots = OrderedDict((key, subjects[key]) for key in order[0:size])
+            print('\tround {}: {} new pilot runs, {} in all.'.format(round_num, len(new_pilots), len(all_pilots)))
+
+            if len(new_pilots) > 0:
+                status_pilot, job_ids_pilot = run_preprocessing(new_pilots, opt, None, garage,
+                                                                pipeline_file=prev_pipeline_file,
+                                                                depends_on_step=step_id,
+                                                                job_tag='r{}'.format(round_num))
+                hpc['job_ids_grouped'].setdefault('PILOT', dict()).update(job_ids_pilot)
+                status = status and status_pilot is not False
+
+            pilot_input_file = pipeline_search.round_input_file(garage, round_num)
+            with open(pilot_input_file, 'w') as pif:
+                pif.writelines(subject.line.rstrip('\n') + '\n' for subject in all_pilots.values())
+
+            # matlab: prune_pipelines(InputStruct, input_pipeset, output_pipeset, optimize_metric)
+            arg_list = [pilot_input_file, prev_pipeline_file, round_pipeline_file, opt.metric]
+            if step_id == 'SELECT':
+                # matlab: select_pipelines(InputStruct, input_pipeset, output_pipeset, optimize_metric,
+                #                          mot_gs_control, whichpipes)
+                arg_list += [get_mot_gs_control(opt), opt.opt_scheme]
+            status_round, job_ids_round = process_module_generic(all_pilots, opt, step_id, step_cmd_matlab, arg_list,
+                                                                 garage, ['PART1', step_id], str(round_num))
+            job_ids_search.update(('round{}'.format(round_num), job_id) for job_id in job_ids_round.values())
+            hpc['job_ids_grouped'][step_id] = job_ids_search
+            status = status and status_round is not False
+
+        prev_size = size
+        prev_pipeline_file = round_pipeline_file
+
+    return status
+
+
 def run_qc_part_one(subjects, opt, input_file, garage):
     # maskname is set to be empty
     arg_list = [1, input_file, 'None', opt.num_PCs]
@@ -1237,18 +2114,9 @@ def run_qc_part_two(subjects, opt, input_file, garage):
     return proc_status, job_id_list
 
 
-def run_optimization(subjects, opt, input_file, garage):
-    """
-    Generates a job script to run the optimization on the existing processing.
-    """
-
-    job_id_list = None
+def get_mot_gs_control(opt):
+    """Control of the motion artifact and the white matter bias in the optimization, as Pipeline_PART2 expects."""
 
-    # ideal:
-    # arg_list = [ input_file, opt.metric, opt.ctrl_motion_artifact, opt.ctrl_wm_bias,
-    #               opt.output_all_pipelines, opt.keepmean ]
-
-    # current
     if opt.ctrl_motion_artifact == 'yes':
         mc_str = '1'
     else:
@@ -1257,13 +2125,38 @@ def run_optimization(subjects, opt, input_file, garage):
         wm_str = '1'
     else:
         wm_str = '0'
-    mot_gs_control = mc_str + wm_str
 
-    arg_list = [input_file, opt.metric, mot_gs_control, opt.output_all_pipelines, opt.keepmean, opt.opt_scheme]
-    proc_status, job_id_list = process_module_generic(subjects, opt, 'PART2', 'Pipeline_PART2', arg_list, garage,
-                                                      'PART1')
+    return mc_str + wm_str
 
-    return proc_status, job_id_list
+
+def run_optimization(subjects, opt, input_file, garage):
+    """
+    Generates the job scripts to run the optimization on the existing processing, split into a job selecting the
+        optimal pipelines on the stats of all the subjects (PART2SEL), a job per subject producing its outputs with
+        those pipelines (PART2SUB), and a last job gathering them in the summary (PART2), which the later steps wait for.
+    """
+
+    job_id_list = None
+
+    # ideal:
+    # arg_list = [ input_file, opt.metric, opt.ctrl_motion_artifact, opt.ctrl_wm_bias,
+    #               opt.output_all_pipelines, opt.keepmean ]
+
+    # current
+    arg_list = [input_file, opt.metric, get_mot_gs_control(opt), opt.output_all_pipelines, opt.keepmean,
+                opt.opt_scheme]
+    # the pipelines selected for the dataset, which the per-subject jobs can not locate from their own subject
+    selection_file = check_proc_status.expected_outputs('PART2SEL', None, subjects.values()[0].out)[0]
+    # matlab: Pipeline_PART2(..., whichpipes, stage, selection_file)
+    status_sel, job_id_list = process_module_generic(subjects, opt, 'PART2SEL', 'Pipeline_PART2',
+                                                     arg_list + ['SELECT', selection_file], garage, 'PART1')
+    # the input file of each subject will be prepended in the process module
+    status_sub, job_id_list = process_module_generic(subjects, opt, 'PART2SUB', 'Pipeline_PART2',
+                                                     arg_list[1:] + ['SUBJECT', selection_file], garage, 'PART2SEL')
+    proc_status, job_id_list = process_module_generic(subjects, opt, 'PART2', 'Pipeline_PART2',
+                                                      arg_list + ['SUMMARY', selection_file], garage, 'PART2SUB')
+
+    return status_sel and status_sub and proc_status, job_id_list
 
 
 def process_spatial_norm(subjects, opt, input_file, sp_norm_step, garage):
@@ -1273,14 +2166,35 @@ def process_spatial_norm(subjects, opt, input_file, sp_norm_step, garage):
     :returns: status of processing and a list of job IDs (or process IDs if running locally).
     """
 
-    if opt.dospnormfirst:
+    if sp_norm_step == 1:
+        # step 1 (--dospnormfirst) needs only the preprocessing of the same subject
         dependencies = ['PART1']
     else:
+        # the optimized outputs are normalized otherwise
         dependencies = ['PART1', 'PART2']
 
+    if sp_norm_step == 2:
+        # step 2 picks up from where step 1 of the same subject left off
+        dependencies.append('SPNORM')
+
+    if sp_norm_step == 0:
+        job_tag = ''
+    else:
+        job_tag = str(sp_norm_step)
+
+    # the jobs of step 1 remain in the same group as those of step 2, to be followed and cancelled alike
+    step1_job_ids = hpc['job_ids_grouped'].get('SPNORM', dict()) if sp_norm_step == 2 else dict()
+
     arg_list = [opt.reference, opt.voxelsize, sp_norm_step, opt.DEOBLIQUE]
-    proc_status, job_id_list = process_module_generic(subjects, opt, 'SPNORM', 'spatial_normalization', arg_list,
-                                                      garage, dependencies)
+    try:
+        proc_status, job_id_list = process_module_generic(subjects, opt, 'SPNORM', 'spatial_normalization', arg_list,
+                                                          garage, dependencies, job_tag)
+    finally:
+        if len(step1_job_ids) > 0:
+            # keyed apart from the subjects, so the later steps still wait for step 2 of the same subject
+            job_ids_spnorm = OrderedDict(('{}_step1'.format(key), job_id) for key, job_id in step1_job_ids.items())
+            job_ids_spnorm.update(hpc['job_ids_grouped'].get('SPNORM', dict()))
+            hpc['job_ids_grouped']['SPNORM'] = job_ids_spnorm
 
     return proc_status, job_id_list
 
@@ -1297,8 +2211,11 @@ def construct_full_cmd(environment, step_id, step_cmd_matlab, arg_list, prefix=N
     """Helper to construct the necessary complete commands for various parts of the OPPNI processing."""
     if environment.lower() in ('matlab', 'octave'):
         single_quoted = lambda s: r"'{}'".format(s)
+        # in array jobs, the input file (and the args) of each task are only known at run time
+        matlab_arg = lambda s: "getenv('{}')".format(reArrayArg.match(s).group(1)) if reArrayArg.match(str(s)) \
+            else single_quoted(s)
 
-        cmd_options = ', '.join(map(single_quoted, arg_list))
+        cmd_options = ', '.join(map(matlab_arg, arg_list))
 
         # make an m-file script
         # hyphen/dash can be treated as an operator
@@ -1349,10 +2266,14 @@ def construct_full_cmd(environment, step_id, step_cmd_matlab, arg_list, prefix=N
     return full_cmd
 
 
-def process_module_generic(subjects, opt, step_id, step_cmd_matlab, arg_list, garage, depends_on_step):
+def process_module_generic(subjects, opt, step_id, step_cmd_matlab, arg_list, garage, depends_on_step,
+                           job_tag='', extra_args=None, prologue=None):
     """
     Generates a job script (per subject, or per dataset) to register all the MRI's of given subjects to a reference.
     :param step_id: identifier of the step being processed such as SPNORM, PREPROCESS, OPTIM
+    :param job_tag: distinguishes the job files of a step submitted more than once in a session (e.g. SPNORM)
+    :param extra_args: args appended for some of the subjects only (dict of subject key -> list of args).
+    :param prologue: shell command run by each per-subject job before the step, with {0} in place of its input file.
     :returns: status of processing and a list of job IDs (or process IDs if running locally).
     """
     global hpc
@@ -1364,71 +2285,504 @@ def process_module_generic(subjects, opt, step_id, step_cmd_matlab, arg_list, ga
     if not os.path.exists(job_dir):
         os.mkdir(job_dir)
 
-    jobs_dict = {}
-    if step_id.upper() in ['QC1', 'PART2', 'QC2', 'GMASK']:
+    step_label = step_id.lower() + job_tag
+
+    # each item will be a tuple (prefix, arg_list_subset, outputs)
+    invocations = OrderedDict()
+    # memory and walltime estimated for each invocation, if any, and its size to record in the runtime ledger
+    resources = dict()
+    profiles = dict()
+    if step_id.upper() in cfg_pronto.CODES_DATASET_LEVEL_STEPS:
         # these steps operate on the dataset as a whole
         # input list supplied from their individual functions
         arg_list_subset = copy(arg_list)
-        prefix = '{0}_all_subjects'.format(step_id.lower())
-        # each item will be a tuple (job_path, job_str)
-        jobs_dict['all_subjects'] = make_single_job(opt.environment, step_id, step_cmd_matlab, prefix, arg_list_subset,
-                                                    job_dir)
+        prefix = '{0}_all_subjects'.format(step_label)
+        # results of the dataset are saved in the output folder of the first subject
+        outputs = check_proc_status.expected_outputs(step_id, None, subjects.values()[0].out)
+        invocations['all_subjects'] = (prefix, arg_list_subset, outputs)
+        resources['all_subjects'] = estimate_resources(opt, step_id, subjects.values())
+        profiles['all_subjects'] = get_job_profile(opt, step_id, subjects.values())
+
+    elif getattr(opt, 'array_jobs', False):
+        # a single job for all the subjects, each task picking its own line from the manifest of input lines
+        # all the tasks request the resources of the largest one
+        task_resources = largest_resources([estimate_resources(opt, step_id, [subject])
+                                            for subject in subjects.values()])
+        task_profiles = [get_job_profile(opt, step_id, [subject]) for subject in subjects.values()]
+        job_path, qsub_opt = make_array_job(opt.environment, step_id, step_cmd_matlab, step_label, subjects, arg_list,
+                                            input_dir, job_dir, task_resources, task_profiles, prologue, extra_args)
+        jobs_status, job_id_list = submit_array_job(job_path, qsub_opt, subjects, depends_on_step)
+        hpc['job_ids_grouped'][step_id] = job_id_list
+        # the order of tasks allows the next array job to depend on them task by task
+        hpc.setdefault('array_tasks', {})[step_id] = job_id_list.keys()
+
+        return jobs_status, job_id_list
 
     else:
-        for idx, subject in enumerate(subjects.itervalues()):
+        if extra_args is None:
+            extra_args = dict()
+        for idx, (sub_key, subject) in enumerate(subjects.iteritems()):
             # subject-wise processing
             # TODO input file doesnt change with step, try refactoring this to have only one input file per run/subject
-            prefix = '{1}_s{0:0>3}_{2}'.format(idx + 1, step_id.lower(), subject['prefix'])
+            prefix = '{1}_s{0:0>3}_{2}'.format(idx + 1, step_label, subject.prefix)
             subset_input_file = os.path.join(input_dir, prefix + '.input.txt')
             with open(subset_input_file, 'w') as sif:
-                sif.write(subject['line'])
+                sif.write(subject.line)
 
             # adding the input file as the first arg
-            arg_list_subset = [subset_input_file] + arg_list
-            # each item will be a tuple (job_path, job_str)
-            jobs_dict[subject['prefix']] = make_single_job(opt.environment, step_id, step_cmd_matlab, prefix,
-                                                           arg_list_subset, job_dir)
+            arg_list_subset = [subset_input_file] + arg_list + extra_args.get(sub_key, list())
+            outputs = check_proc_status.expected_outputs(step_id, strip_nifti_ext(subject.prefix), subject.out)
+            invocations[subject.prefix] = (prefix, arg_list_subset, outputs)
+            resources[subject.prefix] = estimate_resources(opt, step_id, [subject])
+            profiles[subject.prefix] = get_job_profile(opt, step_id, [subject])
+
+    known_resources = [res for res in resources.values() if res is not None]
+    if len(known_resources) > 0 and not getattr(opt, 'num_workers', 0) > 0:
+        print('\tresources estimated per invocation: {}-{} GB, {}-{} hours'.format(
+            min(res['memory_gb'] for res in known_resources), max(res['memory_gb'] for res in known_resources),
+            min(res['walltime_hours'] for res in known_resources),
+            max(res['walltime_hours'] for res in known_resources)))
 
-    jobs_status, job_id_list = run_jobs(jobs_dict, opt.run_locally, int(opt.numcores), depends_on_step)
+    try:
+        if getattr(opt, 'num_workers', 0) > 0:
+            # invocations are only queued here, to be run by the workers started at the end of submission
+            jobs_status, job_id_list = enqueue_tasks(invocations, step_cmd_matlab, garage, depends_on_step)
+        elif getattr(opt, 'subjects_per_job', 1) > 1 and 'all_subjects' not in invocations:
+            jobs_status, job_id_list = submit_bundled_jobs(opt, step_id, step_cmd_matlab, step_label, invocations,
+                                                           job_dir, depends_on_step, resources, profiles, prologue)
+        else:
+            jobs_dict = {}
+            for key, (prefix, arg_list_subset, outputs) in invocations.items():
+                # each item will be a tuple (job_path, job_str)
+                jobs_dict[key] = make_single_job(opt.environment, step_id, step_cmd_matlab, prefix, arg_list_subset,
+                                                 job_dir, outputs, resources.get(key), profiles.get(key), prologue)
+            jobs_status, job_id_list = run_jobs(jobs_dict, opt.run_locally, int(opt.numcores), depends_on_step)
+    except submission.SubmissionError as err:
+        # the jobs submitted before the failure are kept, to be saved for a status update
+        hpc['job_ids_grouped'][step_id] = err.job_ids
+        raise
     # storing the job ids by group to facilitate a status update in future
     hpc['job_ids_grouped'][step_id] = job_id_list
+    hpc.get('array_tasks', {}).pop(step_id, None)
 
     return jobs_status, job_id_list
 
 
-def make_single_job(environment, step_id, step_cmd_matlab, prefix, arg_list_subset, job_dir):
+def get_work_queue_dir(garage):
+    """Returns the folder of the work queue pulled by the workers, creating it if necessary."""
+
+    queue_dir = os.path.join(garage, dir_name_work_queue)
+    for state in work_queue_states:
+        state_dir = os.path.join(queue_dir, state)
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+
+    return queue_dir
+
+
+def enqueue_tasks(invocations, step_cmd_matlab, garage, depends_on_step):
+    """
+    Adds each invocation of a step as a task to the work queue, to be run by the persistent workers.
+        A task lists the tasks it depends on in its first line, the function to run in the second,
+        followed by one argument per line (see oppni_worker.m).
+
+    :returns: status of queuing and a dict of task names keyed like the job IDs.
+    """
+
+    queue_dir = get_work_queue_dir(garage)
+
+    job_id_list = OrderedDict()
+    for key, (prefix, arg_list_subset, outputs) in invocations.items():
+        task_file = prefix + '.task'
+        # the outcome of any previous run of the same task is no longer valid
+        for state in work_queue_states:
+            old_task = os.path.join(queue_dir, state, task_file)
+            if os.path.exists(old_task):
+                os.remove(old_task)
+        for old_record in (os.path.join(queue_dir, 'failed', prefix + '.error'),
+                           os.path.join(get_sentinel_dir(os.path.join(garage, 'job_files')), prefix + '.json')):
+            if os.path.exists(old_record):
+                os.remove(old_record)
+
+        depends_on = get_dependency_ids(depends_on_step, key)
+        task_lines = [' '.join(map(str, depends_on)), step_cmd_matlab] + map(str, arg_list_subset)
+
+        # writing it under a different name first, so the workers never pick up a partial task
+        task_path = os.path.join(queue_dir, 'pending', task_file)
+        with open(task_path + '.tmp', 'w') as tf:
+            tf.write('\n'.join(task_lines))
+            tf.write('\n')
+        os.rename(task_path + '.tmp', task_path)
+
+        job_id_list[key] = prefix
+
+    print('\t{} tasks added to the work queue.\n'.format(len(invocations)))
+
+    return True, job_id_list
+
+
+def start_workers(opt, garage):
+    """Submits (or adds to the local jobs) the persistent workers to run the tasks queued."""
+
+    queue_dir = get_work_queue_dir(garage)
+    num_queued = len(glob.glob(os.path.join(queue_dir, 'pending', '*.task')))
+    if num_queued < 1:
+        return True, dict()
+
+    job_dir = os.path.join(garage, 'job_files')
+    # more workers than tasks would have nothing to do
+    num_workers = min(opt.num_workers, num_queued)
+    print('starting {} workers for the {} tasks queued:'.format(num_workers, num_queued))
+
+    jobs_dict = OrderedDict()
+    for idx in range(num_workers):
+        prefix = 'worker_{0:0>3}'.format(idx + 1)
+        jobs_dict[prefix] = make_single_job(opt.environment, 'WORKER', 'oppni_worker', prefix,
+                                            [queue_dir, worker_max_idle_sec, get_sentinel_dir(job_dir)], job_dir)
+
+    # tasks wait for their own dependencies within the workers, so the workers themselves need not wait
+    jobs_status, job_id_list = run_jobs(jobs_dict, opt.run_locally, int(opt.numcores), None)
+    hpc['job_ids_grouped']['WORKERS'] = job_id_list
+
+    return jobs_status, job_id_list
+
+
+def report_failed_tasks(garage):
+    """Lists the tasks in the work queue that failed, along with their error messages."""
+
+    failed_tasks = sorted(glob.glob(os.path.join(garage, dir_name_work_queue, 'failed', '*.task')))
+    if len(failed_tasks) < 1:
+        return
+
+    print('\n{} tasks in the work queue failed:'.format(len(failed_tasks)))
+    for task_path in failed_tasks:
+        error_path = os.path.splitext(task_path)[0] + '.error'
+        if os.path.isfile(error_path):
+            with open(error_path, 'r') as ef:
+                message = ef.read().strip()
+        else:
+            message = 'unknown error'
+        print('\t{} : {}'.format(os.path.basename(task_path), message))
+
+
+def make_single_job(environment, step_id, step_cmd_matlab, prefix, arg_list_subset, job_dir, outputs=None,
+                    resources=None, profile=None, prologue=None):
     """
     Helper to generate a standalone job file including the HPC directives and processing commands.
+        The job records its completion in a sentinel, including the sizes of the outputs given,
+        and its usage in the runtime ledger, if its profile (size) is given.
+        It requests the memory and walltime in resources (see estimate_resources), if given.
+        The prologue, if given, is run first, with the input file (the first arg) in place of {0}.
     """
     full_cmd = construct_full_cmd(environment, step_id, step_cmd_matlab, arg_list_subset, prefix, job_dir)
 
+    # the exit status of a previous run of the same job is no longer valid
+    sentinel_dir = get_sentinel_dir(job_dir)
+    for prev_record in (os.path.join(job_dir, dir_name_local_logs, prefix + '.exit.json'),
+                        os.path.join(sentinel_dir, prefix + '.json')):
+        if os.path.isfile(prev_record):
+            os.remove(prev_record)
+
     out_job_filename = prefix + '.job'
     job_path = os.path.join(job_dir, out_job_filename)
     # create header with resource specs
-    hpc_dir_1 = make_job_file_and_1linecmd(job_path)
+    hpc_dir_1 = make_job_file_and_1linecmd(job_path, script=True, resources=resources)
+
+    # remove any single quotes
+    if environment.lower() in ('matlab', 'octave'):
+        full_cmd = full_cmd.replace(r"'", '')
 
     # add the commands and its arguments
     hpc_dir_2 = list()
     hpc_dir_2.append('')  # to get the newline concat working
-    # hpc_directives.append('cd {0} '.format(job_dir))
-    hpc_dir_2.append(r"{0}".format(full_cmd))
+    hpc_dir_2.append('sentinel_job={0}'.format(prefix))
+    hpc_dir_2.append('sentinel_outputs="{0}"'.format(' '.join(outputs or [])))
+    hpc_dir_2.append('job_profile={0}'.format(profile or '-'))
+    if prologue is not None:
+        hpc_dir_2.append(prologue.format(arg_list_subset[0]))
+    hpc_dir_2.extend(sentinel_cmds(r"{0}".format(full_cmd), sentinel_dir))
+    hpc_dir_2.append('exit ${exit_code}')
 
     with open(job_path, 'a') as jID:
-        # remove any single quotes
-        if environment.lower() in ('matlab', 'octave'):
-            quote_del = [strg.replace(r"'", '') for strg in hpc_dir_2]
+        jID.write('\n'.join(hpc_dir_2))
+        jID.write('\n')
+
+    # the job file is submitted as such, as recording the sentinel needs the shell
+    qsub_opt = hpc_dir_1 + [job_path]
+    # ensuring unnecessary prefix #$ #PBS is removed
+    qsub_opt = [strg.replace(hpc['prefix'], '') for strg in qsub_opt]
+
+    return job_path, qsub_opt
+
+
+def get_sentinel_dir(job_dir):
+    """Returns the folder of the completion sentinels written by the jobs, creating it if necessary."""
+
+    sentinel_dir = os.path.join(job_dir, dir_name_sentinels)
+    if not os.path.exists(sentinel_dir):
+        os.mkdir(sentinel_dir)
+
+    return sentinel_dir
+
+
+def sentinel_cmds(full_cmd, sentinel_dir):
+    """
+    Shell commands running the command of a job, whose name and outputs are in $sentinel_job and $sentinel_outputs,
+        and recording its completion in the sentinel <job name>.json: exit code, wall time, peak RSS
+        (in KB, when GNU time is available), host and sizes of the outputs. Sentinels are replaced atomically,
+        and one without an exit code is written at the start, so a job killed midway leaves that behind.
+        Jobs whose size is in $job_profile (see runtime_ledger.job_profile) also append their usage, with CPU time,
+        to the runtime ledger in a single write.
+    """
+
+    sentinel = '{0}/${{sentinel_job}}.json'.format(sentinel_dir)
+    record_format = ('{"job": "%s", "exit_code": %s, "wall_time_sec": %s, "peak_rss_kb": %s, "finished": "%s", '
+                     '"host": "%s", "output_sizes": {%s}}\\n')
+
+    cmds = list()
+    cmds.append('write_sentinel() {')
+    cmds.append('    output_sizes=""')
+    cmds.append('    for output in ${sentinel_outputs}; do')
+    cmds.append('        output_sizes="${output_sizes}\\"${output}\\": $(stat -c %s ${output} 2> /dev/null || echo null), "')
+    cmds.append('    done')
+    cmds.append("    printf '{0}' ${{sentinel_job}} $1 $2 $3 \"$(date '+%Y-%m-%d %H:%M:%S')\" $(hostname) "
+                "\"${{output_sizes%, }}\" > {1}.tmp".format(record_format, sentinel))
+    cmds.append('    mv -f {0}.tmp {0}'.format(sentinel))
+    cmds.append('}')
+    cmds.append('write_sentinel null null null')
+    cmds.append('time_start=$(date +%s)')
+    cmds.append('if /usr/bin/time -f %M -o /dev/null true 2> /dev/null; then')
+    cmds.append('    time_cmd="/usr/bin/time -f %M,%U,%S -o {0}.usage"'.format(sentinel))
+    cmds.append('fi')
+    cmds.append('${time_cmd} ' + full_cmd)
+    cmds.append('exit_code=$?')
+    cmds.append('wall_time_sec=$(( $(date +%s) - time_start ))')
+    # the last line, as GNU time precedes it with the exit status of commands failing
+    cmds.append('IFS=, read peak_rss_kb cpu_user_sec cpu_sys_sec <<< "$(tail -n 1 {0}.usage 2> /dev/null)"'.format(sentinel))
+    cmds.append('case "${peak_rss_kb}" in ""|*[!0-9]*) peak_rss_kb=null;; esac')
+    cmds.append('cpu_time_sec=$(awk -v u="${cpu_user_sec}" -v s="${cpu_sys_sec}" '
+                '\'BEGIN { if (u ~ /^[0-9.]+$/ && s ~ /^[0-9.]+$/) print u + s; else print "null" }\')')
+    cmds.append('rm -f {0}.usage'.format(sentinel))
+    cmds.append('write_sentinel ${exit_code} ${wall_time_sec} ${peak_rss_kb}')
+
+    ledger_path = hpc.get('ledger_path')
+    if ledger_path is not None:
+        ledger_format = ('{"job": "%s", "step": "%s", "voxels": %s, "elements": %s, "pipelines": %s, '
+                         '"exit_code": %s, "wall_time_sec": %s, "cpu_time_sec": %s, "peak_rss_kb": %s, '
+                         '"finished": "%s", "host": "%s"}\\n')
+        cmds.append('if [ "${job_profile:--}" != "-" ]; then')
+        cmds.append('    IFS=, read ledger_step ledger_voxels ledger_elements ledger_pipelines <<< "${job_profile}"')
+        cmds.append("    printf '{0}' ${{sentinel_job}} ${{ledger_step}} ${{ledger_voxels}} ${{ledger_elements}} "
+                    "${{ledger_pipelines}} ${{exit_code}} ${{wall_time_sec}} ${{cpu_time_sec}} ${{peak_rss_kb}} "
+                    "\"$(date '+%Y-%m-%d %H:%M:%S')\" $(hostname) >> {1}".format(ledger_format, ledger_path))
+        cmds.append('fi')
+
+    return cmds
+
+
+def make_bundled_job(bundle_prefix, members, job_dir, concurrent_subjects=1, resources=None):
+    """
+    Helper to generate a job file running the jobs of several subjects (made by make_single_job) within it,
+        one after another or up to concurrent_subjects at a time. The exit status of each member is recorded
+        in logs/<member job>.exit.json (just like the jobs run locally), so only the failed ones are resubmitted.
+        The job fails if any of its members fail. It requests the memory and walltime in resources, if given.
+    """
+
+    status_dir = os.path.join(job_dir, dir_name_local_logs)
+    if not os.path.exists(status_dir):
+        os.mkdir(status_dir)
+
+    job_path = os.path.join(job_dir, bundle_prefix + '.job')
+    hpc_dir_1 = make_job_file_and_1linecmd(job_path, script=True, resources=resources)
+
+    bundle_cmds = list()
+    bundle_cmds.append('')  # to get the newline concat working
+    bundle_cmds.append('cd {0}'.format(job_dir))
+    bundle_cmds.append('run_member() {')
+    bundle_cmds.append('    time_start=$(date +%s)')
+    bundle_cmds.append('    bash $1.job > {0}/$1.log 2>&1'.format(status_dir))
+    bundle_cmds.append('    exit_code=$?')
+    bundle_cmds.append('    printf \'{{"job": "%s", "exit_code": %d, "wall_time_sec": %d, "finished": "%s", '
+                       '"host": "%s"}}\\n\' $1 $exit_code $(( $(date +%s) - time_start )) '
+                       '"$(date \'+%Y-%m-%d %H:%M:%S\')" $(hostname) > {0}/$1.exit.json'.format(status_dir))
+    bundle_cmds.append('}')
+
+    member_prefixes = [prefix for prefix, job_path_member in members]
+    for prefix in member_prefixes:
+        if concurrent_subjects > 1:
+            bundle_cmds.append('while [ $(jobs -rp | wc -l) -ge {0} ]; do sleep 5; done'.format(concurrent_subjects))
+            bundle_cmds.append('run_member {0} &'.format(prefix))
         else:
-            quote_del = hpc_dir_2
-        jID.write('\n'.join(quote_del))
+            bundle_cmds.append('run_member {0}'.format(prefix))
+    bundle_cmds.append('wait')
 
-    # complete single line command for qsub
-    qsub_opt = hpc_dir_1 + hpc_dir_2
+    bundle_cmds.append('num_failed=0')
+    bundle_cmds.append('for member in {0}; do'.format(' '.join(member_prefixes)))
+    bundle_cmds.append('    grep -q \'"exit_code": 0,\' {0}/$member.exit.json || num_failed=$((num_failed + 1))'.format(
+        status_dir))
+    bundle_cmds.append('done')
+    bundle_cmds.append('echo "$num_failed of {0} subjects failed."'.format(len(member_prefixes)))
+    bundle_cmds.append('[ $num_failed -eq 0 ]')
+
+    with open(job_path, 'a') as jID:
+        jID.write('\n'.join(bundle_cmds))
+        jID.write('\n')
+
+    # the job file is submitted as such, as the members need the shell
+    qsub_opt = hpc_dir_1 + [job_path]
+    # ensuring unnecessary prefix #$ #PBS is removed
+    qsub_opt = [strg.replace(hpc['prefix'], '') for strg in qsub_opt]
+
+    return job_path, qsub_opt
+
+
+def submit_bundled_jobs(opt, step_id, step_cmd_matlab, step_label, invocations, job_dir, depends_on_step,
+                        resources=None, profiles=None, prologue=None):
+    """
+    Submits the per-subject invocations of a step packed into jobs of opt.subjects_per_job subjects each,
+        recording the id of each job against all the subjects it processes.
+        Each job requests enough resources for the subjects it processes concurrently (see combine_resources).
+
+    :returns: status of submission and a dict of job IDs keyed by subject prefix.
+    """
+
+    subject_keys = invocations.keys()
+    num_per_job = opt.subjects_per_job
+    concurrent_subjects = getattr(opt, 'concurrent_subjects', 1)
+    if resources is None:
+        resources = dict()
+    if profiles is None:
+        profiles = dict()
+
+    # each item will be a tuple (job_str, subject keys), keyed by the path to the job
+    bundles = OrderedDict()
+    for bundle_idx, start in enumerate(range(0, len(subject_keys), num_per_job)):
+        bundle_keys = subject_keys[start:start + num_per_job]
+        members = list()
+        for key in bundle_keys:
+            prefix, arg_list_subset, outputs = invocations[key]
+            job_path_member, _ = make_single_job(opt.environment, step_id, step_cmd_matlab, prefix, arg_list_subset,
+                                                 job_dir, outputs, profile=profiles.get(key), prologue=prologue)
+            members.append((prefix, job_path_member))
+
+        bundle_prefix = '{0}_b{1:0>3}'.format(step_label, bundle_idx + 1)
+        bundle_resources = combine_resources([resources.get(key) for key in bundle_keys], concurrent_subjects)
+        job_path, qsub_opt = make_bundled_job(bundle_prefix, members, job_dir, concurrent_subjects, bundle_resources)
+        # the bundle waits for the previous steps of all its subjects
+        bundles[job_path] = (' '.join(qsub_opt), bundle_keys)
+
+    job_id_list = OrderedDict()
+    txt_out = list()
+    for job_path, bundle_job_id in submit_queue_many(bundles, depends_on_step).items():
+        bundle_keys = bundles[job_path][1]
+        for key in bundle_keys:
+            job_id_list[key] = bundle_job_id
+        txt_out.append('{} : {} subjects (job id: {})'.format(os.path.basename(job_path), len(bundle_keys),
+                                                              bundle_job_id))
+
+    print('\t' + '\n\t'.join(txt_out) + '\n')
+
+    return True, job_id_list
+
+
+def make_array_job(environment, step_id, step_cmd_matlab, step_label, subjects, arg_list, input_dir, job_dir,
+                   resources=None, profiles=None, prologue=None, extra_args=None):
+    """
+    Helper to generate a single array job for a per-subject step: a manifest with one input line per subject,
+        and a job file whose tasks pick their own line from the manifest by their task index.
+        Each task records a sentinel named as the job for the same subject would be (see make_single_job).
+        All the tasks request the same resources, if given (those of the largest task).
+        The profile of each task (in the order of subjects), if given, is recorded in the runtime ledger.
+        The prologue, if given, is run first by each task, with its input file in place of {0}.
+        The args appended for some of the subjects only (extra_args, as in process_module_generic) are picked
+        by each task from a manifest per arg, empty for the other tasks.
+    """
+
+    prefix = '{0}_array'.format(step_label)
+    manifest_path = os.path.join(input_dir, prefix + '.manifest.txt')
+    # name, profile and outputs of each task, for its sentinel
+    sentinel_manifest_path = os.path.join(input_dir, prefix + '.sentinels.txt')
+    sentinel_dir = get_sentinel_dir(job_dir)
+    if profiles is None:
+        profiles = [None] * len(subjects)
+    with open(manifest_path, 'w') as mf, open(sentinel_manifest_path, 'w') as smf:
+        for idx, subject in enumerate(subjects.itervalues()):
+            mf.write(subject.line.rstrip('\n') + '\n')
+            task_name = '{1}_s{0:0>3}_{2}'.format(idx + 1, step_label, subject.prefix)
+            outputs = check_proc_status.expected_outputs(step_id, strip_nifti_ext(subject.prefix), subject.out)
+            smf.write(' '.join([task_name, profiles[idx] or '-'] + outputs) + '\n')
+            prev_record = os.path.join(sentinel_dir, task_name + '.json')
+            if os.path.isfile(prev_record):
+                os.remove(prev_record)
+
+    # a manifest for each of the args appended for some of the subjects, with a line per task
+    if extra_args is None:
+        extra_args = dict()
+    num_extra = max([len(extra_args.get(sub_key, list())) for sub_key in subjects] + [0])
+    extra_manifests = list()
+    for arg_num in range(1, num_extra + 1):
+        extra_manifest_path = os.path.join(input_dir, '{}.arg{}.txt'.format(prefix, arg_num))
+        with open(extra_manifest_path, 'w') as emf:
+            for sub_key in subjects:
+                task_args = extra_args.get(sub_key, list())
+                emf.write((str(task_args[arg_num - 1]) if len(task_args) >= arg_num else '') + '\n')
+        extra_manifests.append(('{}{}'.format(array_extra_var, arg_num), extra_manifest_path))
+
+    extra_arg_list = ['${' + var + '}' for var, _ in extra_manifests]
+    full_cmd = construct_full_cmd(environment, step_id, step_cmd_matlab, [array_input_arg] + arg_list + extra_arg_list,
+                                  prefix, job_dir)
+
+    job_path = os.path.join(job_dir, prefix + '.job')
+    hpc_dir_1 = make_job_file_and_1linecmd(job_path, script=True, resources=resources)
+
+    array_option, task_id_var = get_executor().array_spec()
+    task_cmds = list()
+    task_cmds.append('')  # to get the newline concat working
+    task_cmds.append('TASK_ID=${{{0}}}'.format(task_id_var))
+    task_cmds.append('export {0}=${{TMPDIR:-/tmp}}/{1}.task${{TASK_ID}}.input.txt'.format(array_input_var, prefix))
+    task_cmds.append('sed -n "${{TASK_ID}}p" {0} > {1}'.format(manifest_path, array_input_arg))
+    for var, extra_manifest_path in extra_manifests:
+        task_cmds.append('export {0}="$(sed -n "${{TASK_ID}}p" {1})"'.format(var, extra_manifest_path))
+    task_cmds.append('read sentinel_job job_profile sentinel_outputs <<< "$(sed -n "${{TASK_ID}}p" {0})"'.format(
+        sentinel_manifest_path))
+    if prologue is not None:
+        task_cmds.append(prologue.format(array_input_arg))
+    task_cmds.extend(sentinel_cmds(full_cmd, sentinel_dir))
+    task_cmds.append('rm -f {0}'.format(array_input_arg))
+    task_cmds.append('exit $exit_code')
+
+    with open(job_path, 'a') as jID:
+        jID.write('\n'.join(task_cmds))
+        jID.write('\n')
+
+    # the job file is submitted as such, as the tasks need the shell to pick their input line
+    qsub_opt = hpc_dir_1 + [array_option.format(len(subjects)), job_path]
     # ensuring unnecessary prefix #$ #PBS is removed
     qsub_opt = [strg.replace(hpc['prefix'], '') for strg in qsub_opt]
 
     return job_path, qsub_opt
 
 
+def submit_array_job(job_path, qsub_opt, subjects, depends_on_step):
+    """
+    Submits an array job, recording its id against each of the subjects it processes.
+
+    :returns: status of submission and a dict of job IDs keyed by subject prefix.
+    """
+
+    array_prefixes = [subject.prefix for subject in subjects.itervalues()]
+    # the id of the array as a whole, which dependencies on all of its tasks refer to
+    array_job_id = submit_queue(' '.join(qsub_opt), depends_on_step, array_prefixes=array_prefixes)
+
+    job_id_list = OrderedDict()
+    for subject in subjects.itervalues():
+        job_id_list[subject.prefix] = array_job_id
+
+    print('\t{} : array of {} tasks (job id: {})\n'.format(os.path.basename(job_path), len(subjects), array_job_id))
+
+    return True, job_id_list
+
+
 def run_jobs(job_paths, run_locally, num_procs, depends_on_step):
     """ Tool to either submit jobs or run them locally, as directed by the user."""
 
@@ -1436,43 +2790,42 @@ def run_jobs(job_paths, run_locally, num_procs, depends_on_step):
     if run_locally:
 
         if not hpc['dry_run']:
-            # ret_code = local_exec(job_path, log_fname, print_to_screen=True)
-            # if ret_code < 0 or ret_code > 0:
-            #     raise OSError('Error executing the {} job locally.'.format(step_id))
-
-            # list of all script paths
-            jobs_list = job_paths.values()
-
-            pool = Pool()
-            for idx_beg in range(0, len(jobs_list), num_procs):
-                # running only on a specified num cores, one subject at a time
-                pool.map(local_exec, jobs_list[idx_beg:idx_beg + num_procs])
-                pool.close()
-                pool.join()
+            # jobs are only added to the local graph here, to be run all together later by run_local_jobs(),
+            # so the jobs of different steps can run concurrently, as soon as their own dependencies are done.
+            for prefix, (job_path, job_details) in job_paths.items():
+                job_id_list[prefix] = get_executor().submit([job_path], get_dependency_ids(depends_on_step, prefix))
         else:
-            for prefix, job_path in job_paths.items():
+            for prefix, (job_path, job_details) in job_paths.items():
                 job_id_list[prefix] = make_dry_run(job_path)
     else:
-        # num_sub_per_job = 1 # ability to specify >1 subjects per job
-        # job_id_list = map(submit_queue, jobs_list)
-        txt_out = list()
-        for prefix, (job_path, job_details) in job_paths.items():
-            job_details_str = ' '.join(job_details)
-            job_id_list[prefix] = submit_queue(job_details_str, depends_on_step)
-            txt_out.append('{} (job id: {})'.format(prefix, job_id_list[prefix]))
-
-        tty_height, tty_width = subprocess.check_output(['stty', 'size']).split()
-        max_width = max(map(len,txt_out))
-        num_sets  = int(math.floor( int(tty_width) / (max_width+4)))
+        # jobs of the same step do not depend on one another, so they are submitted concurrently
+        jobs = OrderedDict((prefix, (' '.join(job_details), prefix))
+                           for prefix, (job_path, job_details) in job_paths.items())
+        job_id_list = submit_queue_many(jobs, depends_on_step)
+        txt_out = ['{} (job id: {})'.format(prefix, job_id) for prefix, job_id in job_id_list.items()]
+
+        max_width = max(map(len, txt_out))
+        num_sets = max(1, int(math.floor(get_terminal_width() / (max_width + 4))))
+        rows = list()
         for idx in range(0, len(txt_out), num_sets):
-            print('\t' + '\t'.join(txt_out[idx:min(idx+num_sets,len(txt_out))]))
-            time.sleep(0.08)
+            rows.append('\t' + '\t'.join(txt_out[idx:min(idx + num_sets, len(txt_out))]))
+        print('\n'.join(rows))
 
     print('')
 
     return True, job_id_list
 
 
+def get_terminal_width(default_width=80):
+    """Width of the terminal, or the default when not printing to one (e.g. when the output is redirected)."""
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return int(subprocess.check_output(['stty', 'size'], stderr=devnull).split()[1])
+    except (OSError, subprocess.CalledProcessError, IndexError, ValueError):
+        return default_width
+
+
 # noinspection PyUnusedLocal
 def make_dry_run(cmd_str):
     """ Simple function to perform a dry run (indicated by a -ve job id)."""
@@ -1483,91 +2836,198 @@ def make_dry_run(cmd_str):
     return -job_id
 
 
-def submit_queue(job, depends_on_steps):
-    """ Helper to submit jobs to the queue, taking care of the inter-dependencies. Returns the job ID."""
-    global hpc
+def get_dependency_ids(depends_on_steps, subject_key='all_subjects'):
+    """
+    Returns the IDs of the jobs (submitted previously in this session) the current job must wait for.
+        A job operating on the dataset as a whole waits for all the jobs of the steps it depends on,
+        whereas a per-subject job waits only for the same subject in the per-subject steps it depends on.
+        subject_key can also be a list of subjects, for a job processing several of them.
+    """
 
-    qsub_path = 'qsub'  # find_executable('qsub')
+    if depends_on_steps is None:
+        return []
 
-    # encoding dependencies
-    if depends_on_steps is not None:
-        # making it a list when only one step is specified
-        if not isinstance(depends_on_steps, list):
-            depends_on_steps = [depends_on_steps, ]
-
-        job_ids = list()
-        for step in depends_on_steps:
-            if step in hpc['job_ids_grouped']:
-                # this condition can be False when rerunning from a existing processing
-                # some steps may have been completed already - which means they are not in queue now,
-                # in which case this current step doesnt need to wait
-                job_ids.extend(hpc['job_ids_grouped'][step].values())
-
-        if job_ids:  # if not empty
-            job_id_list_str = map(str, job_ids)
-        else:
-            job_id_list_str = ''
+    if isinstance(subject_key, list):
+        subject_keys = subject_key
     else:
-        job_id_list_str = ''
-
-    if hpc['type'].upper() in ('ROTMAN', 'BRAINCODE', 'ROTMAN-SGE', 'SGE'):
-        # qsub_cmd  = qsub_path + ' -terse '
-        qsub_cmd = qsub_path
-        terse = '-terse'
-        hold_spec = '-hold_jid ' + ",".join(job_id_list_str)
-    elif hpc['type'].upper() in ('CAC', 'HPCVL', 'QUEENSU'):
-        # qsub_cmd  = qsub_path + ' -terse '
-        qsub_cmd = qsub_path
-        terse = '-terse'
-        hold_spec = '-hold_jid ' + ",".join(job_id_list_str)
-    elif hpc['type'].upper() in ('SCINET', 'PBS', 'TORQUE'):
-        qsub_cmd = qsub_path
-        terse = ''
-        hold_spec = '-W depend=' + ":".join(job_id_list_str)
-    else:
-        raise ValueError('HPC type {} unrecognized or not implemented.'.format(hpc['type']))
+        subject_keys = [subject_key, ]
+
+    # making it a list when only one step is specified
+    if not isinstance(depends_on_steps, list):
+        depends_on_steps = [depends_on_steps, ]
+
+    job_ids = list()
+    for step in depends_on_steps:
+        # this condition can be False when rerunning from a existing processing
+        # some steps may have been completed already - which means they are not in queue now,
+        # in which case this current step doesnt need to wait
+        if step not in hpc['job_ids_grouped']:
+            continue
 
-    if job_id_list_str not in [None, '', []]:
-        hold_spec_str = hold_spec
-    else:
-        # some jobs don't need to wait for others!
-        hold_spec_str = ''
+        step_job_ids = hpc['job_ids_grouped'][step]
+        if 'all_subjects' not in subject_keys and step not in cfg_pronto.CODES_DATASET_LEVEL_STEPS:
+            # subject may not have been (re)submitted in the previous step, if it was done already
+            for key in subject_keys:
+                if key in step_job_ids:
+                    job_ids.append(step_job_ids[key])
+        else:
+            job_ids.extend(step_job_ids.values())
+
+    # removing duplicates, preserving the order
+    return list(OrderedDict.fromkeys(job_ids))
+
+
+def get_array_dependency_ids(depends_on_steps, array_prefixes):
+    """
+    Returns the IDs of the array jobs in the steps depending upon, whose tasks process the same subjects
+        in the same order as the array job being submitted, so each task can wait just for its counterpart.
+    """
 
-    arg_list = [qsub_cmd, terse, hold_spec_str, job]
-    # removing empty args (terse and hold list can be empty sometimes)
-    arg_list = [arg for arg in arg_list if arg]
-    full_cmd = ' '.join(arg_list)
-    full_cmd = re.sub('\s+', ' ', full_cmd).strip()
+    # only some schedulers (SGE with -hold_jid_ad, SLURM with aftercorr) can express dependencies
+    #   between individual tasks of two arrays
+    if depends_on_steps is None or not get_executor().task_dependencies:
+        return []
+
+    if not isinstance(depends_on_steps, list):
+        depends_on_steps = [depends_on_steps, ]
+
+    array_tasks = hpc.get('array_tasks', {})
+    job_ids = list()
+    for step in depends_on_steps:
+        if step in hpc['job_ids_grouped'] and array_tasks.get(step) == list(array_prefixes):
+            job_ids.append(hpc['job_ids_grouped'][step][array_prefixes[0]])
+
+    return job_ids
+
+
+def submission_args(job, depends_on_steps, subject_key='all_subjects', array_prefixes=None):
+    """
+    Args of the submission of a job, and the IDs of the jobs it must wait for: all of their tasks,
+        and only the same task (for the tasks of an array job processing array_prefixes).
+        A per-subject job (identified by subject_key) waits only for the same subject in per-subject steps.
+        Tasks of an array job wait only for their counterparts in matching arrays.
+    """
+
+    # encoding dependencies
+    job_ids = get_dependency_ids(depends_on_steps, subject_key)
+    if array_prefixes is not None:
+        task_job_ids = map(str, get_array_dependency_ids(depends_on_steps, array_prefixes))
+        job_ids = [jid for jid in job_ids if str(jid) not in task_job_ids]
+    else:
+        task_job_ids = list()
 
     # splitting on space is required, otherwise subprocess throws an error,
     # as the '-opt value' in a single string gets interepreted as the name of an option
-    arg_list = full_cmd.split(' ')
+    job_args = re.sub('\s+', ' ', job).strip().split(' ')
 
-    if not hpc['dry_run']:
-        job_id = subprocess.check_output(arg_list)
-        job_id = job_id.strip()
-    else:
-        job_id = make_dry_run(full_cmd)
+    return job_args, job_ids, task_job_ids
+
+
+def submit_queue(job, depends_on_steps, subject_key='all_subjects', array_prefixes=None):
+    """
+    Helper to submit jobs to the queue, taking care of the inter-dependencies (see submission_args).
+        Returns the job ID.
+    """
+
+    if hpc['dry_run']:
+        return make_dry_run(job)
+
+    job_args, job_ids, task_job_ids = submission_args(job, depends_on_steps, subject_key, array_prefixes)
+    num_tasks = len(array_prefixes) if array_prefixes is not None else 1
+
+    return get_submitter().submit(job_args, job_ids, task_job_ids, num_tasks)
+
+
+def submit_queue_many(jobs, depends_on_steps):
+    """
+    Submits many jobs that do not depend on one another (e.g. those of a single step) concurrently,
+        as paced by the submitter (see submission.py).
+
+    :param jobs: OrderedDict of key -> (job_str, subject key(s) processed by the job)
+    :returns: OrderedDict of key -> job ID
+    """
+
+    if hpc['dry_run']:
+        return OrderedDict((key, make_dry_run(job_str)) for key, (job_str, subject_key) in jobs.items())
+
+    submissions = OrderedDict((key, submission_args(job_str, depends_on_steps, subject_key))
+                              for key, (job_str, subject_key) in jobs.items())
 
-    return job_id
+    return get_submitter().submit_many(submissions)
 
 
 def submit_jobs():
     """
     Gateway to OPPNI preprocessing and optimization tool.
-        Coordinates the status checks and runs/reruns what is required to perform the requested processing.
+        Submits each of the analyses requested, those sharing the preprocessing of another waiting
+        for its preprocessing of the same subject, then runs them all if running locally.
     """
 
     global hpc
     # check args
-    unique_subjects, options, input_file, cur_garage, time_stamp, proc_out_dir = parse_args_check()
+    analyses = parse_args_check()
+
+    # jobs preprocessing the runs for other analyses, and the order of their tasks (for array jobs),
+    #   by the suffix of the processing folder they belong to
+    preproc_jobs = dict()
+    for unique_subjects, options, input_file, cur_garage, time_stamp, proc_out_dir in analyses:
+        if len(analyses) > 1:
+            print('\n Analysis {} with contrast {}:'.format(options.analysis, options.contrast_list_str))
+        # each processing folder keeps the ids of its own jobs, and the usage of its jobs
+        hpc['ledger_path'] = os.path.abspath(options.ledger_path)
+        hpc['job_ids_grouped'] = dict()
+        hpc['array_tasks'] = dict()
+        if options.preproc_source in preproc_jobs:
+            job_ids, array_tasks = preproc_jobs[options.preproc_source]
+            hpc['job_ids_grouped'][step_shared_preproc] = job_ids
+            if array_tasks is not None:
+                hpc['array_tasks'][step_shared_preproc] = array_tasks
 
-    if options.status_update_in is not None and unique_subjects in [[], None]:
-        print('Status update done.')
-        return
+        try:
+            submitted = submit_analysis(unique_subjects, options, input_file, cur_garage)
+        except submission.SubmissionError:
+            # the jobs queued so far must be known to check the status, or to cancel them
+            save_hpc_cfg_and_jod_ids(cur_garage)
+            raise
+        if submitted:
+            # saving the job ids and hpc cfg to facilitate a status update in future
+            save_hpc_cfg_and_jod_ids(cur_garage)
+        if 'PART1' in hpc['job_ids_grouped']:
+            preproc_jobs[options.suffix] = (hpc['job_ids_grouped']['PART1'], hpc['array_tasks'].get('PART1'))
 
-    # we dont need to check status if its a dry run meant to generate job scripts
     if not hpc['dry_run']:
+        # the report of a simulated cluster runs its simulation, only once
+        report = get_executor().report()
+        if report is not None:
+            print(report)
+
+    # running all the jobs of the requested steps, following their dependencies
+    #   the local jobs are only added to the graph while submitting, so their failures are known only once run
+    if options.run_locally is True and not hpc['dry_run']:
+        if not run_local_jobs(int(options.numcores), options.tail_logs):
+            raise Exception('Some of the jobs failed - check their outputs and the status with --status.')
+
+
+def submit_analysis(unique_subjects, options, input_file, cur_garage):
+    """
+    Coordinates the status checks of a single analysis (model and contrast),
+        and submits what is required to perform the requested processing.
+
+    :returns: whether any processing was submitted
+    """
+
+    global hpc
+
+    # the status can only be checked against the combinations left by the search on pilot runs
+    search_pending = pipeline_search.num_rounds(options) > 0 and not os.path.isfile(options.pipeline_file)
+
+    # we dont need to check status if its a dry run meant to generate job scripts
+    if search_pending and not hpc['dry_run']:
+        print('\n The search over the pipeline combinations on pilot runs is not complete - resuming it.')
+        is_done = cfg_pronto.initialize_proc_status()
+        rem_input_file = None
+        rem_spnorm_file = None
+    elif not hpc['dry_run']:
         # check the status of processing
         # so processing can be done only for the unfinished or failed subjects
         # notice the inputs are combined as a list
@@ -1586,7 +3046,7 @@ def submit_jobs():
         if is_done.preprocessing and is_done.optimization and is_done.QC1 and is_done.QC2:
             print "All of preprocessing, optimization and QC seem to be finished already."
             print " if you'd like to force preprocessing, please rename/remove/move the existing outputs and rerun."
-            return
+            return False
     else:
         print('This is just a dry run - generating jobs for all steps regardless of their processing status.')
         is_done = cfg_pronto.initialize_proc_status()
@@ -1641,11 +3101,18 @@ def submit_jobs():
 
     # submitting jobs for preprocessing for all combinations of pipelines
     if run_part_one and is_done.preprocessing is False:
+        preproc_after = None
+        preproc_prologue = None
+        if search_pending:
+            print('Search on pilot runs:')
+            run_pipeline_search(unique_subjects, options, cur_garage)
+            preproc_after = pipeline_search.search_step(options)[0]
+            preproc_prologue = pipeline_search.reset_cmd(options.pipeline_file)
+
         # running part 1 only on subjects with incomplete processing
         print('Preprocessing:')
-        status_p1, job_ids_pOne = run_preprocessing(unique_subjects, options, rem_input_file, cur_garage)
-        if options.run_locally is True and (status_p1 is False or status_p1 is None):
-            raise Exception('Preprocessing step failed.')
+        status_p1, job_ids_pOne = run_preprocessing(unique_subjects, options, rem_input_file, cur_garage,
+                                                    depends_on_step=preproc_after, prologue=preproc_prologue)
 
     spnorm_completed = False
     spnorm_step1_completed = False
@@ -1654,10 +3121,7 @@ def submit_jobs():
         print('spatial normalization (step 1) BEFORE optimization:')
         status_sp, job_ids_spn = process_spatial_norm(unique_subjects, options, rem_spnorm_file, sp_norm_step,
                                                       cur_garage)
-        if options.run_locally is True and (status_sp is False or status_sp is None):
-            raise Exception('Spatial normalization - step 1 failed.')
-        else:
-            spnorm_step1_completed = True
+        spnorm_step1_completed = True
 
     # submitting jobs for optimization
     if run_part_two and options.analysis != "None" and is_done.optimization is False:
@@ -1665,8 +3129,6 @@ def submit_jobs():
         # even though part 1 may have been rerun just for failed/unfinished subjects
         print('stats and optimization :')
         status_p2, job_ids_pTwo = run_optimization(unique_subjects, options, input_file, cur_garage)
-        if options.run_locally is True and (status_p2 is False or status_p2 is None):
-            raise Exception('Optimization failed.')
 
     # finishing up the spatial normalization
     if run_sp_norm:
@@ -1676,49 +3138,52 @@ def submit_jobs():
             sp_norm_step = 0
 
         print('spatial normalization (step 2): ')
-        status_sp = process_spatial_norm(unique_subjects, options, rem_spnorm_file, sp_norm_step, cur_garage)
-        if options.run_locally is True and (status_sp is False or status_sp is None):
-            raise Exception('Spatial normalization - steps 2 and later failed.')
+        status_sp, job_ids_spn = process_spatial_norm(unique_subjects, options, rem_spnorm_file, sp_norm_step,
+                                                      cur_garage)
 
         print('group mask generation: Submitting jobs ..')
-        status_gm = process_group_mask_generation(unique_subjects, options, input_file, cur_garage)
-        if options.run_locally is True and (status_gm is False or status_gm is None):
-            raise Exception('Group mask generation failed.')
+        status_gm, job_ids_gm = process_group_mask_generation(unique_subjects, options, input_file, cur_garage)
 
     # generating QC1 if not done already
     if is_done.QC1 is False and run_qc1 is True:
         print('QC 1 :')
         status_qc1, job_ids_qc1 = run_qc_part_one(unique_subjects, options, input_file, cur_garage)
-        if options.run_locally is True and (status_qc1 is False or status_qc1 is None):
-            raise Exception('QC part 1 failed.')
 
     # generating QC2 if not done already
     if is_done.QC2 is False and run_qc2 is True:
         print('QC 2 :')
         status_qc2, job_ids_qc2 = run_qc_part_two(unique_subjects, options, input_file, cur_garage)
-        if options.run_locally is True and (status_qc2 is False or status_qc2 is None):
-            raise Exception('QC part 2 failed.')
 
-    # saving the job ids and hpc cfg to facilitate a status update in future
-    save_hpc_cfg_and_jod_ids(cur_garage)
+    if options.num_workers > 0:
+        start_workers(options, cur_garage)
+
+    return True
 
 
 def save_hpc_cfg_and_jod_ids(cur_garage):
     """Saves the job ids and hpc cfg to facilitate a status update in future"""
 
+    # the jobs preprocessing the runs shared with another analysis are saved with that analysis only
+    job_ids_grouped = dict((step, job_ids) for step, job_ids in hpc['job_ids_grouped'].items()
+                           if step != step_shared_preproc)
+    array_tasks = dict((step, tasks) for step, tasks in hpc.get('array_tasks', {}).items()
+                       if step != step_shared_preproc)
+
     # saving the job ids
     job_id_file = os.path.join(cur_garage, file_name_job_ids_by_group)
     if os.path.isfile(job_id_file):
         os.remove(job_id_file)
     with open(job_id_file, 'wb') as jlist:
-        json.dump(hpc['job_ids_grouped'], jlist, indent=2)
+        json.dump(job_ids_grouped, jlist, indent=2)
+
+    get_executor().save_state(cur_garage)
 
     # saving the config
     cfg_file = os.path.join(cur_garage, file_name_hpc_config)
     if os.path.isfile(cfg_file):
         os.remove(cfg_file)
     with open(cfg_file, 'wb') as hcf:
-        json.dump(hpc, hcf, indent=2)
+        json.dump(dict(hpc, job_ids_grouped=job_ids_grouped, array_tasks=array_tasks), hcf, indent=2)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# Searches over the pipeline combinations on pilot subsets of the runs, before processing the whole cohort:
+#   adaptively (--adaptive_rounds), by successive halving on growing pilot subsets, or
+#   selecting the fixed pipelines (--pilot_selection) for --os FIX or CON on a single pilot subset.
+#
+# Rather than preprocessing every run with the full grid of combinations, the grid is first evaluated on a pilot
+#   subset of the runs, whose metrics (dPR, P or R, from their stats_<prefix>.mat) prune the losing options of the
+#   steps until about half the combinations survive (see prune_pipelines.m). Each round evaluates the survivors of
+#   the previous one on twice as many runs, and the whole cohort is processed with the survivors of the last round.
+#   The jobs pruning each round write its pipeline file to <processing folder>/adaptive_search/pipeline_round<r>.txt,
+#   so all the rounds are submitted at once, each waiting on the previous one.
+#   The pilot selection is a single round, whose job (see select_pipelines.m) selects the FIX and CON pipelines as
+#   Part 2 would, so the rest of the runs are processed with those only.
+#   Part 1 keeps the statistics of a run once computed, so the jobs processing the whole cohort remove those computed
+#   for the pilot runs before the search concluded (see reset_run), to compute them for the surviving combinations.
+
+import math
+import os
+import sys
+from collections import OrderedDict
+
+import input_records
+import nifti_header
+import proc_status_front as check_proc_status
+
+dir_name_search = 'adaptive_search'
+file_name_round_pipeline = 'pipeline_round{}.txt'
+file_name_round_input = 'pilot_round{}.txt'
+
+# fewest runs the combinations are compared on
+min_pilot_runs = 2
+
+
+def stratum(subject):
+    """Runs in the same stratum share their task file and acquisition (dimensions, volumes and TR, when known)."""
+
+    header = getattr(subject, 'header', None)
+    if header is None:
+        return (subject.task, )
+
+    return (subject.task, tuple(header['dims'][:3]), nifti_header.num_volumes(header), header['tr_msec'])
+
+
+def pilot_order(subjects):
+    """
+    Orders the runs so that any number of the first ones is a stratified sample: every stratum contributes in
+        proportion to its size, in the order of the input file.
+
+    :returns: list of subject keys
+    """
+
+    strata = OrderedDict()
+    for sub_key, subject in subjects.items():
+        strata.setdefault(stratum(subject), list()).append(sub_key)
+
+    ranked = list()
+    for stratum_idx, keys in enumerate(strata.values()):
+        for position, key in enumerate(keys):
+            ranked.append(((position + 0.5) / len(keys), stratum_idx, key))
+
+    return [key for _, _, key in sorted(ranked)]
+
+
+def round_sizes(num_runs, num_rounds, pilot_fraction):
+    """Number of pilot runs evaluated in each round (including those of the earlier rounds), doubling every round."""
+
+    first = max(min_pilot_runs, int(math.ceil(num_runs * pilot_fraction)))
+
+    return [min(first * 2 ** round_idx, num_runs) for round_idx in range(num_rounds)]
+
+
+def round_pipeline_file(garage, round_num):
+    """Pipeline file of the combinations surviving a round (numbered from 1)."""
+
+    return os.path.join(garage, dir_name_search, file_name_round_pipeline.format(round_num))
+
+
+def round_input_file(garage, round_num):
+    """Input file of the pilot runs evaluated in a round (numbered from 1)."""
+
+    return os.path.join(garage, dir_name_search, file_name_round_input.format(round_num))
+
+
+def count_combinations(pipeline_file):
+    """Number of combinations in a pipeline file (None if it can not be read)."""
+
+    try:
+        with open(pipeline_file, 'r') as pf:
+            lines = pf.readlines()
+    except IOError:
+        return None
+
+    count = 1
+    for line in lines:
+        step, sep, choices = line.partition('=')
+        if sep:
+            count *= max(1, len([choice for choice in choices.strip().strip('[]').split(',') if choice.strip()]))
+
+    return count
+
+
+def num_rounds(options):
+    """Rounds of the search requested (0 for none, i.e. processing all the runs with all the combinations)."""
+
+    if getattr(options, 'pilot_selection', False):
+        return 1
+
+    return getattr(options, 'adaptive_rounds', 0)
+
+
+def search_step(options):
+    """Step and MATLAB function of the job concluding each round, which writes its pipeline file."""
+
+    if getattr(options, 'pilot_selection', False):
+        return 'SELECT', 'select_pipelines'
+
+    return 'PRUNE', 'prune_pipelines'
+
+
+def pilot_runs_file(garage, options):
+    """Input file of all the pilot runs, once all the rounds are submitted (None otherwise)."""
+
+    if num_rounds(options) < 1:
+        return None
+
+    pilot_input_file = round_input_file(garage, num_rounds(options))
+    if not os.path.isfile(pilot_input_file):
+        return None
+
+    return pilot_input_file
+
+
+def rounds_done(garage, num_rounds):
+    """Rounds whose pipeline file has been written, in order (the search is complete once all are)."""
+
+    done = list()
+    for round_num in range(1, num_rounds + 1):
+        if not os.path.isfile(round_pipeline_file(garage, round_num)):
+            break
+        done.append(round_num)
+
+    return done
+
+
+def report_progress(garage, options):
+    """
+    Prints the progress of the search of a processing folder, if any. While it is incomplete, the outputs of the
+        pilot runs of the round under way are checked against the combinations they are evaluated on, listing those
+        to resubmit next to their input file.
+
+    :returns: whether the search is complete (or was not requested)
+    """
+
+    rounds = num_rounds(options)
+    if rounds < 1:
+        return True
+
+    if getattr(options, 'pilot_selection', False):
+        label = 'Selection of the pipelines on the pilot runs'
+    else:
+        label = 'Adaptive search over the pipeline combinations'
+    full_pipeline_file = getattr(options, 'full_pipeline_file', options.pipeline_file)
+    counts = [count_combinations(full_pipeline_file)]
+    done = rounds_done(garage, rounds)
+    counts.extend(count_combinations(round_pipeline_file(garage, round_num)) for round_num in done)
+    print('\n{}: {} of {} rounds done ({} combinations).'.format(
+        label, len(done), rounds, ' -> '.join(str(count) for count in counts)))
+    if len(done) == rounds:
+        return True
+
+    round_num = len(done) + 1
+    pilot_input_file = round_input_file(garage, round_num)
+    if os.path.isfile(pilot_input_file):
+        if round_num > 1:
+            full_pipeline_file = round_pipeline_file(garage, round_num - 1)
+        print('\nPilot runs of round {} (on {} combinations):'.format(round_num, counts[-1]))
+        check_proc_status.run([pilot_input_file, full_pipeline_file, '--skip_validation'])
+
+    return False
+
+
+def reset_cmd(pipeline_file):
+    """Command resetting the statistics of a run computed before pipeline_file was written (see reset_run),
+        with {0} in place of the input file of the run."""
+
+    return '{} {} {{0}} {}'.format(sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + '.py',
+                                  os.path.abspath(pipeline_file))
+
+
+def reset_run(input_file, pipeline_file):
+    """
+    Removes the statistics of Part 1 of the run in an input file, if computed before the pipeline file was written
+        (i.e. on the combinations of a round of the search), so Part 1 computes them for its combinations.
+
+    :returns: number of files removed
+    """
+
+    with open(input_file, 'r') as ipf:
+        record = input_records.parse_input_line(ipf.readline())
+    sub_prefix = input_records.strip_nifti_ext(record.prefix)
+    written = os.path.getmtime(pipeline_file)
+
+    num_removed = 0
+    for stats_file in check_proc_status.part1_stats_outputs(sub_prefix, record.out):
+        if os.path.isfile(stats_file) and os.path.getmtime(stats_file) < written:
+            os.remove(stats_file)
+            num_removed += 1
+    if num_removed > 0:
+        print('statistics of {} on the pilot combinations removed ({} files).'.format(sub_prefix, num_removed))
+
+    return num_removed
+
+
+if __name__ == '__main__':
+    # run by the jobs of Part 1 processing the whole cohort (see reset_cmd)
+    reset_run(*sys.argv[1:3])
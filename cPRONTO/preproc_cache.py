@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# Content-addressed cache of the AFNI preprocessing of Part 1, shared by the analyses of the same runs.
+#
+# The preprocessing of a run depends only on the contents of its files, DROP, the pipeline combination, the
+#   preprocessing options (DEOBLIQUE, TPATTERN, BlurToFWHM) and the versions of the tools, but not on the analysis
+#   model or contrast. Hence the outputs of each run are cached under a key derived from all of these, as:
+#   <cache>/entries/<key[:2]>/<key>/<folder>/RUN_<suffix>, for each output <prefix>_<suffix> in
+#   <OUT>/intermediate_processed/<folder>, with the combinations as RUN_<code>.nii in afni_processed.
+#   New processing folders hard link (or symlink, across filesystems) the outputs of the runs already cached, so
+#   Part 1 skips their AFNI steps, and computes only the statistics of the analysis.
+#   Runs not cached yet are added once their preprocessing is done, the next time the cache is looked up.
+#
+# Analyses submitted together (several models or contrasts) share the preprocessing of the first of them instead:
+#   the jobs of Part 1 of the others link its outputs in when they start (see share_run), once it is done.
+
+import errno
+import glob
+import hashlib
+import json
+import os
+import re
+import stat
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+import input_records
+import proc_status_front as check_proc_status
+
+# stands in for the output prefix of the run, in the names of the cached files
+run_placeholder = 'RUN'
+
+# outputs of the AFNI steps of a run other than the pipeline combinations, relative to intermediate_processed
+#   ({} is the output prefix of the run), and the diagnostics (files or folders) they write, by the start of their names
+base_outputs = ('afni_processed/{}_baseproc.nii', 'masks/{}_mask.nii', 'masks/{}_mask_nomc.nii',
+                'mpe/{}_mpe', 'mpe/{}_maxdisp')
+diagnostic_outputs = ('diagnostic/{}_smo*', 'diagnostic/{}_mc+smo*', 'diagnostic/{}_ica_nomc', 'diagnostic/{}_ica_mc',
+                      'diagnostic/{}_pca_nomc', 'diagnostic/{}_pca_mc')
+
+# files hashed simultaneously, and the size of the chunks they are read in
+num_hash_threads = 4
+hash_chunk_bytes = 4 * 1024 * 1024
+
+file_name_digests = 'file_digests.json'
+
+# versions of the tools, found once per session
+tool_version_cache = dict()
+
+
+def file_digest(path):
+    """SHA-1 of the contents of a file."""
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as content:
+        for chunk in iter(lambda: content.read(hash_chunk_bytes), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def file_digests(paths, cache_dir):
+    """
+    Digests of the contents of many files, each hashed only once for each version of the file (by mtime and size),
+        as the digests are saved in the cache.
+
+    :returns: dict of path -> digest
+    """
+
+    digests_path = os.path.join(cache_dir, file_name_digests)
+    known = dict()
+    if os.path.isfile(digests_path):
+        try:
+            with open(digests_path, 'r') as df:
+                known = json.load(df)
+        except ValueError:
+            known = dict()
+
+    digests = dict()
+    to_hash = list()
+    for path in set(paths):
+        st = os.stat(path)
+        saved = known.get(os.path.abspath(path))
+        if saved is not None and saved[0] == st.st_mtime and saved[1] == st.st_size:
+            digests[path] = saved[2]
+        else:
+            to_hash.append((path, st.st_mtime, st.st_size))
+
+    if len(to_hash) > 0:
+        pool = ThreadPool(max(1, min(num_hash_threads, len(to_hash))))
+        try:
+            hashed = pool.map(file_digest, [path for path, mtime, size in to_hash])
+        finally:
+            pool.close()
+            pool.join()
+        for (path, mtime, size), digest in zip(to_hash, hashed):
+            digests[path] = digest
+            known[os.path.abspath(path)] = [mtime, size, digest]
+
+        temp_path = '{}.{}'.format(digests_path, os.getpid())
+        with open(temp_path, 'w') as df:
+            json.dump(known, df)
+        os.rename(temp_path, digests_path)
+
+    return digests
+
+
+def run_command_output(cmd):
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(cmd, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def tool_versions(environment):
+    """Versions of OPPNI, AFNI and FSL, and the environment running the MATLAB code."""
+
+    if environment in tool_version_cache:
+        return tool_version_cache[environment]
+
+    versions = dict()
+    history = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), '_documentation',
+                           'UPDATE_HISTORY.txt')
+    try:
+        with open(history, 'r') as hf:
+            header = ''.join([hf.readline() for _ in range(3)])
+        versions['oppni'] = ' '.join(re.findall(r"^(?:VERSION|REVISION)\s*=\s*'?([^'%]+?)'?\s*(?:%.*)?$",
+                                                header, re.MULTILINE))
+    except IOError:
+        versions['oppni'] = 'unknown'
+
+    # the tools are called with their path prepended, as in the MATLAB code
+    versions['afni'] = run_command_output([os.getenv('AFNI_PATH', '') + 'afni', '-ver'])
+    fsl_version = 'unknown'
+    for fsl_dir in (os.getenv('FSLDIR'), os.path.join(os.getenv('FSL_PATH', ''), os.pardir)):
+        if fsl_dir and os.path.isfile(os.path.join(fsl_dir, 'etc', 'fslversion')):
+            with open(os.path.join(fsl_dir, 'etc', 'fslversion'), 'r') as fv:
+                fsl_version = fv.read().strip()
+            break
+    versions['fsl'] = fsl_version
+
+    if environment.lower() == 'compiled':
+        versions['environment'] = 'compiled ' + os.path.basename(os.path.normpath(os.getenv('MCR_PATH', '')))
+    else:
+        versions['environment'] = environment
+
+    tool_version_cache[environment] = versions
+
+    return versions
+
+
+def run_inputs(subject, opt):
+    """Files whose contents the preprocessing of a run depends on."""
+
+    files = [subject.nii]
+    if subject.physio is not None:
+        files.extend([subject.physio + '.puls.1D', subject.physio + '.resp.1D'])
+    if opt.BlurToFWHM == '1' and subject.task is not None:
+        # the adaptive smoothing regresses out the design
+        files.append(subject.task)
+
+    return files
+
+
+def run_key(subject, opt, digests):
+    """Key of the preprocessing of a run in the cache, along with what it is derived from."""
+
+    description = {'nii': digests[subject.nii],
+                   'drop': [int(subject.drop_beg or 0), int(subject.drop_end or 0)],
+                   'physio': None,
+                   'task': None,
+                   'DEOBLIQUE': str(opt.DEOBLIQUE),
+                   'TPATTERN': str(opt.TPATTERN),
+                   'BlurToFWHM': str(opt.BlurToFWHM),
+                   'tools': tool_versions(opt.environment)}
+    if subject.physio is not None:
+        description['physio'] = [digests[subject.physio + '.puls.1D'], digests[subject.physio + '.resp.1D']]
+    if opt.BlurToFWHM == '1' and subject.task is not None:
+        description['task'] = digests[subject.task]
+        description['contrast'] = opt.contrast_list_str
+
+    key = hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+    return key, description
+
+
+def entry_dir(cache_dir, key):
+
+    return os.path.join(cache_dir, 'entries', key[:2], key)
+
+
+def run_outputs(out_dir, sub_prefix, codes):
+    """
+    Outputs of the AFNI steps of a run, for the given pipeline combinations.
+
+    :returns: list of paths relative to intermediate_processed (folders for some diagnostics)
+    """
+
+    int_proc_dir = os.path.join(out_dir, 'intermediate_processed')
+    outputs = ['afni_processed/{}_{}.nii'.format(sub_prefix, code) for code in codes]
+    outputs.extend(pattern.format(sub_prefix) for pattern in base_outputs)
+    for pattern in diagnostic_outputs:
+        # prefixes have no wildcards (see input_records.reValue)
+        outputs.extend(os.path.relpath(path, int_proc_dir)
+                       for path in glob.glob(os.path.join(int_proc_dir, pattern.format(sub_prefix))))
+
+    return outputs
+
+
+def cached_name(rel_path, sub_prefix):
+    """Name of an output of a run in the cache, with its prefix replaced by the placeholder."""
+
+    folder, name = rel_path.split('/', 1)
+
+    return '/'.join([folder, run_placeholder + name[len(sub_prefix):]])
+
+
+def files_under(path):
+    """The file itself, or all the files in a folder."""
+
+    if not os.path.isdir(path):
+        return [path]
+
+    files = list()
+    for root, dirs, names in os.walk(path):
+        files.extend(os.path.join(root, name) for name in names)
+
+    return files
+
+
+def make_parent(path):
+
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+
+
+def link_file(src, dst):
+    """Hard links a file, or symlinks it across filesystems. Returns whether the file is linked."""
+
+    make_parent(dst)
+    try:
+        os.link(src, dst)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            return False
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        os.symlink(os.path.abspath(src), dst)
+
+    return True
+
+
+def cached_codes(entry):
+    """Pipeline combinations in an entry of the cache."""
+
+    return set(os.path.basename(path)[len(run_placeholder) + 1:-len('.nii')]
+               for path in glob.glob(os.path.join(entry, 'afni_processed', run_placeholder + '_m*.nii')))
+
+
+def is_cached(entry, codes):
+    """Whether an entry holds the given pipeline combinations, and the outputs common to them all."""
+
+    if not set(codes) <= cached_codes(entry):
+        return False
+
+    return all(os.path.exists(os.path.join(entry, pattern.format(run_placeholder))) for pattern in base_outputs)
+
+
+def link_entry(entry, out_dir, sub_prefix):
+    """Links all the outputs in an entry of the cache into the output folder of a run (those not there already)."""
+
+    int_proc_dir = os.path.join(out_dir, 'intermediate_processed')
+    num_linked = 0
+    for entry_folder in os.listdir(entry):
+        if not os.path.isdir(os.path.join(entry, entry_folder)):
+            continue
+        for src in files_under(os.path.join(entry, entry_folder)):
+            rel_path = os.path.relpath(src, entry)
+            folder, name = rel_path.split('/', 1)
+            dst = os.path.join(int_proc_dir, folder, sub_prefix + name[len(run_placeholder):])
+            if not os.path.lexists(dst) and link_file(src, dst):
+                num_linked += 1
+
+    return num_linked
+
+
+def publish(cache_dir, key, description, out_dir, sub_prefix, codes):
+    """
+    Adds the outputs of a run to the cache, once its preprocessing is done (all the combinations complete).
+        Outputs are hard linked (or copied, across filesystems), each moved into place at once so concurrent
+        readers never see partial files, and made read-only, as they are shared by the processing folders.
+
+    :returns: whether the run was added
+    """
+
+    missing, stale = check_proc_status.missing_pipeline_codes(sub_prefix, out_dir, codes)
+    int_proc_dir = os.path.join(out_dir, 'intermediate_processed')
+    outputs = run_outputs(out_dir, sub_prefix, codes)
+    if missing or stale or not all(os.path.exists(os.path.join(int_proc_dir, rel_path)) for rel_path in outputs):
+        return False
+
+    entry = entry_dir(cache_dir, key)
+    for rel_path in outputs:
+        src_root = os.path.join(int_proc_dir, rel_path)
+        for src in files_under(src_root):
+            dst = os.path.join(entry, cached_name(rel_path, sub_prefix), os.path.relpath(src, src_root))
+            dst = os.path.normpath(dst)
+            if os.path.lexists(dst):
+                continue
+            temp_dst = '{}.{}.tmp'.format(dst, os.getpid())
+            make_parent(temp_dst)
+            try:
+                os.link(os.path.realpath(src), temp_dst)
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                with open(src, 'rb') as sf, open(temp_dst, 'wb') as tf:
+                    for chunk in iter(lambda: sf.read(hash_chunk_bytes), b''):
+                        tf.write(chunk)
+            os.chmod(temp_dst, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.rename(temp_dst, dst)
+
+    with open(os.path.join(entry, 'key.json'), 'w') as kf:
+        json.dump(description, kf, indent=2, sort_keys=True)
+
+    return True
+
+
+def pending_path(cache_dir, key, out_dir, sub_prefix):
+
+    location = hashlib.sha1(os.path.join(os.path.abspath(out_dir), sub_prefix)).hexdigest()[:12]
+    return os.path.join(cache_dir, 'pending', '{}_{}.json'.format(key, location))
+
+
+def publish_pending(cache_dir):
+    """Adds to the cache the runs whose preprocessing was pending, and is now done. Returns how many were added."""
+
+    num_published = 0
+    for path in glob.glob(os.path.join(cache_dir, 'pending', '*.json')):
+        try:
+            with open(path, 'r') as pf:
+                pending = json.load(pf)
+        except (IOError, ValueError):
+            continue
+        if not os.path.isdir(pending['out']):
+            # the processing was removed
+            os.remove(path)
+        elif publish(cache_dir, pending['key'], pending['description'], pending['out'], pending['prefix'],
+                     pending['codes']):
+            os.remove(path)
+            num_published += 1
+
+    return num_published
+
+
+def reuse_cached_runs(subjects, opt, cache_dir, codes):
+    """
+    Links the outputs of the runs whose preprocessing is cached into their output folders, for the given pipeline
+        combinations, so Part 1 skips their AFNI steps. The other runs are added to the cache once preprocessed.
+
+    :returns: subject keys of the runs reused
+    """
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    num_published = publish_pending(cache_dir)
+
+    digests = file_digests([path for subject in subjects.values() for path in run_inputs(subject, opt)], cache_dir)
+
+    reused = list()
+    num_linked = 0
+    for sub_key, subject in subjects.items():
+        sub_prefix = input_records.strip_nifti_ext(subject.prefix)
+        key, description = run_key(subject, opt, digests)
+        entry = entry_dir(cache_dir, key)
+        if os.path.isdir(entry) and is_cached(entry, codes):
+            num_linked += link_entry(entry, subject.out, sub_prefix)
+            reused.append(sub_key)
+            continue
+
+        pending = pending_path(cache_dir, key, subject.out, sub_prefix)
+        make_parent(pending)
+        with open(pending, 'w') as pf:
+            json.dump({'key': key, 'description': description, 'out': os.path.abspath(subject.out),
+                       'prefix': sub_prefix, 'codes': list(codes)}, pf)
+
+    print('\tpreprocessing cache: {} of {} runs cached ({} files linked), '
+          '{} runs added from earlier processing.'.format(len(reused), len(subjects), num_linked, num_published))
+
+    return reused
+
+
+def share_cmd(source_suffix, pipeline_file):
+    """
+    Command linking the preprocessing of a run from the processing folder <OUT>/<source_suffix> of another analysis
+        (see share_run), with {0} in place of the input file of the run.
+    """
+
+    return '{} {} {{0}} {} {}'.format(sys.executable, os.path.splitext(os.path.abspath(__file__))[0] + '.py',
+                                     source_suffix, os.path.abspath(pipeline_file))
+
+
+def share_run(input_file, source_suffix, pipeline_file):
+    """
+    Links the outputs of the AFNI steps of the run in an input file from the processing folder of the analysis
+        preprocessing it (<OUT>/<source_suffix>), if all its combinations are complete there, so Part 1 skips them.
+        Otherwise the run is preprocessed anew.
+
+    :returns: number of files linked
+    """
+
+    with open(input_file, 'r') as ipf:
+        record = input_records.parse_input_line(ipf.readline())
+    sub_prefix = input_records.strip_nifti_ext(record.prefix)
+    source_out = os.path.join(os.path.dirname(os.path.normpath(record.out)), source_suffix)
+    codes = check_proc_status.afni_pipeline_codes(pipeline_file)
+
+    missing, stale = check_proc_status.missing_pipeline_codes(sub_prefix, source_out, codes)
+    if missing or stale:
+        print('preprocessing of {} in {} is incomplete - preprocessing it anew.'.format(sub_prefix, source_out))
+        return 0
+
+    source_dir = os.path.join(source_out, 'intermediate_processed')
+    int_proc_dir = os.path.join(record.out, 'intermediate_processed')
+    num_linked = 0
+    for rel_path in run_outputs(source_out, sub_prefix, codes):
+        if not os.path.exists(os.path.join(source_dir, rel_path)):
+            continue
+        for src in files_under(os.path.join(source_dir, rel_path)):
+            dst = os.path.join(int_proc_dir, os.path.relpath(src, source_dir))
+            if not os.path.lexists(dst) and link_file(os.path.realpath(src), dst):
+                num_linked += 1
+
+    print('preprocessing of {} shared from {} ({} files linked).'.format(sub_prefix, source_out, num_linked))
+
+    return num_linked
+
+
+if __name__ == '__main__':
+    # run by the jobs of Part 1 sharing the preprocessing of another analysis (see share_cmd)
+    share_run(*sys.argv[1:4])
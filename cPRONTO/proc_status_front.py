@@ -2,6 +2,8 @@
 
 import fnmatch
 import glob
+import itertools
+import json
 import os
 import re
 import sys
@@ -10,13 +12,25 @@ from cStringIO import StringIO
 
 import oppni
 import cfg_front as cfg_pronto
+import nifti_header
+from input_records import read_run_records, strip_nifti_ext
+from status_index import StatusIndex
 
 tick_mark = u'\u2713'.encode('utf-8')
 crossed = u'\u2718'.encode('utf-8')
 
-def all_files_exist_in(files):
+# names of the per-subject jobs: <step><job tag>_s<index>_<subject prefix>
+#   (Part 1 split into shards is completed by its merge job)
+reSubjectJob = re.compile(r"^(part1|merge|spnorm)([12]?)_s\d+_(.+)$")
+
+# template of the files saved by the AFNI steps for each combination of the first 5 pipeline steps
+afni_code_format = 'm{}c{}p{}t{}s{}'
+
+def all_files_exist_in(files, index=None):
+    if index is None:
+        index = StatusIndex()
     for fp in files:
-        if not os.path.isfile(fp):
+        if not index.exists(fp):
             return False
     return True
 
@@ -38,12 +52,215 @@ def count_variations_pipeline_step(pipelineFile, descr):
         return len(digits.findall(stepLine))
 
 
-def is_done_spnorm(sub_prefix, out_dir):
+def pipeline_step_choices(pipelineFile, descr):
+    """
+    Choices specified for a given pipeline step, as integers in the order listed.
+
+    :param pipelineFile: pipeline config file.
+    :param descr: string specifying the exact step, such as 'MOTCOR', 'CENSOR', 'RETROICOR', 'TIMECOR', 'SMOOTH'
+    :rtype: list
+    """
+    reStep = re.compile(descr + r"=\[([\d,]+)\]", re.DOTALL)
+    with open(pipelineFile, 'r') as pipID:
+        stepLine = reStep.search(pipID.read()).group(1)
+        return [int(choice) for choice in re.findall(r'\d+', stepLine)]
+
+
+def selected_pipelines(pipelineFile):
+    """
+    Pipeline combinations listed by a pipeline file limited to some of the combinations of its steps
+        (SELECTED=[...;...], written by select_pipelines.m), each as the list of its choices in the order of
+        the pipelines in the stats of Part 1. None if all the combinations are processed.
+    """
+    reSelected = re.compile(r"SELECTED=\[([\d,;\s]*)\]", re.DOTALL)
+    with open(pipelineFile, 'r') as pipID:
+        found = reSelected.search(pipID.read())
+    if found is None:
+        return None
+    return [[int(choice) for choice in re.findall(r'\d+', row)] for row in found.group(1).split(';') if row.strip()]
+
+
+def afni_pipeline_codes(pipelineFile):
+    """
+    Codes of all the combinations of the first 5 pipeline steps (like m0c0p0t0s6),
+        each of which is saved by the AFNI steps as <prefix>_<code>.nii in afni_processed.
+        Only those of the combinations selected are preprocessed, when the pipeline file lists them.
+    """
+
+    choices = [pipeline_step_choices(pipelineFile, flag) for flag in cfg_pronto.CODES_PREPROCESSING_STEPS[0:5]]
+    combinations = list(itertools.product(*choices))
+    selected = selected_pipelines(pipelineFile)
+    if selected is not None:
+        selected_afni = set(tuple(row[0:5]) for row in selected)
+        combinations = [combination for combination in combinations if combination in selected_afni]
+    return [afni_code_format.format(*combination) for combination in combinations]
+
+
+def nifti_data_end(nii_path):
+    """
+    Size a NIfTI-1/2 file must have to hold all the data declared in its header (None if it can't be read).
+    """
+
+    header, reason = nifti_header.try_read_header(nii_path)
+    if header is None:
+        return None
+
+    return nifti_header.data_end(header)
+
+
+def missing_pipeline_codes(subPrefix, outFolder, pipelineCodes, index=None):
+    """
+    Finds the pipeline combinations whose AFNI-preprocessed file is missing or stale for a subject.
+        A file is stale when it is empty, or shorter than the data declared in its header
+        (e.g. its job was killed while writing it). All the files of a subject have the same dimensions,
+        hence only those smaller than the largest one are read to be sure.
+
+    :param subPrefix:
+    :param outFolder:
+    :param pipelineCodes: codes of all the combinations expected, from afni_pipeline_codes
+    :param index: StatusIndex of the output folders, to avoid listing them again
+    :return: codes of the missing files, and codes of the stale files
+    :rtype: list, list
+    """
+
+    if index is None:
+        index = StatusIndex()
+
+    afniFolder = os.path.join(outFolder, 'intermediate_processed', 'afni_processed')
+    code_path = lambda code: os.path.join(afniFolder, '{}_{}.nii'.format(subPrefix, code))
+
+    sizes = dict((code, index.size(code_path(code))) for code in pipelineCodes)
+    missing = [code for code in pipelineCodes if sizes[code] is None]
+
+    largest = max([0] + [size for size in sizes.values() if size is not None])
+    stale = list()
+    for code in pipelineCodes:
+        if sizes[code] is None or sizes[code] >= largest > 0:
+            continue
+        # sizes in the index date from when the files were first seen - checking the file itself
+        data_end = nifti_data_end(code_path(code))
+        if data_end is None or os.path.getsize(code_path(code)) < data_end:
+            stale.append(code)
+
+    return missing, stale
+
+
+def resubmit_pipelines_file(resubmit_part1_file):
+    """Path to the pipeline combinations to redo for each subject listed in the resubmission list of Part 1."""
+
+    return os.path.splitext(resubmit_part1_file)[0] + '-pipelines.json'
+
+
+def read_sentinels(sentinel_dir):
+    """
+    Reads the completion sentinels written by the per-subject jobs, keeping the latest for each subject and step.
+        A sentinel without an exit code belongs to a job still running, or killed before it could finish.
+
+    :param sentinel_dir: folder containing the <job name>.json sentinels
+    :return: latest sentinels of preprocessing and spatial normalization, keyed by subject prefix.
+        None, if the jobs did not write sentinels (processed with older versions of OPPNI)
+    :rtype: dict
+    """
+
+    if sentinel_dir is None or not os.path.isdir(sentinel_dir):
+        return None
+
+    sentinels = {'part1': dict(), 'spnorm': dict()}
+    for sentinel_file in glob.glob(os.path.join(sentinel_dir, '*.json')):
+        try:
+            with open(sentinel_file, 'r') as snf:
+                record = json.load(snf)
+        except (IOError, ValueError):
+            # sentinels are replaced atomically, so this must be debris
+            continue
+
+        job_name = reSubjectJob.match(record.get('job', ''))
+        # step 1 of spatial normalization (--dospnormfirst) doesn't complete it
+        if job_name is None or job_name.group(2) == '1':
+            continue
+
+        step, subject_prefix = job_name.group(1), strip_nifti_ext(job_name.group(3))
+        if step == 'merge':
+            step = 'part1'
+        prev_record = sentinels[step].get(subject_prefix)
+        if prev_record is None or record.get('finished', '') >= prev_record.get('finished', ''):
+            sentinels[step][subject_prefix] = record
+
+    return sentinels
+
+
+def is_done_by_sentinel(record, label):
+    """Completeness of a step as per the sentinel written by its job, with a message to print like is_done_*."""
+
+    if record.get('exit_code') == 0:
+        return True , " {} : Done.      {}".format(label, tick_mark)
+    elif record.get('exit_code') is None:
+        return False, " {} : Incomplete {}".format(label, crossed)
+    else:
+        return False, " {} : Failed.    {}".format(label, crossed)
+
+
+def expected_outputs(step_id, sub_prefix, out_dir):
+    """
+    Key outputs of a step (for a given subject, in per-subject steps), whose sizes are recorded in its sentinel.
+    """
+
+    step_id = step_id.upper()
+    if step_id in ('PART1', 'MERGE'):
+        return part1_afni_outputs(sub_prefix, out_dir) + part1_stats_outputs(sub_prefix, out_dir)
+    elif step_id == 'SPNORM':
+        return spnorm_outputs(sub_prefix, out_dir)
+    elif step_id == 'PART2SEL':
+        return [os.path.join(out_dir, 'optimization_results', 'matfiles', 'optimization_selection.mat')]
+    elif step_id == 'PART2':
+        return [os.path.join(out_dir, 'optimization_results', 'matfiles', 'optimization_summary.mat')]
+    elif step_id == 'QC1':
+        return [os.path.join(out_dir, 'QC1_results', 'output_qc1.mat')]
+    elif step_id == 'QC2':
+        return [os.path.join(out_dir, 'QC2_results', 'output_qc2.mat')]
+    else:
+        return list()
+
+
+def checkpoint_folders(out_dir):
+    """
+    Lists the folders holding the files checked for the completeness of processing in out_dir,
+        so they can be listed all at once, before checking the subjects.
+    """
+
+    intProcFolder = os.path.join(out_dir, 'intermediate_processed')
+    intMetricFolder = os.path.join(out_dir, 'intermediate_metrics')
+    optim_dir = os.path.join(out_dir, 'optimization_results')
+
+    folders = [os.path.join(intProcFolder, sub_dir) for sub_dir in ('afni_processed', 'diagnostic', 'mpe', 'spat_norm')]
+    folders.extend([os.path.join(intMetricFolder, sub_dir)
+                    for sub_dir in ('res0_params', 'res1_spms', 'res2_temp', 'res3_stats')])
+    folders.extend([os.path.join(optim_dir, sub_dir) for sub_dir in ('spms', 'processed', 'matfiles')])
+
+    return folders
+
+
+def spnorm_outputs(sub_prefix, out_dir):
+
+    intProcFolder = os.path.join(out_dir, 'intermediate_processed')
+    optim_dir = os.path.join(out_dir, 'optimization_results')
+
+    must_exist_list = list()
+    must_exist_list.append(os.path.join(intProcFolder, 'spat_norm', 'Transmat_EPItoREF_'+ sub_prefix + '.mat'))
+    must_exist_list.append(os.path.join(optim_dir, 'spms', 'rSPM_' + sub_prefix + '_CON_FIX_IND_sNorm.nii'))
+    for scheme in cfg_pronto.CODES_OPTIM_SCHEMES:
+        must_exist_list.append(os.path.join(optim_dir, 'processed', 'Proc_' + sub_prefix + '_' + scheme + '_sNorm.nii'))
+
+    return must_exist_list
+
+
+def is_done_spnorm(sub_prefix, out_dir, index=None):
     """
     Checks for the completeness of processing, according to the documentation provided in Pipeline_Part1.m
 
     :param sub_prefix:
     :param out_dir:
+    :param index: StatusIndex of the output folders, to avoid listing them again
     :return:
     :rtype: bool, str
     """
@@ -61,43 +278,43 @@ def is_done_spnorm(sub_prefix, out_dir):
     #
     # These are the essential final outputs needed to go forward with group masking, QC, etc.
 
-    intProcFolder = os.path.join(out_dir, 'intermediate_processed')
-    optim_dir = os.path.join(out_dir, 'optimization_results')
-
-    must_exist_list = list()
-    must_exist_list.append(os.path.join(intProcFolder, 'spat_norm', 'Transmat_EPItoREF_'+ sub_prefix + '.mat'))
-    must_exist_list.append(os.path.join(optim_dir, 'spms', 'rSPM_' + sub_prefix + '_CON_FIX_IND_sNorm.nii'))
-    for scheme in cfg_pronto.CODES_OPTIM_SCHEMES:
-        must_exist_list.append(os.path.join(optim_dir, 'processed', 'Proc_' + sub_prefix + '_' + scheme + '_sNorm.nii'))
-
-    exist_bool = map(os.path.exists, must_exist_list)
-    if not all(exist_bool):
+    if not all_files_exist_in(spnorm_outputs(sub_prefix, out_dir), index):
         return False, " spat. norm : Incomplete " + crossed
     else:
         return True , " spat. norm : Done.      " + tick_mark
 
 
-def is_done_part1_afni(subPrefix, outFolder, numPipelineSteps):
+def part1_afni_outputs(subPrefix, outFolder):
+
+    intProcFolder = os.path.join(outFolder, 'intermediate_processed')
+
+    file1 = os.path.join(intProcFolder, 'diagnostic', subPrefix + '_mc+smo_QC_output.mat')
+    file2 = os.path.join(intProcFolder, 'mpe', subPrefix + '_mpe')
+    file3 = os.path.join(intProcFolder, 'mpe', subPrefix + '_maxdisp')
+    file4 = os.path.join(intProcFolder, 'afni_processed', subPrefix + '_baseproc.nii')
+
+    return [file1, file2, file3, file4]
+
+
+def is_done_part1_afni(subPrefix, outFolder, numPipelineSteps, index=None):
     """
     Checks for the completeness of processing, according to the documentation provided in Pipeline_Part1.m
 
     :param subPrefix:
     :param outFolder:
     :param numPipelineSteps:
+    :param index: StatusIndex of the output folders, to avoid listing them again
     :return:
     :rtype: bool
     """
-    intProcFolder = os.path.join(outFolder, 'intermediate_processed')
-    afniFolder = os.path.join(intProcFolder, 'afni_processed')
+    afniFolder = os.path.join(outFolder, 'intermediate_processed', 'afni_processed')
+    mustExistList = part1_afni_outputs(subPrefix, outFolder)
 
-    file1 = os.path.join(intProcFolder, 'diagnostic', subPrefix + '_mc+smo_QC_output.mat')
-    file2 = os.path.join(intProcFolder, 'mpe', subPrefix + '_mpe')
-    file3 = os.path.join(intProcFolder, 'mpe', subPrefix + '_maxdisp')
-    file4 = os.path.join(intProcFolder, 'afni_processed', subPrefix + '_baseproc.nii')
-    mustExistList = (file1, file2, file3, file4)
+    if index is None:
+        index = StatusIndex()
 
     # everything starts with MOTCOR, like session1_ID2382_run3_m0c0p0t0s6.nii
-    fileList = glob.glob(os.path.join(afniFolder, subPrefix + '_m*.nii'))
+    fileList = index.glob(afniFolder, subPrefix + '_m*.nii')
     fileList = set(fileList) - set(fnmatch.filter(fileList, '*baseproc*'))
     if len(fileList) != numPipelineSteps:
         # print "unequal AFNI steps - expected : ", numPipelineSteps, " actual: ", len(fileList)
@@ -105,30 +322,35 @@ def is_done_part1_afni(subPrefix, outFolder, numPipelineSteps):
     else:
         PipelineStepsComplete = True
 
-    if (not PipelineStepsComplete) or (not all_files_exist_in(mustExistList)):
+    if (not PipelineStepsComplete) or (not all_files_exist_in(mustExistList, index)):
         return False, " preproc : Incomplete " + crossed
     else:
         return True , " preproc : Done.      " + tick_mark
 
 
-def is_done_part1_stats(subPrefix, outFolder):
+def part1_stats_outputs(subPrefix, outFolder):
+
+    intMetricFolder = os.path.join(outFolder, 'intermediate_metrics')
+    param_file1 = os.path.join(intMetricFolder, 'res0_params', 'params_' + subPrefix + '.mat')
+    metricFile1 = os.path.join(intMetricFolder, 'res1_spms'  , 'spms_'   + subPrefix + '.mat')
+    metricFile2 = os.path.join(intMetricFolder, 'res2_temp'  , 'temp_'   + subPrefix + '.mat')
+    metricFile3 = os.path.join(intMetricFolder, 'res3_stats' , 'stats_'  + subPrefix + '.mat')
+
+    return [param_file1, metricFile1, metricFile2, metricFile3]
+
+
+def is_done_part1_stats(subPrefix, outFolder, index=None):
     """
     Checks for the completeness of processing in the fixed part of Part 1,
         according to the documentation provided in Pipeline_Part1.m
 
     :param subPrefix:
     :param outFolder:
+    :param index: StatusIndex of the output folders, to avoid listing them again
     :return:
     :rtype: bool
     """
-    intMetricFolder = os.path.join(outFolder, 'intermediate_metrics')
-    param_file1 = os.path.join(intMetricFolder, 'res0_params', 'params_' + subPrefix + '.mat')
-    metricFile1 = os.path.join(intMetricFolder, 'res1_spms'  , 'spms_'   + subPrefix + '.mat')
-    metricFile2 = os.path.join(intMetricFolder, 'res2_temp'  , 'temp_'   + subPrefix + '.mat')
-    metricFile3 = os.path.join(intMetricFolder, 'res3_stats' , 'stats_'  + subPrefix + '.mat')
-
-    mustExistList = (param_file1, metricFile1, metricFile2, metricFile3)
-    if not all_files_exist_in(mustExistList):
+    if not all_files_exist_in(part1_stats_outputs(subPrefix, outFolder), index):
         return False, " Metrics : Incomplete " + crossed
     else:
         return True , " Metrics : Done.      " + tick_mark
@@ -193,13 +415,14 @@ def is_done_QC_part_two(out_dir):
         return False
 
 
-def is_done_part_two_opt_summary(out_dir):
+def is_done_part_two_opt_summary(out_dir, index=None):
     """
     Checks for the completeness of processing in optimization (Part 2),
         according to the documentation provided in Pipeline_Part2.m.
         This is rather a loose check - only looking for final optimization_summary.mat.
 
     :param out_dir:
+    :param index: StatusIndex of the output folders, to avoid listing them again
     :rtype: bool
     """
 
@@ -207,7 +430,7 @@ def is_done_part_two_opt_summary(out_dir):
     file1 = os.path.join(optim_dir, 'matfiles', 'optimization_summary.mat')
     mustExistList = (file1,)
 
-    if not all_files_exist_in(mustExistList):
+    if not all_files_exist_in(mustExistList, index):
         #print "P2 : Optim. summary : Incomplete "
         return False
     else:
@@ -240,6 +463,19 @@ def parse_args_check(input_args):
     parser.add_argument("-q", "--not_verbose", dest="not_verbose",
                         action="store_true", default=False,
                         help="Removes the text output to screen.")
+    parser.add_argument("-x", "--status_index", dest="status_index",
+                        action="store", default=None,
+                        help="File to save the listings of output folders in, so the next check "
+                             "lists only the folders changed since.")
+    parser.add_argument("-e", "--sentinel_dir", dest="sentinel_dir",
+                        action="store", default=None,
+                        help="Folder with the completion sentinels written by the jobs. When present, the subjects "
+                             "whose jobs failed or were killed are reported as such, without checking their outputs. "
+                             "The outputs of the other subjects are checked as usual.")
+    parser.add_argument("-p", "--pilot_runs", dest="pilot_runs",
+                        action="store", default=None,
+                        help="Input file of the pilot runs the pipelines were selected on, "
+                             "which are reported apart from the rest.")
 
     try:
         args = parser.parse_args(input_args)
@@ -253,7 +489,7 @@ def parse_args_check(input_args):
     pipFile = os.path.abspath(args.PipelineFile)
     assert os.path.exists(pipFile), "Pipeline file doesn't exist!"
 
-    return inputFile, pipFile, args.not_verbose
+    return inputFile, pipFile, args.not_verbose, args.sentinel_dir, args.status_index, args.pilot_runs
 
 
 def run(input_args):
@@ -267,16 +503,20 @@ def run(input_args):
     old_stdout = sys.stdout
     sys.stdout = my_stdout = StringIO()
 
-    inputFile, pipFile, not_verbose = parse_args_check(input_args)
+    inputFile, pipFile, not_verbose, sentinel_dir, status_index_path, pilot_runs = parse_args_check(input_args)
+    sentinels = read_sentinels(sentinel_dir)
+    index = StatusIndex(status_index_path)
+    pilot_prefixes = set()
+    if pilot_runs is not None:
+        pilot_prefixes = set(strip_nifti_ext(record.prefix) for record in read_run_records(pilot_runs)
+                             if record.prefix is not None)
 
     proc_status = cfg_pronto.initialize_proc_status()
 
-    # estimating the number of pipeline steps needed for
-    numPipelineSteps = 1
     # "MOTCOR", "CENSOR", "RETROICOR", "TIMECOR", "SMOOTH"
-    # only the combinations for the first 5 steps need to be multiplied
-    for flag in cfg_pronto.CODES_PREPROCESSING_STEPS[0:5]:
-        numPipelineSteps *= count_variations_pipeline_step(pipFile, flag)
+    # only the combinations for the first 5 steps are saved as separate files
+    pipelineCodes = afni_pipeline_codes(pipFile)
+    numPipelineSteps = len(pipelineCodes)
 
     outFolderStatus = os.path.dirname(inputFile)
     name_suffix = os.path.splitext(os.path.basename(inputFile))[0]
@@ -299,57 +539,88 @@ def run(input_args):
     failed_count_preproc = 0
     failed_count_stats = 0
     failed_count_spnorm = 0
-
-    # # regex to extract the relevant parts of the input file
-    reOut = re.compile(r"OUT=([\w\./+_-]+)[\s]*")
+    # failures among the pilot runs, if any
+    failed_pilot_preproc = 0
+    failed_pilot_spnorm = 0
+    # pipeline combinations to redo in the resubmission, by subject
+    pipelines_to_redo = dict()
 
     try:
 
-        # TODO reimplement this using front.validate_input_file to parse and iterative over subjects in input file
         common_out_dir = ' '
-        with open(inputFile, 'r') as fID:
-            for inputLine in fID.readlines():
-                num_subjects += 1
-
-                out_results = reOut.search(inputLine)
-                if out_results is not None:
-                    outFolderSpec = out_results.group(1)
-                else:
-                    print 'Either OUT= not specifed or contains an invalid path that can not be parsed.'
-                    print 'Only Alphanumeric, underscore (_), hyphen (-) and plus (+) characters are allowed. skipping this line {}'.format(num_subjects)
-                    continue
-
-                # sometimes the output prefixes are specified with .nii extention
-                # stripping it off (like PRONTO does internally)
-                outFolderSpec, tmp_ext = os.path.splitext(outFolderSpec)
-                subjectPrefix = os.path.basename(outFolderSpec)
-                subjectPrefix, tmp_ext = os.path.splitext(subjectPrefix)
-
-                out_dir = os.path.dirname(outFolderSpec)
-                if num_subjects == 1:
-                    # pronto saves the optimization results in the output folder specified for the first subject
-                    common_out_dir = out_dir
-
-                part1_preproc_done, msg1 = is_done_part1_afni(subjectPrefix, out_dir, numPipelineSteps)
-                part1_stats_done  , msg2 = is_done_part1_stats(subjectPrefix, out_dir)
-
-                spnorm_done, msg3 = is_done_spnorm(subjectPrefix, out_dir)
-
-                print('{:>15}:  {} \t {} \t {}'.format(subjectPrefix, msg1, msg2, msg3))
-
-                if not part1_preproc_done or not part1_stats_done:
-                    failed_count_preproc += 1
-                    failed_count_stats += 1
-                    if writable:
-                        resub_part1.write(inputLine)
-
-                if not spnorm_done:
-                    failed_count_spnorm += 1
-                    if writable:
-                        resub_spnorm.write(inputLine)
+
+        # listing the output folders of all the subjects together, in parallel
+        out_dirs = set([record.out for record in read_run_records(inputFile) if record.out is not None])
+        index.refresh([folder for out_dir in out_dirs for folder in checkpoint_folders(out_dir)])
+
+        for record in read_run_records(inputFile):
+            num_subjects += 1
+            inputLine = record.line
+
+            if record.out is None:
+                print 'Either OUT= not specifed or contains an invalid path that can not be parsed.'
+                print 'Only Alphanumeric, underscore (_), hyphen (-) and plus (+) characters are allowed. skipping this line {}'.format(num_subjects)
+                continue
+
+            # sometimes the output prefixes are specified with .nii extention
+            # stripping it off (like PRONTO does internally)
+            subjectPrefix = strip_nifti_ext(record.prefix)
+
+            out_dir = record.out
+            if num_subjects == 1:
+                # pronto saves the optimization results in the output folder specified for the first subject
+                common_out_dir = out_dir
+
+            # outputs left behind by jobs killed or failed midway can not be trusted,
+            #   whereas those of the jobs completed (or without a sentinel) are checked, in case they were removed since
+            part1_sentinel = sentinels['part1'].get(subjectPrefix) if sentinels is not None else None
+            spnorm_sentinel = sentinels['spnorm'].get(subjectPrefix) if sentinels is not None else None
+
+            if part1_sentinel is not None and part1_sentinel.get('exit_code') != 0:
+                part1_preproc_done, msg1 = is_done_by_sentinel(part1_sentinel, 'preproc')
+                part1_stats_done  , msg2 = is_done_by_sentinel(part1_sentinel, 'Metrics')
+                # combinations are checked only for the subjects to resubmit
+                missing_stale = None
+            else:
+                part1_preproc_done, msg1 = is_done_part1_afni(subjectPrefix, out_dir, numPipelineSteps, index)
+                missing_stale = missing_pipeline_codes(subjectPrefix, out_dir, pipelineCodes, index)
+                if part1_preproc_done and len(missing_stale[1]) > 0:
+                    # files truncated by killed jobs still count as present above
+                    part1_preproc_done, msg1 = False, " preproc : Incomplete " + crossed
+                part1_stats_done  , msg2 = is_done_part1_stats(subjectPrefix, out_dir, index)
+
+            if spnorm_sentinel is not None and spnorm_sentinel.get('exit_code') != 0:
+                spnorm_done, msg3 = is_done_by_sentinel(spnorm_sentinel, 'spat. norm')
+            else:
+                spnorm_done, msg3 = is_done_spnorm(subjectPrefix, out_dir, index)
+
+            is_pilot = subjectPrefix in pilot_prefixes
+            print('{:>15}:  {} \t {} \t {}{}'.format(subjectPrefix, msg1, msg2, msg3, '   (pilot)' if is_pilot else ''))
+
+            if not part1_preproc_done or not part1_stats_done:
+                failed_count_preproc += 1
+                failed_count_stats += 1
+                failed_pilot_preproc += is_pilot
+                if missing_stale is None:
+                    missing_stale = missing_pipeline_codes(subjectPrefix, out_dir, pipelineCodes, index)
+                missing, stale = missing_stale
+                if len(missing) + len(stale) > 0:
+                    print('{:>15}   pipelines missing: {}, stale: {} (of {})'.format(' ', len(missing), len(stale),
+                                                                                  numPipelineSteps))
+                if writable:
+                    resub_part1.write(inputLine)
+                    pipelines_to_redo[subjectPrefix] = {'missing': missing, 'stale': stale, 'pilot': is_pilot}
+
+            if not spnorm_done:
+                failed_count_spnorm += 1
+                failed_pilot_spnorm += is_pilot
+                if writable:
+                    resub_spnorm.write(inputLine)
 
         # print out summary
         print "\nSummary: \n# subjects: ", num_subjects
+        if len(pilot_prefixes) > 0:
+            print "# pilot runs the pipelines were selected on: ", len(pilot_prefixes)
         # part 1
         if failed_count_preproc == 0:
             proc_status.preprocessing = True
@@ -367,10 +638,13 @@ def run(input_args):
             proc_status.rem_input_file = resubmit_part1_file
             print "P1 : incomplete \t  # subjects/runs failed: {} / {} ({:.0f}%)".format(
                 failed_count_preproc, num_subjects, (100 * failed_count_preproc / num_subjects))
+            if len(pilot_prefixes) > 0:
+                print "\t pilot runs failed: {}, other runs failed: {}".format(
+                    failed_pilot_preproc, failed_count_preproc - failed_pilot_preproc)
             print "\t resubmit list : ", resubmit_part1_file
 
         # part 2
-        proc_status.optimization = (failed_count_stats == 0) and is_done_part_two_opt_summary(common_out_dir)
+        proc_status.optimization = (failed_count_stats == 0) and is_done_part_two_opt_summary(common_out_dir, index)
         if not proc_status.optimization:
             print "P2 : Incomplete \n\t # sbujects whose stats need to be computed: {}".format(failed_count_stats)
         else:
@@ -391,6 +665,9 @@ def run(input_args):
             proc_status.rem_spnorm_file = resubmit_spnorm_file
             print "SPNORM : incomplete \t  # subjects/runs failed: {} / {} ({:.0f}%)".format(
                 failed_count_spnorm, num_subjects, (100 * failed_count_spnorm / num_subjects))
+            if len(pilot_prefixes) > 0:
+                print "\t pilot runs failed: {}, other runs failed: {}".format(
+                    failed_pilot_spnorm, failed_count_spnorm - failed_pilot_spnorm)
             print "\t resubmit list : ", resubmit_spnorm_file
 
         # QC
@@ -400,6 +677,13 @@ def run(input_args):
         if writable:
             resub_spnorm.close()
             resub_part1.close()
+            if failed_count_preproc > 0:
+                with open(resubmit_pipelines_file(resubmit_part1_file), 'w') as pipes:
+                    json.dump(pipelines_to_redo, pipes)
+
+        print('\nFolders listed: {} (listings reused from the status index: {})'.format(index.num_listed,
+                                                                                     index.num_cached))
+        index.save()
 
     except Exception as e:
         print "following exception occurred: \n{}".format(e)
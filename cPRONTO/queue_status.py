@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# Bulk queries of the scheduler for the state of the jobs submitted by OPPNI, in a single round trip per status check.
+
+import getpass
+import json
+import os
+import re
+import subprocess
+import xml.etree.ElementTree as ElementTree
+from collections import OrderedDict
+
+import cfg_front as cfg_pronto
+
+# states the jobs are reported in, in the order they are printed:
+#   held includes jobs waiting on their dependencies, error the jobs stuck in the queue that will never run
+#   (along with all the jobs depending on them), and finished the jobs that left the queue, when the scheduler
+#   keeps no record of how they ended
+JOB_STATES = ('queued', 'held', 'running', 'error', 'done', 'failed', 'finished', 'unknown')
+
+# SGE states (combinations of letters), by the letter deciding the state each is reported as, in order of precedence
+sge_state_letters = (('E', 'error'), ('d', 'failed'), ('h', 'held'), ('s', 'held'), ('S', 'held'), ('T', 'held'),
+                     ('r', 'running'), ('t', 'running'), ('q', 'queued'))
+
+# PBS/TORQUE states, and the state each is reported as
+pbs_states = {'Q': 'queued', 'T': 'queued', 'W': 'queued', 'M': 'queued',
+              'H': 'held', 'S': 'held', 'U': 'held',
+              'R': 'running', 'E': 'running', 'B': 'running',
+              'F': 'finished', 'X': 'finished', 'C': 'finished'}
+
+# SLURM states, and the state each is reported as
+slurm_states = {'PENDING': 'queued', 'CONFIGURING': 'queued', 'REQUEUED': 'queued', 'RESIZING': 'queued',
+                'RUNNING': 'running', 'COMPLETING': 'running', 'SIGNALING': 'running', 'STAGE_OUT': 'running',
+                'SUSPENDED': 'held', 'STOPPED': 'held', 'REQUEUE_HOLD': 'held', 'SPECIAL_EXIT': 'held',
+                'COMPLETED': 'done',
+                'FAILED': 'failed', 'CANCELLED': 'failed', 'TIMEOUT': 'failed', 'NODE_FAIL': 'failed',
+                'OUT_OF_MEMORY': 'failed', 'PREEMPTED': 'failed', 'BOOT_FAIL': 'failed', 'DEADLINE': 'failed'}
+
+# reasons SLURM gives for pending jobs that are held, rather than waiting for resources or dependencies
+slurm_held_reasons = ('JobHeldUser', 'JobHeldAdmin')
+# and those of pending jobs that will never run
+slurm_error_reasons = ('DependencyNeverSatisfied', 'launch_failed_requeued_held', 'BadConstraints')
+
+
+def run_query(cmd):
+    """Output of a query to the scheduler, or None if it could not be run (e.g. not on a node of the cluster)."""
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(cmd, stderr=devnull, close_fds=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def base_job_id(job_id):
+    """Id of the job a task of an array job belongs to (<job id>_<task> in SLURM)."""
+
+    return job_id.split('_')[0]
+
+
+def pbs_job_id(job_id):
+    """
+    Id of a PBS/TORQUE job without the server, as it may or may not be reported with it.
+        Tasks of array jobs (<id>[<task>]) are mapped to their array (<id>[]).
+    """
+
+    return re.sub(r'\[\d*\]', '[]', job_id.strip().split('.')[0])
+
+
+def count_sge_tasks(tasks):
+    """Number of tasks of an array job in a range reported by SGE, such as 1-10:1 or 3,5-7:1 (1 if not an array)."""
+
+    if not tasks:
+        return 1
+
+    count = 0
+    for task_range in tasks.split(','):
+        match = re.match(r'^(\d+)(?:-(\d+)(?::(\d+))?)?$', task_range.strip())
+        if match is None:
+            count += 1
+            continue
+        first, last, step = match.groups()
+        count += len(range(int(first), int(last or first) + 1, int(step or 1)))
+
+    return count
+
+
+def sge_state(state):
+    """State an SGE job is reported as, e.g. error for Eqw and held for hqw (waiting on dependencies)."""
+
+    for letter, reported in sge_state_letters:
+        if letter in state:
+            return reported
+
+    return 'unknown'
+
+
+def sge_job_states(job_ids):
+    """
+    States of the given SGE jobs, from a single qstat -xml of the jobs of the user.
+        Jobs that left the queue are not reported (qacct is too slow to query in bulk).
+
+    :returns: dict of job id -> list of states (one per task, for array jobs). None if qstat could not be run.
+    """
+
+    commands = cfg_pronto.SCHEDULER_COMMANDS['SGE']
+    job_ids = set(str(jid) for jid in job_ids)
+
+    queue = run_query([commands['queue'], '-xml', '-u', getpass.getuser()])
+    if queue is None:
+        return None
+    try:
+        root = ElementTree.fromstring(queue)
+    except ElementTree.ParseError:
+        return None
+
+    states = dict()
+    # running jobs are listed under queue_info, and pending ones under job_info
+    for job in root.iter('job_list'):
+        job_id = (job.findtext('JB_job_number') or '').strip()
+        if job_id not in job_ids:
+            continue
+        state = sge_state(job.findtext('state') or '')
+        # running tasks are listed one by one, and pending ones as a range
+        num_tasks = count_sge_tasks((job.findtext('tasks') or '').strip())
+        states.setdefault(job_id, list()).extend([state] * num_tasks)
+
+    return states
+
+
+def pbs_job_states(job_ids):
+    """
+    States of the given PBS Pro jobs, from a single qstat -f -F json.
+        Array jobs are reported as a whole, running while any of their tasks runs.
+
+    :returns: dict of job id -> list of states. None if qstat could not be run.
+    """
+
+    commands = cfg_pronto.SCHEDULER_COMMANDS['PBS']
+    ids_by_pbs_id = dict((pbs_job_id(str(jid)), str(jid)) for jid in job_ids)
+
+    queue = run_query([commands['queue'], '-f', '-F', 'json'])
+    if queue is None:
+        return None
+    try:
+        jobs = json.loads(queue).get('Jobs', dict())
+    except ValueError:
+        return None
+
+    states = dict()
+    for job_id, job in jobs.items():
+        saved_id = ids_by_pbs_id.get(pbs_job_id(job_id))
+        if saved_id is None:
+            continue
+        states.setdefault(saved_id, list()).append(pbs_states.get(job.get('job_state'), 'unknown'))
+
+    return states
+
+
+def torque_job_states(job_ids):
+    """
+    States of the given TORQUE jobs, from a single qstat -x of the jobs of the user (TORQUE has no JSON output).
+        Completed jobs are listed until the server purges them.
+
+    :returns: dict of job id -> list of states (one per task, for array jobs). None if qstat could not be run.
+    """
+
+    commands = cfg_pronto.SCHEDULER_COMMANDS['TORQUE']
+    ids_by_pbs_id = dict((pbs_job_id(str(jid)), str(jid)) for jid in job_ids)
+
+    queue = run_query([commands['queue'], '-x', '-t', '-u', getpass.getuser()])
+    if queue is None:
+        return None
+    if not queue.strip():
+        # nothing in the queue
+        return dict()
+    try:
+        root = ElementTree.fromstring(queue)
+    except ElementTree.ParseError:
+        return None
+
+    states = dict()
+    for job in root.iter('Job'):
+        saved_id = ids_by_pbs_id.get(pbs_job_id(job.findtext('Job_Id') or ''))
+        if saved_id is None:
+            continue
+        state = pbs_states.get((job.findtext('job_state') or '').strip(), 'unknown')
+        if state == 'finished' and (job.findtext('exit_status') or '').strip() not in ('', '0'):
+            state = 'failed'
+        states.setdefault(saved_id, list()).append(state)
+
+    return states
+
+
+def slurm_job_states(job_ids):
+    """
+    States of the given SLURM jobs: a single squeue of the jobs of the user for those in the queue,
+        and a single sacct for those that left it.
+
+    :returns: dict of job id -> list of states (one per task, for array jobs). None if squeue could not be run.
+    """
+
+    commands = cfg_pronto.SCHEDULER_COMMANDS['SLURM']
+    job_ids = set(str(jid) for jid in job_ids)
+
+    # one line per task of array jobs, even for pending tasks listed as a range by default
+    queue = run_query([commands['queue'], '--noheader', '--array', '--user', getpass.getuser(),
+                       '--format=%i|%T|%r'])
+    if queue is None:
+        return None
+
+    states = dict()
+    for line in queue.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) < 3 or base_job_id(fields[0]) not in job_ids:
+            continue
+        state = slurm_states.get(fields[1], 'unknown')
+        if state == 'queued' and fields[2] in slurm_held_reasons:
+            state = 'held'
+        elif state == 'queued' and fields[2] in slurm_error_reasons:
+            state = 'error'
+        states.setdefault(base_job_id(fields[0]), list()).append(state)
+
+    finished = sorted(job_ids - set(states.keys()))
+    if finished and commands['accounting'] is not None:
+        # allocations only (-X), without their job steps
+        accounting = run_query([commands['accounting'], '--noheader', '--parsable2', '--allocations',
+                                '--format=JobID,State', '--jobs', ','.join(finished)])
+        for line in (accounting or '').splitlines():
+            fields = line.strip().split('|')
+            if len(fields) < 2 or base_job_id(fields[0]) not in job_ids:
+                continue
+            # e.g. CANCELLED by 1234
+            state = slurm_states.get(fields[1].split(' ')[0], 'unknown')
+            states.setdefault(base_job_id(fields[0]), list()).append(state)
+
+    return states
+
+
+def job_states(hpc_family, job_ids):
+    """
+    States of the given jobs, from a single query of the scheduler (and its accounting, if needed).
+
+    :returns: dict of job id -> list of states. None if the scheduler could not be queried.
+        Jobs not in the result left the queue (or were never submitted).
+    """
+
+    if hpc_family == 'SGE':
+        return sge_job_states(job_ids)
+    elif hpc_family == 'PBS':
+        return pbs_job_states(job_ids)
+    elif hpc_family == 'TORQUE':
+        return torque_job_states(job_ids)
+    elif hpc_family == 'SLURM':
+        return slurm_job_states(job_ids)
+
+    return None
+
+
+def summarize_by_step(job_ids_grouped, states):
+    """
+    Counts the jobs of each step in each state, joining the states with the ids saved in each step.
+        Jobs processing several subjects (bundles and arrays) are counted once (or once per task, for arrays).
+        Jobs unknown to the scheduler have finished: what became of them is for the outputs to tell.
+
+    :returns: OrderedDict of step -> OrderedDict of state -> count (only the states with jobs)
+    """
+
+    summary = OrderedDict()
+    for step in cfg_pronto.CODES_PRONTO_STEPS + sorted(set(job_ids_grouped.keys()) - set(cfg_pronto.CODES_PRONTO_STEPS)):
+        if step not in job_ids_grouped:
+            continue
+        counts = OrderedDict((state, 0) for state in JOB_STATES)
+        for job_id in set(str(jid) for jid in job_ids_grouped[step].values()):
+            for state in states.get(job_id, ['finished']):
+                counts[state] += 1
+        summary[step] = OrderedDict((state, count) for state, count in counts.items() if count > 0)
+
+    return summary
+
+
+def jobs_in_error(job_ids_grouped, states):
+    """
+    Jobs stuck in error state (e.g. Eqw in SGE), which hold back all the jobs depending on them.
+
+    :returns: list of (step, job id, subjects processed by the job)
+    """
+
+    stuck = list()
+    for step, id_dict in job_ids_grouped.items():
+        subjects_by_job = OrderedDict()
+        for prefix, job_id in id_dict.items():
+            subjects_by_job.setdefault(str(job_id), list()).append(prefix)
+        for job_id, prefixes in subjects_by_job.items():
+            if 'error' in states.get(job_id, list()):
+                stuck.append((step, job_id, prefixes))
+
+    return stuck
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# Append-only ledger of the resources used by the finished jobs, from which those of the jobs to come are predicted.
+
+import json
+import math
+import os
+
+import cfg_front as cfg_pronto
+import nifti_header
+
+# successful jobs of a step needed in the ledger, before its predictions replace the static models of cfg_front
+min_records = 5
+
+# predictors loaded so far, by ledger path and quantile
+predictor_cache = dict()
+
+
+def run_features(headers):
+    """
+    Size of the runs processed by a job: voxels of a volume, and voxels of all the volumes (elements),
+        summed over the runs.
+    """
+
+    voxels, elements = 0, 0
+    for header in headers:
+        voxels += nifti_header.num_voxels(header)
+        elements += nifti_header.num_voxels(header) * nifti_header.num_volumes(header)
+
+    return voxels, elements
+
+
+def job_profile(step_id, headers, num_pipelines):
+    """Size of a job, as recorded along with its usage in the ledger: STEP,voxels,elements,pipelines"""
+
+    voxels, elements = run_features(headers)
+    return '{0},{1},{2},{3}'.format(step_id.upper(), voxels, elements, num_pipelines)
+
+
+def model_usage(model, voxels, elements, num_pipelines):
+    """
+    Memory (GB) and walltime (hours) of a job as per a model of cfg_front.RESOURCE_MODELS, without its safety factor.
+        The pipelines work in double precision, whatever the datatype of the files.
+    """
+
+    run_gb = elements * 8 / 1024.0 ** 3
+    volume_gb = voxels * 8 / 1024.0 ** 3
+
+    memory_gb = model.mem_base + model.mem_per_gb * run_gb + model.mem_per_pipeline * num_pipelines * volume_gb
+    walltime_hours = model.time_base + model.time_per_gb * run_gb + model.time_per_pipeline * num_pipelines * run_gb
+
+    return memory_gb, walltime_hours
+
+
+def read_ledger(ledger_path):
+    """Records of the ledger, one per finished job, skipping lines that can not be parsed."""
+
+    records = list()
+    if ledger_path is None or not os.path.isfile(ledger_path):
+        return records
+
+    with open(ledger_path, 'r') as ledger:
+        for line in ledger:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # interleaved with the record of another job, on filesystems not appending atomically
+                continue
+            if isinstance(record, dict):
+                records.append(record)
+
+    return records
+
+
+def quantile(values, q):
+    """Quantile q (between 0 and 1) of a list of values, interpolating linearly between them."""
+
+    ordered = sorted(values)
+    position = min(max(q, 0.0), 1.0) * (len(ordered) - 1)
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(ordered) - 1)
+
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class ResourcePredictor(object):
+    """
+    Predicts the memory and walltime of jobs from the usage of the finished jobs of the same step.
+        What is learned is the usage of each job relative to the model of its step, so jobs of one size inform
+        the predictions for jobs of any other size (and the studies sharing a ledger inform each other).
+    """
+
+    def __init__(self, records, q=0.95):
+
+        self.q = q
+        # usage relative to the model, of each successful job of each step
+        self.memory_ratios = dict()
+        self.walltime_ratios = dict()
+
+        for record in records:
+            if record.get('exit_code') != 0:
+                # killed or failed, so its usage does not reflect what the job needs
+                continue
+            model = cfg_pronto.RESOURCE_MODELS.get(record.get('step'))
+            if model is None:
+                continue
+            try:
+                memory_gb, walltime_hours = model_usage(model, float(record['voxels']), float(record['elements']),
+                                                        int(record['pipelines']))
+            except (KeyError, TypeError, ValueError):
+                continue
+
+            if isinstance(record.get('peak_rss_kb'), (int, long, float)):
+                self.memory_ratios.setdefault(record['step'], list()).append(
+                    record['peak_rss_kb'] / 1024.0 ** 2 / memory_gb)
+            if isinstance(record.get('wall_time_sec'), (int, long, float)):
+                self.walltime_ratios.setdefault(record['step'], list()).append(
+                    record['wall_time_sec'] / 3600.0 / walltime_hours)
+
+    def predict(self, step_id, voxels, elements, num_pipelines):
+        """
+        Memory (GB) and walltime (hours) not exceeded by the given quantile of the jobs of the step, scaled to the
+            size of the job. Either of them is None while the ledger has fewer than min_records jobs of the step.
+        """
+
+        model = cfg_pronto.RESOURCE_MODELS.get(step_id.upper())
+        if model is None:
+            return None, None
+
+        memory_gb, walltime_hours = model_usage(model, voxels, elements, num_pipelines)
+        memory_ratios = self.memory_ratios.get(step_id.upper(), list())
+        walltime_ratios = self.walltime_ratios.get(step_id.upper(), list())
+
+        predicted_memory, predicted_walltime = None, None
+        if len(memory_ratios) >= min_records:
+            predicted_memory = memory_gb * quantile(memory_ratios, self.q)
+        if len(walltime_ratios) >= min_records:
+            predicted_walltime = walltime_hours * quantile(walltime_ratios, self.q)
+
+        return predicted_memory, predicted_walltime
+
+
+def load_predictor(ledger_path, q=0.95):
+    """Predictor learned from the ledger, read only once per session."""
+
+    key = (ledger_path, q)
+    if key not in predictor_cache:
+        predictor_cache[key] = ResourcePredictor(read_ledger(ledger_path), q)
+
+    return predictor_cache[key]
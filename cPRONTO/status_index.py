@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# Persistent index of the output folders of OPPNI, to check the status of processing incrementally.
+
+import fnmatch
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+# the size and mtime checked here are not part of a directory listing on POSIX, so entry.stat() of scandir
+#   makes the same stat call as os.stat - it only spares them on Windows, where the listing reports both
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# version of the layout of the saved index, to ignore indices saved by incompatible versions
+index_version = 1
+
+# files changed within this many seconds of listing a folder may not have updated its mtime yet
+racy_window_sec = 2
+
+# folders listed simultaneously - metadata requests to network filesystems are mostly waiting
+num_scan_threads = 16
+
+
+def scan_folder(folder, prev_record=None):
+    """
+    Lists a folder, unless its mtime matches that of its previous listing.
+        Only the entries not seen in the previous listing are stat'ed.
+
+    :param folder: path to the folder
+    :param prev_record: record of the previous listing {'mtime': .., 'entries': {name: [size, mtime]}}, if any
+    :returns: record of the folder (None if it doesn't exist), and whether it was listed again
+    :rtype: dict, bool
+    """
+
+    try:
+        folder_mtime = os.stat(folder).st_mtime
+    except OSError:
+        # doesn't exist (yet)
+        return None, False
+
+    if prev_record is not None and prev_record['mtime'] == folder_mtime:
+        return prev_record, False
+
+    prev_entries = dict() if prev_record is None else prev_record['entries']
+    entries = dict()
+    if scandir is not None:
+        for entry in scandir(folder):
+            if entry.name in prev_entries:
+                # still the same entry, as far as the folder is concerned
+                entries[entry.name] = prev_entries[entry.name]
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                # removed in the mean time
+                continue
+            entries[entry.name] = [st.st_size, st.st_mtime]
+    else:
+        for name in os.listdir(folder):
+            if name in prev_entries:
+                entries[name] = prev_entries[name]
+                continue
+            try:
+                st = os.stat(os.path.join(folder, name))
+            except OSError:
+                continue
+            entries[name] = [st.st_size, st.st_mtime]
+
+    if time.time() - folder_mtime < racy_window_sec:
+        # could still be changing without a change in mtime, so it must be listed again next time
+        folder_mtime = None
+
+    return {'mtime': folder_mtime, 'entries': entries}, True
+
+
+class StatusIndex(object):
+    """
+    Listings of the output folders (name -> [size, mtime] of each entry), saved across status checks.
+        A folder is listed again only when its own mtime changed since it was last listed,
+        i.e. when entries were added, removed or renamed within it. Hence files rewritten in place
+        retain the size and mtime recorded when they were first seen.
+
+    Each folder is checked at most once per session: all the queries that follow are answered from memory.
+    """
+
+    def __init__(self, index_path=None):
+
+        self.index_path = index_path
+        self.folders = dict()
+        # folders checked in this session, to be answered from memory from then on
+        self.checked = set()
+        # number of folders (re)listed in this session, to report the savings
+        self.num_listed = 0
+        self.num_cached = 0
+
+        if index_path is not None and os.path.isfile(index_path):
+            try:
+                with open(index_path, 'r') as idx:
+                    saved = json.load(idx)
+                if saved.get('version') == index_version:
+                    self.folders = saved['folders']
+            except (IOError, ValueError, KeyError):
+                # starting afresh is always safe
+                self.folders = dict()
+
+    def refresh(self, folders, num_threads=num_scan_threads):
+        """
+        Checks all the given folders in parallel, listing those changed since they were last listed,
+            so the queries that follow need no more trips to the filesystem.
+        """
+
+        to_check = [folder for folder in set(folders) if folder not in self.checked]
+        if len(to_check) < 1:
+            return
+
+        pool = ThreadPool(max(1, min(num_threads, len(to_check))))
+        try:
+            # the workers only list the folders - the index is updated here, in one thread
+            records = pool.map(lambda folder: scan_folder(folder, self.folders.get(folder)), to_check)
+        finally:
+            pool.close()
+            pool.join()
+
+        for folder, (record, listed) in zip(to_check, records):
+            self.update(folder, record, listed)
+
+    def update(self, folder, record, listed):
+
+        if record is None:
+            self.folders.pop(folder, None)
+        else:
+            self.folders[folder] = record
+        self.checked.add(folder)
+        if listed:
+            self.num_listed += 1
+        elif record is not None:
+            self.num_cached += 1
+
+    def listing(self, folder):
+        """Returns the entries of a folder (name -> [size, mtime]), listing it only if it changed."""
+
+        if folder not in self.checked:
+            record, listed = scan_folder(folder, self.folders.get(folder))
+            self.update(folder, record, listed)
+
+        record = self.folders.get(folder)
+        if record is None:
+            return dict()
+        return record['entries']
+
+    def exists(self, path):
+        """Checks whether a file exists, as per the listing of its folder."""
+
+        folder, name = os.path.split(path)
+        return name in self.listing(folder)
+
+    def size(self, path):
+        """Size of a file when it was first seen, or None if it doesn't exist."""
+
+        folder, name = os.path.split(path)
+        entry = self.listing(folder).get(name)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def glob(self, folder, pattern):
+        """Names of the entries of a folder matching a shell-style pattern."""
+
+        return fnmatch.filter(self.listing(folder).keys(), pattern)
+
+    def save(self):
+        """Saves the index for the next status check, replacing the previous one atomically."""
+
+        if self.index_path is None:
+            return
+
+        tmp_path = '{0}.{1}.tmp'.format(self.index_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as idx:
+                json.dump({'version': index_version, 'folders': self.folders}, idx)
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError) as exc:
+            # not being able to save the index only costs time in the next check
+            print('Unable to save the status index to {}: {}'.format(self.index_path, exc))
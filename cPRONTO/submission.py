@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# Submits many jobs concurrently, at a limited rate, holding them back while too many are in the queue.
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# seconds between the queries of the scheduler while submissions are held back
+queue_poll_sec = 30
+# seconds between the progress reports of a bulk submission
+progress_interval_sec = 10
+
+# states of jobs that left the queue, which no longer count towards the jobs queued (see queue_status.JOB_STATES)
+#   jobs stuck in an error state (e.g. Eqw in SGE) do not drain by themselves, so they are not waited for either
+left_queue_states = ('done', 'failed', 'finished', 'error')
+
+
+class SubmissionError(Exception):
+    """Raised when some of the jobs of a bulk submission could not be submitted, holding the ids of the others."""
+
+    def __init__(self, message, job_ids):
+
+        Exception.__init__(self, message)
+        self.job_ids = job_ids
+
+
+class Submitter(object):
+    """
+    Submits jobs through an executor (see executors.py) with a pool of threads, as schedulers answer
+        each submission in a round trip of their own. Submissions are paced, so that:
+        - no more than `rate` jobs are submitted per second (0 for no limit), as some sites reject bursts, and
+        - no more than `max_queued` tasks of this session are in the queue at any time (0 for no limit),
+            as some sites cap the jobs queued per user. Jobs above the cap are held back, and fed in as
+            earlier ones drain from the queue. Jobs larger than the cap (e.g. arrays) go in once the queue is empty.
+    """
+
+    def __init__(self, executor, num_threads=4, rate=0, max_queued=0):
+
+        self.executor = executor
+        self.num_threads = max(1, int(num_threads))
+        self.rate = float(rate)
+        self.max_queued = int(max_queued)
+
+        # released while waiting for the queue to drain, so the submissions under way can complete
+        self.lock = threading.Condition()
+        self.print_lock = threading.Lock()
+        # earliest time the next submission can go, as per the rate
+        self.next_submission = 0.0
+        # jobs submitted and possibly still in the queue, with their number of tasks
+        self.queued = OrderedDict()
+        # tasks of the jobs being submitted right now
+        self.reserved = 0
+        # when the jobs were last reported to be held back
+        self.held_reported = 0.0
+
+    def num_queued(self):
+
+        return self.reserved + sum(self.queued.values())
+
+    def refresh_queued(self):
+        """Forgets the jobs that left the queue, with a single query of the scheduler."""
+
+        states = self.executor.status(self.queued.keys())
+        if states is None:
+            # can not tell - better to wait than to go over the cap
+            return
+        for job_id in self.queued.keys():
+            job_states = states.get(str(job_id), list())
+            remaining = len([state for state in job_states if state not in left_queue_states])
+            if remaining > 0:
+                self.queued[job_id] = remaining
+            else:
+                self.queued.pop(job_id)
+                if 'error' in job_states:
+                    self.report('job {} is stuck in an error state - no longer waiting for it to drain. '
+                                'Check it with the scheduler.'.format(job_id))
+
+    def wait_for_room(self, num_tasks):
+        """Blocks until the queue has room for num_tasks more tasks, and reserves it."""
+
+        with self.lock:
+            if self.max_queued > 0:
+                while self.num_queued() > 0 and self.num_queued() + num_tasks > self.max_queued:
+                    self.refresh_queued()
+                    if self.num_queued() > 0 and self.num_queued() + num_tasks > self.max_queued:
+                        if time.time() - self.held_reported >= progress_interval_sec:
+                            self.report('{} tasks in the queue - holding back the rest of the jobs until it drains '
+                                        'below {}'.format(self.num_queued(), self.max_queued))
+                            self.held_reported = time.time()
+                        self.lock.wait(queue_poll_sec)
+            self.reserved += num_tasks
+
+            # spacing the submissions as per the rate
+            now = time.time()
+            wait = self.next_submission - now
+            if self.rate > 0:
+                self.next_submission = max(now, self.next_submission) + 1.0 / self.rate
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def submit(self, job_args, depends_on=(), task_depends_on=(), num_tasks=1):
+        """Submits a single job once the rate and the cap of the queue allow it, returning its id."""
+
+        self.wait_for_room(num_tasks)
+        job_id = None
+        try:
+            job_id = self.executor.submit(job_args, depends_on, task_depends_on)
+        finally:
+            with self.lock:
+                self.reserved -= num_tasks
+                if job_id is not None:
+                    self.queued[job_id] = num_tasks
+
+        return job_id
+
+    def submit_many(self, submissions):
+        """
+        Submits many jobs that do not depend on one another, concurrently, reporting the progress as it goes.
+
+        :param submissions: OrderedDict of key -> (job_args, depends_on, task_depends_on)
+        :returns: OrderedDict of key -> job id, in the same order
+        :raises SubmissionError: if any of the jobs could not be submitted, once all the others are
+        """
+
+        keys = submissions.keys()
+        if len(keys) < 1:
+            return OrderedDict()
+
+        progress = {'done': 0, 'reported': time.time()}
+        start = time.time()
+
+        def submit_one(key):
+            # a failure is returned rather than raised, so the ids of the jobs submitted are not lost
+            job_args, depends_on, task_depends_on = submissions[key]
+            try:
+                job_id, error = self.submit(job_args, depends_on, task_depends_on), None
+            except Exception as exc:
+                job_id, error = None, exc
+            with self.print_lock:
+                progress['done'] += 1
+                if time.time() - progress['reported'] >= progress_interval_sec:
+                    progress['reported'] = time.time()
+                    self.report_progress(progress['done'], len(keys), start)
+            return job_id, error
+
+        pool = ThreadPool(min(self.num_threads, len(keys)))
+        try:
+            results = pool.map(submit_one, keys)
+        finally:
+            pool.close()
+            pool.join()
+
+        if time.time() - start >= progress_interval_sec:
+            self.report_progress(len(keys), len(keys), start)
+
+        job_ids = OrderedDict((key, job_id) for key, (job_id, error) in zip(keys, results) if error is None)
+        failures = [(key, error) for key, (job_id, error) in zip(keys, results) if error is not None]
+        if len(failures) > 0:
+            for key, error in failures:
+                self.report('submission of {} failed: {}'.format(key, error))
+            raise SubmissionError('{} of {} jobs could not be submitted, e.g. {}: {}'.format(
+                len(failures), len(keys), failures[0][0], failures[0][1]), job_ids)
+
+        return job_ids
+
+    def report_progress(self, num_done, num_total, start):
+
+        elapsed = max(time.time() - start, 1e-6)
+        self.report('submitted {}/{} jobs ({:.1f} jobs/sec)'.format(num_done, num_total, num_done / elapsed))
+
+    def report(self, message):
+
+        sys.stdout.write('\t{}\n'.format(message))
+        sys.stdout.flush()
@@ -0,0 +1 @@
+# Unit tests of the pure-Python parts of cPRONTO, run from cPRONTO with: python -m unittest discover -s tests -t .
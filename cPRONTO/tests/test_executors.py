@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Simulated cluster of executors.MockExecutor: scheduling of the jobs on its slots, their states, and its saved state.
+
+import shutil
+import tempfile
+import time
+import unittest
+
+import executors
+
+# jobs of 100 sec, in real time, released 10 sec after their submission
+mock_params = {'num_slots': 1, 'submit_latency_sec': 0.0, 'queue_latency_sec': 10.0,
+               'job_duration_sec': (100.0, 0.0), 'failure_rate': 0.0, 'time_scale': 1.0, 'seed': 0}
+
+
+class TestMockExecutor(unittest.TestCase):
+
+    def setUp(self):
+
+        self.executor = executors.MockExecutor(dict(), **mock_params)
+
+    def run_for(self, seconds):
+        """Moves the simulated time to the given seconds since the first submission."""
+
+        self.executor.started = time.time() - seconds / self.executor.params['time_scale']
+
+    def test_ids_and_arrays(self):
+
+        first = self.executor.submit(['-N', 'one', 'one.sh'])
+        array = self.executor.submit(['-t', '1-4', 'array.sh'], depends_on=[first])
+        self.assertEqual((first, array), ('1', '2'))
+        self.assertEqual(len(self.executor.jobs[array]['durations']), 4)
+        self.assertEqual(self.executor.jobs[array]['name'], 'array')
+        self.assertEqual(self.executor.jobs[array]['depends_on'], ['1'])
+
+    def test_schedule_on_slots(self):
+
+        self.executor.submit(['a.sh'])
+        self.executor.submit(['b.sh'])
+        run_times = self.executor.schedule()
+        # a single slot, so the second job waits for the first
+        self.assertAlmostEqual(run_times[('1', 0)][0], 10.0, delta=1.0)
+        self.assertAlmostEqual(run_times[('2', 0)][0], run_times[('1', 0)][1])
+        self.assertAlmostEqual(run_times[('2', 0)][1] - run_times[('2', 0)][0], 100.0)
+
+    def test_states(self):
+
+        self.executor.submit(['a.sh'])
+        self.executor.submit(['b.sh'])
+        self.run_for(0.0)
+        self.assertEqual(self.executor.status(['1', '2']), {'1': ['queued'], '2': ['queued']})
+        self.run_for(50.0)
+        self.assertEqual(self.executor.status(['1', '2']), {'1': ['running'], '2': ['held']})
+        self.run_for(1000.0)
+        self.assertEqual(self.executor.status([1, 2, 3]), {'1': ['done'], '2': ['done']})
+
+    def test_failed_dependencies(self):
+
+        self.executor.params['num_slots'] = 10
+        first = self.executor.submit(['a.sh'])
+        second = self.executor.submit(['b.sh'], depends_on=[first])
+        self.executor.jobs[first]['fails'] = [True]
+        self.run_for(1000.0)
+        # jobs depending on a failed one never run
+        self.assertEqual(self.executor.status([first, second]), {first: ['failed'], second: ['error']})
+        self.assertIn('1 tasks never ran', self.executor.report())
+
+    def test_task_dependencies(self):
+
+        self.executor.params['num_slots'] = 10
+        first = self.executor.submit(['-t', '1-3', 'a.sh'])
+        second = self.executor.submit(['-t', '1-3', 'b.sh'], task_depends_on=[first])
+        self.executor.jobs[first]['fails'] = [False, True, False]
+        self.run_for(1000.0)
+        # only the task waiting on the failed one is blocked
+        self.assertEqual(self.executor.status([second]), {second: ['done', 'error', 'done']})
+
+    def test_cancel(self):
+
+        first = self.executor.submit(['a.sh'])
+        second = self.executor.submit(['b.sh'], depends_on=[first])
+        self.executor.cancel([first])
+        self.run_for(1000.0)
+        self.assertEqual(self.executor.status([first, second]), {second: ['error']})
+
+    def test_report(self):
+
+        self.executor.submit(['a.sh'])
+        self.executor.submit(['-t', '1-2', 'b.sh'])
+        report = self.executor.report()
+        self.assertTrue(report.startswith('Simulated 2 jobs (3 tasks) on 1 slots:'))
+        self.assertIn('all done after', report)
+
+    def test_save_and_load(self):
+
+        out_dir = tempfile.mkdtemp()
+        try:
+            self.executor.submit(['a.sh'])
+            self.executor.submit(['b.sh'], depends_on=['1'])
+            self.run_for(50.0)
+            self.executor.save_state(out_dir)
+
+            loaded = executors.MockExecutor(dict())
+            loaded.load_state(out_dir)
+            self.assertEqual(loaded.params['num_slots'], 1)
+            self.assertEqual(loaded.jobs.keys(), ['1', '2'])
+            self.assertEqual(loaded.status(['1', '2']), {'1': ['running'], '2': ['held']})
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_load_without_state(self):
+
+        out_dir = tempfile.mkdtemp()
+        try:
+            self.executor.load_state(out_dir)
+            self.assertEqual(len(self.executor.jobs), 0)
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_make_executor(self):
+
+        self.assertIsInstance(executors.make_executor('MOCK', dict()), executors.MockExecutor)
+        self.assertRaises(ValueError, executors.make_executor, 'LSF', dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
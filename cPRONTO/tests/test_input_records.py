@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Parsing of the lines of the input files by input_records.
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import input_records
+
+
+class TestInputRecords(unittest.TestCase):
+
+    def test_parse_line(self):
+
+        record = input_records.parse_input_line(
+            'IN=/data/s1/run1.nii OUT=/out/s1/s1_run1 DROP=[2,3] TASK=/data/s1/task.txt '
+            'PHYSIO=/data/s1/physio STRUCT=/data/s1/t1.nii CUSTOMREG=/data/s1/reg.nii', 7)
+        self.assertEqual(record.errors, [])
+        self.assertEqual(record.line_num, 7)
+        self.assertEqual(record.nii, '/data/s1/run1.nii')
+        self.assertEqual((record.out, record.prefix), ('/out/s1', 's1_run1'))
+        self.assertEqual((record.drop_beg, record.drop_end), ('2', '3'))
+        self.assertEqual(record.mask, '/data/s1/reg.nii')
+        self.assertEqual(record.files(), ['/data/s1/run1.nii', '/data/s1/task.txt', '/data/s1/t1.nii',
+                                          '/data/s1/reg.nii', '/data/s1/physio.puls.1D', '/data/s1/physio.resp.1D'])
+
+    def test_optional_fields(self):
+
+        record = input_records.parse_input_line('in=/data/run1.nii out=/out/run1 NOTE=anything')
+        self.assertEqual(record.errors, [])
+        self.assertEqual(record.nii, '/data/run1.nii')
+        self.assertIsNone(record.task)
+        self.assertIsNone(record.drop_beg)
+        self.assertEqual(record.files(), ['/data/run1.nii'])
+
+    def test_errors(self):
+
+        record = input_records.parse_input_line('IN=/data/run 1.nii OUT=/out/run$1 DROP=[2]')
+        self.assertEqual(len(record.errors), 2)
+        self.assertIn('OUT contains an invalid path', record.errors[0])
+        self.assertIn('DROP indices', record.errors[1])
+        self.assertIsNone(record.out)
+
+        record = input_records.parse_input_line('IN=/data/run1.nii OUT=/out/run1 DROP=[-1,2]')
+        self.assertEqual(len(record.errors), 1)
+
+    def test_strip_nifti_ext(self):
+
+        self.assertEqual(input_records.strip_nifti_ext('s1_run1.nii'), 's1_run1')
+        self.assertEqual(input_records.strip_nifti_ext('s1_run1'), 's1_run1')
+        # only the extension PRONTO strips
+        self.assertEqual(input_records.strip_nifti_ext('s1.run1'), 's1.run1')
+        self.assertEqual(input_records.strip_nifti_ext('s1_run1.nii.gz'), 's1_run1.nii.gz')
+
+    def test_read_run_records(self):
+
+        folder = tempfile.mkdtemp()
+        try:
+            input_file = os.path.join(folder, 'input.txt')
+            with open(input_file, 'w') as ipf:
+                ipf.write('IN=/data/s1.nii OUT=/out/s1\nIN=/data/s2.nii OUT=/out/s2\n')
+            records = list(input_records.read_run_records(input_file))
+        finally:
+            shutil.rmtree(folder)
+
+        self.assertEqual([(record.line_num, record.prefix) for record in records], [(1, 's1'), (2, 's2')])
+
+    def test_pickle(self):
+
+        record = input_records.parse_input_line('IN=/data/s1.nii OUT=/out/s1 DROP=[1,1]', 3)
+        record.header = {'tr_msec': 2000.0}
+        loaded = pickle.loads(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+        for field in input_records.RunRecord.__slots__:
+            self.assertEqual(getattr(loaded, field), getattr(record, field))
+
+        # records saved before fields were added
+        older = input_records.RunRecord()
+        older.__setstate__(('/data/s1.nii', '/out', 's1'))
+        self.assertEqual(older.prefix, 's1')
+        self.assertIsNone(older.header)
+
+    def test_from_dict(self):
+
+        record = input_records.RunRecord.from_dict({'nii': '/data/s1.nii', 'out': '/out', 'prefix': 's1',
+                                                    'errors': None, 'line': 'IN=/data/s1.nii OUT=/out/s1'})
+        self.assertEqual((record.nii, record.prefix), ('/data/s1.nii', 's1'))
+        self.assertEqual(record.errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Pilot subsets of the runs, and the number of runs evaluated in each round of pipeline_search.
+
+import unittest
+from collections import OrderedDict
+
+import input_records
+import pipeline_search
+
+
+def make_subjects(tasks):
+
+    subjects = OrderedDict()
+    for idx, task in enumerate(tasks):
+        key = 'run{}'.format(idx)
+        subjects[key] = input_records.parse_input_line('IN=/data/{0}.nii OUT=/out/{0} TASK={1}'.format(key, task))
+
+    return subjects
+
+
+class TestPilotOrder(unittest.TestCase):
+
+    def test_stratified(self):
+
+        subjects = make_subjects(['a.txt', 'a.txt', 'a.txt', 'a.txt', 'b.txt', 'b.txt'])
+        order = pipeline_search.pilot_order(subjects)
+        self.assertEqual(order, ['run0', 'run4', 'run1', 'run2', 'run5', 'run3'])
+        # any number of the first runs samples both tasks in proportion
+        self.assertEqual(sorted(order[:3]), ['run0', 'run1', 'run4'])
+
+    def test_single_stratum(self):
+
+        subjects = make_subjects(['a.txt'] * 5)
+        self.assertEqual(pipeline_search.pilot_order(subjects), subjects.keys())
+
+    def test_acquisitions(self):
+
+        subjects = make_subjects(['a.txt'] * 4)
+        for idx, subject in enumerate(subjects.values()):
+            dims = [64, 64, 32] if idx < 2 else [96, 96, 40]
+            subject.header = {'dims': dims + [200], 'tr_msec': 2000.0}
+        order = pipeline_search.pilot_order(subjects)
+        self.assertEqual(sorted(order[:2]), ['run0', 'run2'])
+
+
+class TestRoundSizes(unittest.TestCase):
+
+    def test_doubling(self):
+
+        self.assertEqual(pipeline_search.round_sizes(100, 3, 0.1), [10, 20, 40])
+
+    def test_fewest_runs(self):
+
+        self.assertEqual(pipeline_search.round_sizes(10, 3, 0.05), [2, 4, 8])
+
+    def test_capped_by_the_cohort(self):
+
+        self.assertEqual(pipeline_search.round_sizes(10, 4, 0.3), [3, 6, 10, 10])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# Keys of the runs in preproc_cache, and the outputs published to it, in temporary folders.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import input_records
+import preproc_cache
+
+codes = ('m1000000000', 'm1100000000')
+
+
+class Options(object):
+
+    def __init__(self, **values):
+
+        self.DEOBLIQUE = '0'
+        self.TPATTERN = 'auto_hdr'
+        self.BlurToFWHM = '0'
+        self.environment = 'matlab'
+        self.contrast_list_str = 'A-B'
+        self.__dict__.update(values)
+
+
+def write_file(path, content):
+
+    preproc_cache.make_parent(path)
+    with open(path, 'w') as fp:
+        fp.write(content)
+
+
+class TestRunKey(unittest.TestCase):
+
+    def setUp(self):
+
+        # not looking up the tools installed here
+        self.tool_version_cache = dict(preproc_cache.tool_version_cache)
+        preproc_cache.tool_version_cache['matlab'] = {'oppni': '1', 'afni': 'a', 'fsl': 'f', 'environment': 'matlab'}
+        self.subject = input_records.parse_input_line('IN=/data/s1.nii OUT=/out/s1 DROP=[2,0] TASK=/data/task.txt')
+        self.digests = {'/data/s1.nii': 'n1', '/data/task.txt': 't1'}
+
+    def tearDown(self):
+
+        preproc_cache.tool_version_cache.clear()
+        preproc_cache.tool_version_cache.update(self.tool_version_cache)
+
+    def test_key(self):
+
+        key, description = preproc_cache.run_key(self.subject, Options(), self.digests)
+        self.assertEqual(len(key), 40)
+        self.assertEqual(description['drop'], [2, 0])
+        self.assertIsNone(description['task'])
+        # the same however the run is named
+        other = input_records.parse_input_line('IN=/data/s1.nii OUT=/elsewhere/run DROP=[2,0]')
+        self.assertEqual(preproc_cache.run_key(other, Options(), self.digests)[0], key)
+
+    def test_what_changes_the_key(self):
+
+        key = preproc_cache.run_key(self.subject, Options(), self.digests)[0]
+        self.assertNotEqual(preproc_cache.run_key(self.subject, Options(DEOBLIQUE='1'), self.digests)[0], key)
+        self.assertNotEqual(preproc_cache.run_key(self.subject, Options(), {'/data/s1.nii': 'n2'})[0], key)
+        # the model and contrast only matter to the adaptive smoothing
+        self.assertEqual(preproc_cache.run_key(self.subject, Options(contrast_list_str='B-A'), self.digests)[0], key)
+        smoothed = preproc_cache.run_key(self.subject, Options(BlurToFWHM='1'), self.digests)
+        self.assertEqual(smoothed[1]['task'], 't1')
+        self.assertNotEqual(preproc_cache.run_key(self.subject, Options(BlurToFWHM='1', contrast_list_str='B-A'),
+                                                  self.digests)[0], smoothed[0])
+
+    def test_file_digests(self):
+
+        folder = tempfile.mkdtemp()
+        file_digest = preproc_cache.file_digest
+        hashed = list()
+        try:
+            nii = os.path.join(folder, 's1.nii')
+            write_file(nii, 'voxels')
+            preproc_cache.file_digest = lambda path: hashed.append(path) or file_digest(path)
+            first = preproc_cache.file_digests([nii, nii], folder)
+            second = preproc_cache.file_digests([nii], folder)
+        finally:
+            preproc_cache.file_digest = file_digest
+            shutil.rmtree(folder)
+
+        self.assertEqual(first, second)
+        # hashed once, as the digest is saved
+        self.assertEqual(hashed, [nii])
+
+
+class TestPublish(unittest.TestCase):
+
+    def setUp(self):
+
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, 'cache')
+        self.out_dir = os.path.join(self.root, 'out')
+        int_proc_dir = os.path.join(self.out_dir, 'intermediate_processed')
+        for code in codes:
+            write_file(os.path.join(int_proc_dir, 'afni_processed', 's1_{}.nii'.format(code)), 'combination')
+        for pattern in preproc_cache.base_outputs:
+            write_file(os.path.join(int_proc_dir, pattern.format('s1')), 'base')
+        write_file(os.path.join(int_proc_dir, 'diagnostic', 's1_ica_mc', 'components.txt'), 'ica')
+        self.key = 'ab' + '0' * 38
+
+    def tearDown(self):
+
+        for root, dirs, names in os.walk(self.root):
+            for name in names:
+                os.chmod(os.path.join(root, name), stat.S_IRUSR | stat.S_IWUSR)
+        shutil.rmtree(self.root)
+
+    def test_publish(self):
+
+        self.assertTrue(preproc_cache.publish(self.cache_dir, self.key, {'nii': 'n1'}, self.out_dir, 's1', codes))
+
+        entry = preproc_cache.entry_dir(self.cache_dir, self.key)
+        self.assertEqual(entry, os.path.join(self.cache_dir, 'entries', 'ab', self.key))
+        self.assertTrue(preproc_cache.is_cached(entry, codes))
+        self.assertFalse(preproc_cache.is_cached(entry, codes + ('m1110000000', )))
+        cached = os.path.join(entry, 'afni_processed', 'RUN_{}.nii'.format(codes[0]))
+        # shared by the processing folders, so read-only
+        self.assertFalse(os.stat(cached).st_mode & stat.S_IWUSR)
+        self.assertTrue(os.path.isfile(os.path.join(entry, 'diagnostic', 'RUN_ica_mc', 'components.txt')))
+        self.assertTrue(os.path.isfile(os.path.join(entry, 'key.json')))
+        self.assertEqual([name for name in os.listdir(os.path.join(entry, 'masks')) if name.endswith('.tmp')], [])
+
+        # linked into the folders of the analyses of the same run
+        other_dir = os.path.join(self.root, 'other')
+        num_linked = preproc_cache.link_entry(entry, other_dir, 's2')
+        self.assertEqual(num_linked, len(codes) + len(preproc_cache.base_outputs) + 1)
+        linked = os.path.join(other_dir, 'intermediate_processed', 'afni_processed', 's2_{}.nii'.format(codes[0]))
+        self.assertTrue(os.path.samefile(linked, cached))
+        self.assertEqual(preproc_cache.link_entry(entry, other_dir, 's2'), 0)
+
+    def test_incomplete_run(self):
+
+        os.remove(os.path.join(self.out_dir, 'intermediate_processed', 'masks', 's1_mask_nomc.nii'))
+        self.assertFalse(preproc_cache.publish(self.cache_dir, self.key, dict(), self.out_dir, 's1', codes))
+        self.assertFalse(preproc_cache.publish(self.cache_dir, self.key, dict(), self.out_dir, 's1',
+                                               codes + ('m1110000000', )))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# Parsing of the queries of each scheduler, from canned outputs of qstat, squeue and sacct.
+
+import json
+import unittest
+from collections import OrderedDict
+
+import queue_status
+
+sge_qstat_xml = """<?xml version='1.0'?>
+<job_info xmlns:xsd="http://arc.liv.ac.uk/repos/darcs/sge/source/dist/util/resources/schemas/qstat/qstat.xsd">
+  <queue_info>
+    <job_list state="running">
+      <JB_job_number>101</JB_job_number>
+      <state>r</state>
+    </job_list>
+    <job_list state="running">
+      <JB_job_number>103</JB_job_number>
+      <state>r</state>
+      <tasks>1</tasks>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending">
+      <JB_job_number>102</JB_job_number>
+      <state>Eqw</state>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>103</JB_job_number>
+      <state>qw</state>
+      <tasks>2-10:1</tasks>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>104</JB_job_number>
+      <state>hqw</state>
+    </job_list>
+    <job_list state="pending">
+      <JB_job_number>999</JB_job_number>
+      <state>qw</state>
+    </job_list>
+  </job_info>
+</job_info>
+"""
+
+pbs_qstat_json = json.dumps({'Jobs': {'201.pbsserver': {'job_state': 'R'},
+                                      '202.pbsserver': {'job_state': 'H'},
+                                      '203[].pbsserver': {'job_state': 'B'},
+                                      '299.pbsserver': {'job_state': 'Q'}}})
+
+torque_qstat_xml = """<Data>
+<Job><Job_Id>301.torque.example.org</Job_Id><job_state>C</job_state><exit_status>0</exit_status></Job>
+<Job><Job_Id>302.torque.example.org</Job_Id><job_state>C</job_state><exit_status>271</exit_status></Job>
+<Job><Job_Id>303[1].torque.example.org</Job_Id><job_state>R</job_state></Job>
+<Job><Job_Id>303[2].torque.example.org</Job_Id><job_state>Q</job_state></Job>
+</Data>
+"""
+
+slurm_squeue = """401|RUNNING|None
+402|PENDING|Dependency
+403|PENDING|JobHeldUser
+404|PENDING|DependencyNeverSatisfied
+405_1|RUNNING|None
+405_2|PENDING|Resources
+499|RUNNING|None
+"""
+
+slurm_sacct = """406|COMPLETED
+407|CANCELLED by 1234
+408_1|FAILED
+408_2|COMPLETED
+"""
+
+
+class CannedQueryTest(unittest.TestCase):
+    """Answers the queries to the scheduler with canned outputs, by the command queried."""
+
+    outputs = dict()
+
+    def setUp(self):
+
+        self.queries = list()
+        self.run_query = queue_status.run_query
+        queue_status.run_query = self.canned_query
+
+    def tearDown(self):
+
+        queue_status.run_query = self.run_query
+
+    def canned_query(self, cmd):
+
+        self.queries.append(cmd)
+        return self.outputs.get(cmd[0])
+
+
+class TestHelpers(unittest.TestCase):
+
+    def test_count_sge_tasks(self):
+
+        self.assertEqual(queue_status.count_sge_tasks(''), 1)
+        self.assertEqual(queue_status.count_sge_tasks('4'), 1)
+        self.assertEqual(queue_status.count_sge_tasks('1-10:1'), 10)
+        self.assertEqual(queue_status.count_sge_tasks('1-10:2'), 5)
+        self.assertEqual(queue_status.count_sge_tasks('3,5-7:1'), 4)
+
+    def test_sge_state(self):
+
+        self.assertEqual(queue_status.sge_state('qw'), 'queued')
+        self.assertEqual(queue_status.sge_state('hqw'), 'held')
+        self.assertEqual(queue_status.sge_state('Eqw'), 'error')
+        self.assertEqual(queue_status.sge_state('dr'), 'failed')
+        self.assertEqual(queue_status.sge_state('r'), 'running')
+        self.assertEqual(queue_status.sge_state('?'), 'unknown')
+
+    def test_job_ids(self):
+
+        self.assertEqual(queue_status.base_job_id('405_2'), '405')
+        self.assertEqual(queue_status.pbs_job_id('201.pbsserver'), '201')
+        self.assertEqual(queue_status.pbs_job_id('303[1].torque.example.org'), '303[]')
+        self.assertEqual(queue_status.pbs_job_id('303[]'), '303[]')
+
+
+class TestSGE(CannedQueryTest):
+
+    outputs = {'qstat': sge_qstat_xml}
+
+    def test_states(self):
+
+        states = queue_status.job_states('SGE', ['101', '102', '103', 104, '105'])
+        self.assertEqual(states['101'], ['running'])
+        self.assertEqual(states['102'], ['error'])
+        self.assertEqual(sorted(states['103']), ['queued'] * 9 + ['running'])
+        self.assertEqual(states['104'], ['held'])
+        # jobs of others, and those that left the queue, are not reported
+        self.assertNotIn('999', states)
+        self.assertNotIn('105', states)
+        self.assertIn('-xml', self.queries[0])
+
+    def test_unavailable(self):
+
+        self.outputs = dict()
+        self.assertIsNone(queue_status.job_states('SGE', ['101']))
+
+    def test_unparsable(self):
+
+        self.outputs = {'qstat': 'error: commlib error'}
+        self.assertIsNone(queue_status.job_states('SGE', ['101']))
+
+
+class TestPBS(CannedQueryTest):
+
+    outputs = {'qstat': pbs_qstat_json}
+
+    def test_states(self):
+
+        states = queue_status.job_states('PBS', ['201', '202.pbsserver', '203[].pbsserver', '204'])
+        # reported under the ids they were saved with
+        self.assertEqual(states, {'201': ['running'], '202.pbsserver': ['held'], '203[].pbsserver': ['running']})
+
+    def test_unparsable(self):
+
+        self.outputs = {'qstat': 'qstat: cannot connect to server'}
+        self.assertIsNone(queue_status.job_states('PBS', ['201']))
+
+
+class TestTorque(CannedQueryTest):
+
+    outputs = {'qstat': torque_qstat_xml}
+
+    def test_states(self):
+
+        states = queue_status.job_states('TORQUE', ['301.torque.example.org', '302', '303[]'])
+        self.assertEqual(states['301.torque.example.org'], ['finished'])
+        self.assertEqual(states['302'], ['failed'])
+        self.assertEqual(states['303[]'], ['running', 'queued'])
+
+    def test_empty_queue(self):
+
+        self.outputs = {'qstat': '\n'}
+        self.assertEqual(queue_status.job_states('TORQUE', ['301']), dict())
+
+
+class TestSLURM(CannedQueryTest):
+
+    outputs = {'squeue': slurm_squeue, 'sacct': slurm_sacct}
+
+    def test_states(self):
+
+        states = queue_status.job_states('SLURM', ['401', '402', '403', '404', '405', '406', '407', '408', '409'])
+        self.assertEqual(states['401'], ['running'])
+        self.assertEqual(states['402'], ['queued'])
+        self.assertEqual(states['403'], ['held'])
+        self.assertEqual(states['404'], ['error'])
+        self.assertEqual(states['405'], ['running', 'queued'])
+        self.assertEqual(states['406'], ['done'])
+        self.assertEqual(states['407'], ['failed'])
+        self.assertEqual(states['408'], ['failed', 'done'])
+        self.assertNotIn('409', states)
+        self.assertNotIn('499', states)
+
+        # only the jobs not in the queue are looked up in the accounting
+        sacct = [cmd for cmd in self.queries if cmd[0] == 'sacct']
+        self.assertEqual(len(sacct), 1)
+        self.assertEqual(sacct[0][-1], '406,407,408,409')
+
+    def test_all_in_queue(self):
+
+        queue_status.job_states('SLURM', ['401', '402'])
+        self.assertEqual([cmd[0] for cmd in self.queries], ['squeue'])
+
+    def test_unavailable(self):
+
+        self.outputs = dict()
+        self.assertIsNone(queue_status.job_states('SLURM', ['401']))
+
+
+class TestSummaries(unittest.TestCase):
+
+    job_ids_grouped = OrderedDict([('QC1', OrderedDict([('sub1', '21'), ('sub2', '21'), ('sub3', '21')])),
+                                   ('PART1', OrderedDict([('sub1', '11'), ('sub2', '12'), ('sub3', '13')]))])
+
+    def test_summarize_by_step(self):
+
+        states = {'11': ['running'], '12': ['error'], '21': ['held', 'held']}
+        summary = queue_status.summarize_by_step(self.job_ids_grouped, states)
+        self.assertEqual(summary.keys(), ['PART1', 'QC1'])
+        # jobs unknown to the scheduler have finished
+        self.assertEqual(dict(summary['PART1']), {'running': 1, 'error': 1, 'finished': 1})
+        # in the order of the steps, and jobs processing several subjects are counted once per task
+        self.assertEqual(dict(summary['QC1']), {'held': 2})
+
+    def test_jobs_in_error(self):
+
+        states = {'12': ['error'], '21': ['running', 'error']}
+        stuck = queue_status.jobs_in_error(self.job_ids_grouped, states)
+        self.assertEqual(stuck, [('QC1', '21', ['sub1', 'sub2', 'sub3']), ('PART1', '12', ['sub2'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
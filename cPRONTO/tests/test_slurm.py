@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# Submissions and status checks of the SLURM backend, through a fake sbatch, squeue and sacct on PATH.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from collections import OrderedDict
+
+import oppni
+import queue_status
+
+# each fake command records its args (one call per line, tab separated) and prints its canned output
+fake_command = """#!/bin/sh
+printf '%s\\t' "$@" >> "$FAKE_SLURM_DIR/{0}.calls"
+printf '\\n' >> "$FAKE_SLURM_DIR/{0}.calls"
+if [ -f "$FAKE_SLURM_DIR/{0}.out" ]; then cat "$FAKE_SLURM_DIR/{0}.out"; fi
+"""
+
+
+class FakeSlurmTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.fake_dir = tempfile.mkdtemp()
+        for command in ('sbatch', 'squeue', 'sacct'):
+            command_path = os.path.join(self.fake_dir, command)
+            with open(command_path, 'w') as cf:
+                cf.write(fake_command.format(command))
+            os.chmod(command_path, stat.S_IRWXU)
+
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = self.fake_dir + os.pathsep + os.environ.get('PATH', '')
+        os.environ['FAKE_SLURM_DIR'] = self.fake_dir
+
+        self.hpc = dict(oppni.hpc)
+        oppni.hpc.update({'type': 'SLURM', 'dry_run': False, 'job_ids_grouped': dict(), 'array_tasks': dict()})
+
+    def tearDown(self):
+
+        os.environ.clear()
+        os.environ.update(self.environ)
+        oppni.hpc.clear()
+        oppni.hpc.update(self.hpc)
+        shutil.rmtree(self.fake_dir)
+
+    def answer(self, command, output):
+
+        with open(os.path.join(self.fake_dir, command + '.out'), 'w') as of:
+            of.write(output)
+
+    def calls(self, command):
+        """Args of each call of a fake command."""
+
+        calls_path = os.path.join(self.fake_dir, command + '.calls')
+        if not os.path.isfile(calls_path):
+            return list()
+        with open(calls_path, 'r') as cf:
+            return [line.rstrip('\n').rstrip('\t').split('\t') for line in cf]
+
+
+class TestSubmission(FakeSlurmTest):
+
+    def test_parsable_id(self):
+
+        self.answer('sbatch', '1234\n')
+        self.assertEqual(oppni.submit_queue('/jobs/part1.job', None), '1234')
+        self.assertEqual(self.calls('sbatch'), [['--parsable', '/jobs/part1.job']])
+
+    def test_federated_id(self):
+
+        # reported along with the cluster
+        self.answer('sbatch', '1235;cluster2\n')
+        self.assertEqual(oppni.submit_queue('/jobs/part1.job', None), '1235')
+
+    def test_dependencies(self):
+
+        self.answer('sbatch', '40\n')
+        oppni.hpc['job_ids_grouped'] = {'PART1': OrderedDict([('s1', '11'), ('s2', '12')])}
+        oppni.submit_queue('/jobs/qc1.job', 'PART1')
+        # per-subject jobs wait for the same subject only
+        oppni.submit_queue('/jobs/spnorm_s2.job', 'PART1', 's2')
+        self.assertEqual(self.calls('sbatch'), [['--parsable', '--dependency=afterok:11:12', '/jobs/qc1.job'],
+                                                ['--parsable', '--dependency=afterok:12', '/jobs/spnorm_s2.job']])
+
+    def test_array_dependencies(self):
+
+        self.answer('sbatch', '50\n')
+        oppni.hpc['job_ids_grouped'] = {'PART1': {'s1': '20', 's2': '20'}, 'BASE': {'all_subjects': '30'}}
+        oppni.hpc['array_tasks'] = {'PART1': ['s1', 's2']}
+        job_id = oppni.submit_queue('--array=1-2 /jobs/spnorm_array.job', ['BASE', 'PART1'],
+                                    array_prefixes=['s1', 's2'])
+        self.assertEqual(job_id, '50')
+        # each task waits for its counterpart in the array of the same subjects
+        self.assertEqual(self.calls('sbatch'), [['--parsable', '--dependency=afterok:30,aftercorr:20', '--array=1-2',
+                                                 '/jobs/spnorm_array.job']])
+
+    def test_rejected(self):
+
+        os.remove(os.path.join(self.fake_dir, 'sbatch'))
+        with open(os.path.join(self.fake_dir, 'sbatch'), 'w') as cf:
+            cf.write('#!/bin/sh\nexit 1\n')
+        os.chmod(os.path.join(self.fake_dir, 'sbatch'), stat.S_IRWXU)
+        self.assertRaises(Exception, oppni.submit_queue, '/jobs/part1.job', None)
+
+
+class TestStatus(FakeSlurmTest):
+
+    def test_states(self):
+
+        self.answer('squeue', '60|RUNNING|None\n61_1|PENDING|Dependency\n61_2|PENDING|JobHeldUser\n')
+        self.answer('sacct', '62|COMPLETED\n63|CANCELLED by 1234\n')
+        states = queue_status.job_states('SLURM', ['60', '61', '62', '63'])
+        self.assertEqual(states, {'60': ['running'], '61': ['queued', 'held'], '62': ['done'], '63': ['failed']})
+
+        self.assertIn('--format=%i|%T|%r', self.calls('squeue')[0])
+        # a single sacct, for the jobs that left the queue
+        self.assertEqual(len(self.calls('sacct')), 1)
+        self.assertEqual(self.calls('sacct')[0][-2:], ['--jobs', '62,63'])
+
+    def test_without_sacct(self):
+
+        os.remove(os.path.join(self.fake_dir, 'sacct'))
+        self.answer('squeue', '60|RUNNING|None\n')
+        self.assertEqual(queue_status.job_states('SLURM', ['60', '62']), {'60': ['running']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Listings of status_index, saved across status checks, in temporary folders.
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import status_index
+
+
+def write_file(path, content):
+
+    with open(path, 'w') as fp:
+        fp.write(content)
+
+
+class TestStatusIndex(unittest.TestCase):
+
+    def setUp(self):
+
+        self.root = tempfile.mkdtemp()
+        self.folder = os.path.join(self.root, 'afni_processed')
+        os.mkdir(self.folder)
+        write_file(os.path.join(self.folder, 'sub1_m1.nii'), 'x' * 10)
+        write_file(os.path.join(self.folder, 'sub1_m2.nii'), 'x' * 20)
+        self.settle(self.folder)
+
+    def tearDown(self):
+
+        shutil.rmtree(self.root)
+
+    def settle(self, folder, age_sec=100):
+        """Dates the last change of a folder back, out of the racy window."""
+
+        past = time.time() - age_sec
+        os.utime(folder, (past, past))
+
+    def test_scan_folder(self):
+
+        record, listed = status_index.scan_folder(self.folder)
+        self.assertTrue(listed)
+        self.assertEqual(sorted(record['entries'].keys()), ['sub1_m1.nii', 'sub1_m2.nii'])
+        self.assertEqual(record['entries']['sub1_m2.nii'][0], 20)
+
+        # unchanged, so not listed again
+        again, listed = status_index.scan_folder(self.folder, record)
+        self.assertFalse(listed)
+        self.assertIs(again, record)
+
+    def test_scan_missing_folder(self):
+
+        self.assertEqual(status_index.scan_folder(os.path.join(self.root, 'missing')), (None, False))
+
+    def test_scan_changed_folder(self):
+
+        record, _ = status_index.scan_folder(self.folder)
+        write_file(os.path.join(self.folder, 'sub1_m3.nii'), 'x' * 30)
+        self.settle(self.folder, age_sec=50)
+
+        again, listed = status_index.scan_folder(self.folder, record)
+        self.assertTrue(listed)
+        self.assertEqual(again['entries']['sub1_m3.nii'][0], 30)
+        # entries seen before are not stat'ed again
+        self.assertIs(again['entries']['sub1_m1.nii'], record['entries']['sub1_m1.nii'])
+
+    def test_racy_window(self):
+
+        write_file(os.path.join(self.folder, 'sub1_m3.nii'), 'x')
+        record, _ = status_index.scan_folder(self.folder)
+        # could still change within the same mtime, so it is listed again next time
+        self.assertIsNone(record['mtime'])
+        self.assertTrue(status_index.scan_folder(self.folder, record)[1])
+
+    def test_queries(self):
+
+        index = status_index.StatusIndex()
+        self.assertTrue(index.exists(os.path.join(self.folder, 'sub1_m1.nii')))
+        self.assertFalse(index.exists(os.path.join(self.folder, 'sub1_m9.nii')))
+        self.assertFalse(index.exists(os.path.join(self.root, 'missing', 'sub1_m1.nii')))
+        self.assertEqual(index.size(os.path.join(self.folder, 'sub1_m2.nii')), 20)
+        self.assertIsNone(index.size(os.path.join(self.folder, 'sub1_m9.nii')))
+        self.assertEqual(sorted(index.glob(self.folder, 'sub1_m*.nii')), ['sub1_m1.nii', 'sub1_m2.nii'])
+
+        # answered from memory for the rest of the session
+        write_file(os.path.join(self.folder, 'sub1_m3.nii'), 'x')
+        self.assertFalse(index.exists(os.path.join(self.folder, 'sub1_m3.nii')))
+        self.assertEqual(index.num_listed, 1)
+
+    def test_refresh(self):
+
+        other = os.path.join(self.root, 'masks')
+        os.mkdir(other)
+        index = status_index.StatusIndex()
+        index.refresh([self.folder, other, os.path.join(self.root, 'missing')], num_threads=2)
+        self.assertEqual(index.num_listed, 2)
+        self.assertEqual(sorted(index.folders.keys()), sorted([self.folder, other]))
+        self.assertEqual(len(index.checked), 3)
+
+    def test_save_and_load(self):
+
+        index_path = os.path.join(self.root, 'status_index.json')
+        index = status_index.StatusIndex(index_path)
+        index.refresh([self.folder])
+        index.save()
+
+        loaded = status_index.StatusIndex(index_path)
+        self.assertEqual(loaded.size(os.path.join(self.folder, 'sub1_m1.nii')), 10)
+        self.assertEqual((loaded.num_listed, loaded.num_cached), (0, 1))
+        # replaced at once, without leaving the temporary file behind
+        self.assertEqual(sorted(os.listdir(self.root)), ['afni_processed', 'status_index.json'])
+
+    def test_incompatible_index(self):
+
+        index_path = os.path.join(self.root, 'status_index.json')
+        with open(index_path, 'w') as idx:
+            json.dump({'version': status_index.index_version + 1, 'folders': {self.folder: None}}, idx)
+        self.assertEqual(status_index.StatusIndex(index_path).folders, dict())
+
+        write_file(index_path, '{"version": 1, "fold')
+        self.assertEqual(status_index.StatusIndex(index_path).folders, dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Bulk submissions of submission.Submitter, through an executor answering from memory.
+
+import threading
+import time
+import unittest
+from collections import OrderedDict
+
+import submission
+
+
+class FakeExecutor(object):
+    """Numbers the jobs submitted, failing those whose job file is in fail, and reports the states in states."""
+
+    def __init__(self, fail=(), states=None):
+
+        self.fail = set(fail)
+        self.states = states
+        self.submitted = list()
+        self.num_queries = 0
+        self.lock = threading.Lock()
+
+    def submit(self, job_args, depends_on=(), task_depends_on=()):
+
+        if job_args[-1] in self.fail:
+            raise RuntimeError('qsub: rejected')
+        with self.lock:
+            self.submitted.append(job_args[-1])
+            return str(len(self.submitted))
+
+    def status(self, job_ids):
+
+        self.num_queries += 1
+        if self.states is None:
+            return None
+        return dict((job_id, self.states.get(job_id, ['done'])) for job_id in job_ids)
+
+
+class TestSubmitter(unittest.TestCase):
+
+    def setUp(self):
+
+        self.queue_poll_sec = submission.queue_poll_sec
+        submission.queue_poll_sec = 0.01
+        self.messages = list()
+
+    def tearDown(self):
+
+        submission.queue_poll_sec = self.queue_poll_sec
+
+    def make_submitter(self, executor, **kwargs):
+
+        submitter = submission.Submitter(executor, **kwargs)
+        submitter.report = self.messages.append
+        return submitter
+
+    def test_submit_many(self):
+
+        executor = FakeExecutor()
+        submitter = self.make_submitter(executor, num_threads=4)
+        submissions = OrderedDict(('sub{}'.format(idx), (['job{}.sh'.format(idx)], (), ())) for idx in range(20))
+        job_ids = submitter.submit_many(submissions)
+
+        # in the order of the submissions, whatever the order they went in
+        self.assertEqual(job_ids.keys(), submissions.keys())
+        self.assertEqual(sorted(job_ids.values(), key=int), [str(idx) for idx in range(1, 21)])
+        for key, job_id in job_ids.items():
+            self.assertEqual(executor.submitted[int(job_id) - 1], 'job{}.sh'.format(key[3:]))
+
+    def test_submit_none(self):
+
+        self.assertEqual(self.make_submitter(FakeExecutor()).submit_many(OrderedDict()), OrderedDict())
+
+    def test_failures(self):
+
+        executor = FakeExecutor(fail=['job1.sh', 'job3.sh'])
+        submitter = self.make_submitter(executor)
+        submissions = OrderedDict(('sub{}'.format(idx), (['job{}.sh'.format(idx)], (), ())) for idx in range(5))
+
+        with self.assertRaises(submission.SubmissionError) as raised:
+            submitter.submit_many(submissions)
+        # the ids of the jobs submitted are not lost
+        self.assertEqual(raised.exception.job_ids.keys(), ['sub0', 'sub2', 'sub4'])
+        self.assertIn('2 of 5 jobs could not be submitted', str(raised.exception))
+        self.assertEqual(len([msg for msg in self.messages if msg.startswith('submission of')]), 2)
+
+    def test_refresh_queued(self):
+
+        executor = FakeExecutor(states={'1': ['done'], '2': ['running', 'done', 'queued'], '3': ['error']})
+        submitter = self.make_submitter(executor)
+        submitter.queued = OrderedDict([('1', 1), ('2', 3), ('3', 1), ('4', 1)])
+        submitter.refresh_queued()
+
+        # jobs stuck in an error state, or unknown to the scheduler, are no longer waited for
+        self.assertEqual(submitter.queued, OrderedDict([('2', 2)]))
+        self.assertTrue(any('job 3 is stuck in an error state' in msg for msg in self.messages))
+
+    def test_refresh_unknown(self):
+
+        submitter = self.make_submitter(FakeExecutor(states=None))
+        submitter.queued = OrderedDict([('1', 1)])
+        submitter.refresh_queued()
+        self.assertEqual(submitter.queued, OrderedDict([('1', 1)]))
+
+    def test_cap_of_the_queue(self):
+
+        executor = FakeExecutor(states=dict())
+        submitter = self.make_submitter(executor, num_threads=4, max_queued=2)
+        submissions = OrderedDict(('sub{}'.format(idx), (['job{}.sh'.format(idx)], (), ())) for idx in range(6))
+        job_ids = submitter.submit_many(submissions)
+
+        self.assertEqual(len(job_ids), 6)
+        # held back until the earlier jobs drained
+        self.assertGreater(executor.num_queries, 0)
+        self.assertLessEqual(submitter.num_queued(), 2)
+
+    def test_larger_than_the_cap(self):
+
+        executor = FakeExecutor(states=dict())
+        submitter = self.make_submitter(executor, max_queued=2)
+        # goes in once the queue is empty, rather than never
+        self.assertEqual(submitter.submit(['array.sh'], num_tasks=10), '1')
+        self.assertEqual(executor.num_queries, 0)
+        self.assertEqual(submitter.num_queued(), 10)
+
+    def test_rate(self):
+
+        submitter = self.make_submitter(FakeExecutor(), num_threads=4, rate=100)
+        submissions = OrderedDict(('sub{}'.format(idx), (['job{}.sh'.format(idx)], (), ())) for idx in range(6))
+        start = time.time()
+        submitter.submit_many(submissions)
+        # the first one goes at once
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
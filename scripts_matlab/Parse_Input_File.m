@@ -33,11 +33,14 @@ ifile = strfind( upper(tline), 'OUT=' ); ifile = ifile+4;
 ips   = [strfind( tline, ' ' )-1 length(tline)];
 ips   = ips(ips>ifile);
 [Output_nifti_file_path_temp,Output_nifti_file_prefix,ext] = fileparts(tline(ifile:ips(1)));
+% only the .nii extension is stripped, as the prefixes may contain other dots
+Output_nifti_file_prefix = [Output_nifti_file_prefix ext];
 
 if(isempty(strfind(Output_nifti_file_prefix,',')))
      Output_nifti_file_prefix = cellstr(Output_nifti_file_prefix);
 else Output_nifti_file_prefix = regexp(Output_nifti_file_prefix,',','split');
 end
+Output_nifti_file_prefix = regexprep(Output_nifti_file_prefix,'\.nii$','');
 
 if length(Output_nifti_file_prefix)~=N_run
     display(sprintf('Error the number of output prefixes does not match with the number of inputs, please check the line %s',tline));
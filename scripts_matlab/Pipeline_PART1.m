@@ -1,4 +1,4 @@
-function Pipeline_PART1(InputStruct, input_pipeset, analysis_model, modelparam, niiout, contrast_list_str, dospnormfirst, DEOBLIQUE, TPATTERN, TOFWHM)
+function Pipeline_PART1(InputStruct, input_pipeset, analysis_model, modelparam, niiout, contrast_list_str, dospnormfirst, DEOBLIQUE, TPATTERN, TOFWHM, afni_pipeset, shard)
 %
 %==========================================================================
 % PIPELINE_PART1 : main script used for running pipelines and obtaining
@@ -7,14 +7,16 @@ function Pipeline_PART1(InputStruct, input_pipeset, analysis_model, modelparam,
 %
 % SYNTAX:
 %
-%   Pipeline_PART1(InputStruct, input_pipeset, analysis_model, modelparam, niiout, contrast_list_str, dospnormfirst, DEOBLIQUE, TPATTERN)
+%   Pipeline_PART1(InputStruct, input_pipeset, analysis_model, modelparam, niiout, contrast_list_str, dospnormfirst, DEOBLIQUE, TPATTERN, TOFWHM, afni_pipeset, shard)
 %
 % INPUT:
 %
 %   InputStruct    = string specifying "input" textfile (path/name),
 %                   containing subject information
 %   input_pipeset  = string specifying "pipeline" textfile (path/name),
-%                   listing all preprocessing pipelines to test
+%                   listing all preprocessing pipelines to test (all the
+%                   combinations of the options of the steps, or only those
+%                   it lists as SELECTED - see get_pipe_list)
 %   analysis_model= string specifying choice of pipeline analysis model.
 %                   Choices include:
 %
@@ -36,6 +38,18 @@ function Pipeline_PART1(InputStruct, input_pipeset, analysis_model, modelparam,
 %                  1 or 'altplus' = default interleaved ascending
 %                  'altminus' = interleaved descending
 %                  'seqplus', 'seqminus' = sequential ascending, descending
+%  afni_pipeset(optional) = string specifying a reduced "pipeline" textfile, limiting the
+%                  AFNI-based preprocessing to the pipeline combinations it lists
+%                  (e.g. those missing after a failed run). Metrics are still
+%                  computed for all the pipelines in input_pipeset
+%  shard(optional) = string, when Part 1 of a subject is split into several jobs
+%                  (see merge_part1_shards):
+%                    'base'   : only runs the AFNI-based preprocessing, for all the
+%                               pipelines, which the shards share
+%                    '<name>' : skips the AFNI-based preprocessing, and computes the
+%                               metrics of the pipelines in input_pipeset (a subset of
+%                               the combinations) only, saving the output matfiles with
+%                               the suffix _<name>, to be merged
 %
 % OUTPUT:
 %
@@ -225,7 +239,7 @@ if ~isstruct(InputStruct)
 end
 
 %% acquire a list of all pipeline choices
-[pipeset_half, detSet, mprSet, tskSet, phySet, gsSet, lpSet, Nhalf, Nfull] = get_pipe_list(input_pipeset);
+[pipeset_half, detSet, mprSet, tskSet, phySet, gsSet, lpSet, Nhalf, Nfull, selSet] = get_pipe_list(input_pipeset);
 pipeset_full = zeros( Nfull, 10 );
 
 if numel(InputStruct(1).run)>1
@@ -240,20 +254,43 @@ check_input_file_integrity(InputStruct,max(pipeset_half(:,3)),max(tskSet));
 %% now, defining contrasts for analysis
 InputStruct = interpret_contrast_list_str(InputStruct,modelparam,analysis_model,contrast_list_str);             % generate contrast list for each subject and run
 
+%% check if Part 1 is split into shards
+if nargin<12 || isempty(shard)
+    shard  = '';
+    suffix = '';
+elseif strcmpi(shard,'base')
+    suffix = '';
+else
+    suffix = ['_' shard];
+end
+
 %% run all AFNI-based preprocessing steps
-Pipeline_PART1_afni_steps(InputStruct, pipeset_half, dospnormfirst,DEOBLIQUE,TPATTERN,TOFWHM );
+% (done once for all the shards of a subject, by its base job)
+if isempty(suffix)
+    if nargin<11 || isempty(afni_pipeset)
+        afni_pipeset_half = pipeset_half;
+    else
+        % resubmission: only the pipeline combinations missing for this subject
+        afni_pipeset_half = get_pipe_list(afni_pipeset);
+    end
+    Pipeline_PART1_afni_steps(InputStruct, afni_pipeset_half, dospnormfirst,DEOBLIQUE,TPATTERN,TOFWHM );
 
-spatial_normalization_noise_roi(InputStruct); % Transform user defined 
+    spatial_normalization_noise_roi(InputStruct); % Transform user defined 
 
-%% save generated split_info files
-for ksub = 1:numel(InputStruct)
-    for krun = 1:numel(InputStruct(ksub).run)
-        mkdir_r([InputStruct(ksub).run(krun).Output_nifti_file_path '/intermediate_processed/split_info']);
-        split_info = InputStruct(ksub).run(krun).split_info;
-        save([InputStruct(ksub).run(krun).Output_nifti_file_path '/intermediate_processed/split_info/' InputStruct(ksub).run(krun).Output_nifti_file_prefix '.mat'],'split_info','CODE_PROPERTY','-v7');
+    %% save generated split_info files
+    for ksub = 1:numel(InputStruct)
+        for krun = 1:numel(InputStruct(ksub).run)
+            mkdir_r([InputStruct(ksub).run(krun).Output_nifti_file_path '/intermediate_processed/split_info']);
+            split_info = InputStruct(ksub).run(krun).split_info;
+            save([InputStruct(ksub).run(krun).Output_nifti_file_path '/intermediate_processed/split_info/' InputStruct(ksub).run(krun).Output_nifti_file_prefix '.mat'],'split_info','CODE_PROPERTY','-v7');
+        end
     end
+    clear split_info
+end
+if strcmpi(shard,'base')
+    disp('AFNI-based preprocessing done - the metrics are computed by the shards.');
+    return;
 end
-clear split_info
 
 %%
 for ksub = 1:numel(InputStruct)
@@ -267,8 +304,7 @@ for ksub = 1:numel(InputStruct)
     kcount = 0;
     
     %%%% Check if output files already exist %%%%
-    suffix='';
-    chk0 = exist( [Subject_OutputDirIntermed,'/res0_params/params' subjectprefix '.mat'], 'file' );
+    chk0 = exist( [Subject_OutputDirIntermed,'/res0_params/params' subjectprefix suffix '.mat'], 'file' );
     chk1 = exist( [Subject_OutputDirIntermed,'/res1_spms/spms', subjectprefix,suffix,'.mat'], 'file' );
     chk2 = exist( [Subject_OutputDirIntermed,'/res2_temp/temp', subjectprefix,suffix,'.mat'], 'file' );
     chk3 = exist( [Subject_OutputDirIntermed,'/res3_stats/stats',subjectprefix,suffix,'.mat'], 'file' );
@@ -428,7 +464,7 @@ for ksub = 1:numel(InputStruct)
             split_info_set{1}.mask_vol    = mask;
         end
 
-        save([Subject_OutputDirIntermed '/res0_params/params' subjectprefix '.mat'],'split_info_set','Xsignal','Xnoise','modelparam','CODE_PROPERTY','-v7');
+        save([Subject_OutputDirIntermed '/res0_params/params' subjectprefix suffix '.mat'],'split_info_set','Xsignal','Xnoise','modelparam','CODE_PROPERTY','-v7');
 
         % initialize cell array for activation maps, one cell per pipeline
         IMAGE_set_0  = cell( Nfull, 1 );
@@ -500,6 +536,11 @@ for ksub = 1:numel(InputStruct)
                         for GS  = gsSet
                             for LP = lpSet
 
+                            % only the combinations selected, if the pipeline file lists them
+                            if ~isempty(selSet) && ~ismember( [pipeset_half(i,:) DET MPR TASK GS LP], selSet, 'rows' )
+                                continue;
+                            end
+
                             kall = kall + 1;
                             % full list of preprocessing choices for this pipeline step
                             pipeset_full(kall,:) = [pipeset_half(i,:) DET MPR TASK GS LP];
@@ -575,7 +616,6 @@ for ksub = 1:numel(InputStruct)
 
             % save output matfiles
             %
-            suffix = '';
             if  ~exist('OCTAVE_VERSION','builtin')
                 save(strcat(Subject_OutputDirIntermed,'/res1_spms/spms', subjectprefix,suffix,'.mat'),'IMAGE_set','modelparam','CODE_PROPERTY');
                 save(strcat(Subject_OutputDirIntermed,'/res2_temp/temp', subjectprefix,suffix,'.mat'),'TEMP_set','modelparam','CODE_PROPERTY');
@@ -589,51 +629,9 @@ for ksub = 1:numel(InputStruct)
             % ------------------------------------------------------------------------------------------------
             % ------------------------------------------------------------------------------------------------
 
-            if    (niiout>0)
-
-                %---------- now, brain maps
-
-                if( strcmp( modeltype, 'one_component') )
-
-                    disp('Only 1 image per pipeline. Concatenating all NIFTIS into single 4D matrix');
-
-                    TMPVOL = zeros( [size(mask), Nfull] );
-
-                    for(n=1:Nfull )
-                        tmp=mask;tmp(tmp>0)=IMAGE_set{n};
-                        TMPVOL(:,:,:,n) = tmp;
-                    end
-
-                    nii=VV;
-                    nii.img = TMPVOL;
-                    nii.hdr.dime.datatype = 16;
-                    nii.hdr.hist = VV.hdr.hist;
-                    nii.hdr.dime.dim(5) = Nfull;
-                    nii.hdr.hist.descrip = CODE_PROPERTY.NII_HEADER;
-                    save_untouch_nii(nii,strcat(Subject_OutputDirOptimize,'/spms/rSPM_',subjectprefix,suffix,'_pipelines_all.nii'));
-                else
-
-                    disp('Multiple images per pipeline. Producing 4D volume for each pipeline');
-
-                    for(n=1:Nfull )
-
-                        TMPVOL = zeros( [size(mask), size(IMAGE_set{n},2)] );
-
-                        for(p=1:size(IMAGE_set{n},2) )
-                            tmp=mask;tmp(tmp>0)=IMAGE_set{n}(:,p);
-                            TMPVOL(:,:,:,p) = tmp;
-                        end
-
-                        nii=VV;
-                        nii.img = TMPVOL;
-                        nii.hdr.dime.datatype = 16;
-                        nii.hdr.hist = VV.hdr.hist;
-                        nii.hdr.dime.dim(5) = size(IMAGE_set{n},2);
-                        pipeline_name = generate_pipeline_name(pipechars,pipeset(n,:));
-                        nii.hdr.hist.descrip = CODE_PROPERTY.NII_HEADER;
-                        save_untouch_nii(nii,strcat(Subject_OutputDirOptimize,'/spms/rSPM_',subjectprefix,'_pipeline_',num2str(n),'_',num2str(p),'vols.nii'));
-                    end
-                end
+            % brain maps of the shards are saved once merged
+            if (niiout>0) && isempty(suffix)
+                save_pipeline_spms(IMAGE_set, Nfull, modeltype, mask, VV, Subject_OutputDirOptimize, subjectprefix);
             end
 
         end
@@ -1,4 +1,4 @@
-function Pipeline_PART2( InputStruct, optimize_metric, mot_gs_control, process_out, keepmean, whichpipes)
+function pipeline_sets = Pipeline_PART2( InputStruct, optimize_metric, mot_gs_control, process_out, keepmean, whichpipes, stage, selection_file)
 %
 %==========================================================================
 % PIPELINE_PART2 : this step identifies optimal pipelines, and produces
@@ -8,7 +8,7 @@ function Pipeline_PART2( InputStruct, optimize_metric, mot_gs_control, process_o
 %
 % SYNTAX:
 %
-%   Pipeline_PART2( InputStruct, optimize_metric, mot_gs_control, process_out, keepmean)
+%   pipeline_sets = Pipeline_PART2( InputStruct, optimize_metric, mot_gs_control, process_out, keepmean, whichpipes, stage, selection_file)
 %
 % INPUT:
 %
@@ -30,9 +30,28 @@ function Pipeline_PART2( InputStruct, optimize_metric, mot_gs_control, process_o
 %                       0=no, 1=yes (includes 3 fixed pipelines; 1 individually optimized)
 %   keepmean       = binary flag, determines if voxel means are re-added to
 %                    optimally processed data
+%   stage(optional)= string, when the optimization is split into jobs, to
+%                    run on large datasets:
+%                       'SELECT'  = selects the optimal pipelines, loading
+%                                   the stats of all the subjects only, and
+%                                   saves them in optimization_selection.mat
+%                       'SUBJECT' = produces the outputs of the subject(s)
+%                                   in InputStruct, with the pipelines
+%                                   selected by the SELECT job
+%                       'SUMMARY' = gathers the outputs of all the subjects
+%                                   in optimization_summary.mat
+%                    default 'ALL' does all of the above at once
+%   selection_file(optional) = path of the .mat file the SELECT job saves
+%                    the selected pipelines in, for the SUBJECT and SUMMARY
+%                    jobs to load; by default, optimization_selection.mat in
+%                    the output folder of the first subject
 %
 % OUTPUT:
 %
+%   pipeline_sets  = the optimal pipelines, as saved in optimization_summary.mat
+%                    (see below). Returned even when process_out=0, which
+%                    writes no outputs (to select the pipelines of a pilot)
+%
 %   (1) Set of Matlab/Octave data, in .mat file named:
 %       [outputdirectory,'/optimization_results/matfiles/optimization_summary.mat']
 %
@@ -170,6 +189,16 @@ end
 
 whichpipes = upper(whichpipes);
 
+% stage of the optimization split into jobs
+if  nargin<7 || isempty( stage )
+       stage = 'ALL';
+elseif ~ismember(upper(stage),{'ALL','SELECT','SUBJECT','SUMMARY'})
+       error('for "stage" argument, needs to be ALL, SELECT, SUBJECT or SUMMARY');
+end
+stage = upper(stage);
+% the SUBJECT and SUMMARY jobs use the pipelines selected by the SELECT job
+load_selection = strcmp(stage,'SUBJECT') || strcmp(stage,'SUMMARY');
+
 output_notes{1} = CODE_PROPERTY.NII_HEADER;
 output_notes{2} = ['optimization metric: ' optimize_metric];
 
@@ -203,11 +232,27 @@ for ksub = 1:Nsubject
     Nrun(ksub) = numel(InputStruct(ksub).run);
 end
 
-%% check for multiple pipelines - load first subject
-load(strcat(InputStruct(1).run(1).Output_nifti_file_path, '/intermediate_metrics/res3_stats/stats',InputStruct(1).run(1).subjectprefix,'.mat'));
-metric_names = fieldnames( METRIC_set{1} );
+% pipelines selected for the dataset, shared by the jobs of the optimization
+% (the SUBJECT jobs only know their own subject, so they must be given the file of the SELECT job)
+if  nargin<8 || isempty( selection_file )
+    selection_file = strcat(InputStruct(1).run(1).Output_nifti_file_path,'/optimization_results/matfiles/optimization_selection.mat');
+end
+
+if load_selection
+    %% pipelines selected by the SELECT job (subject_prefixes lists the subjects, in the order of its InputStruct)
+    load(selection_file);
+else
+    for ksub = 1:Nsubject
+        subject_prefixes{ksub,1} = InputStruct(ksub).run(1).subjectprefix;
+    end
 
-if(length(METRIC_set)>1) %% if more than one pipeline found, we do optimization...
+    %% check for multiple pipelines - load first subject
+    load(strcat(InputStruct(1).run(1).Output_nifti_file_path, '/intermediate_metrics/res3_stats/stats',InputStruct(1).run(1).subjectprefix,'.mat'));
+    metric_names = fieldnames( METRIC_set{1} );
+    multi_pipe   = (length(METRIC_set)>1);
+end
+
+if( multi_pipe && ~load_selection ) %% if more than one pipeline found, we do optimization...
     
     disp('Now selecting optimal pipelines...');
     
@@ -529,6 +574,26 @@ if(length(METRIC_set)>1) %% if more than one pipeline found, we do optimization.
     pipeline_sets.pipechars = pipechars;
     pipeline_sets.pipenames = pipenames;
 
+elseif( ~load_selection ) %% If only 1 pipeline being tested, this becomes the default output
+
+    pipeline_sets.pipe1 = pipeset; %
+    %  save pipeline names / representative characters
+    pipeline_sets.pipechars = pipechars;
+    pipeline_sets.pipenames = pipenames;
+end
+
+if strcmp(stage,'SELECT')
+    if( multi_pipe )
+        save(selection_file,'subject_prefixes','multi_pipe','pipeline_sets','METRIC_opt','metric_names','ibase','irank','iind','TR_MSEC','-v7');
+    else
+        save(selection_file,'subject_prefixes','multi_pipe','pipeline_sets','-v7');
+    end
+    disp('Optimal pipelines selected - the outputs are produced by the jobs of each subject.');
+    return;
+end
+
+if( multi_pipe )
+
     %% [IV] NOW GENERATE PREPROCESSED DATA
 
     if( process_out > 0 ) %% only if option turned on
@@ -537,6 +602,20 @@ if(length(METRIC_set)>1) %% if more than one pipeline found, we do optimization.
 
         for ksub = 1:Nsubject
 
+            % index of the subject among those the pipelines were selected on
+            kopt = find( strcmp( subject_prefixes, InputStruct(ksub).run(1).subjectprefix ), 1 );
+            if isempty(kopt)
+                error('%s is not among the subjects the pipelines were selected on - rerun the optimization.', InputStruct(ksub).run(1).subjectprefix);
+            end
+
+            if strcmp(stage,'SUMMARY')
+                % outputs of the subject, produced by its own job
+                SV = load([InputStruct(ksub).run(1).Output_nifti_file_path,'/optimization_results/matfiles/opt_' optimize_metric InputStruct(ksub).run(1).subjectprefix '.mat']);
+                SPM_opt{ksub}  = SV.SPM_opt;
+                TEMP_opt{ksub} = SV.TEMP_opt;
+                continue;
+            end
+
             % Read the subject directory
             MM = load_untouch_nii( InputStruct(ksub).run(1).subjectmask );
             load([InputStruct(ksub).run(1).Output_nifti_file_path, '/intermediate_metrics/res0_params/params' InputStruct(ksub).run(1).subjectprefix '.mat']);        
@@ -546,12 +625,12 @@ if(length(METRIC_set)>1) %% if more than one pipeline found, we do optimization.
             % load optimal data (spms+timeseries) into cell arrays
             SPM_opt{ksub}.con = IMAGE_set{ibase     };
             SPM_opt{ksub}.fix = IMAGE_set{irank     };
-            SPM_opt{ksub}.ind = IMAGE_set{iind(ksub)};
+            SPM_opt{ksub}.ind = IMAGE_set{iind(kopt)};
 
             %---
             TEMP_opt{ksub}.con = TEMP_set{ibase      };
             TEMP_opt{ksub}.fix = TEMP_set{irank      };
-            TEMP_opt{ksub}.ind = TEMP_set{iind(ksub) };
+            TEMP_opt{ksub}.ind = TEMP_set{iind(kopt) };
 
             if strcmpi(whichpipes,'ALL') %%%%%%%%%%%%%%%%%%%%%%%%%%%%%%% PRODUCE ALL SPMS
                 
@@ -581,28 +660,28 @@ if(length(METRIC_set)>1) %% if more than one pipeline found, we do optimization.
             
                 
             %% select additional preprocessing choices (Step2) for current pipeline
-            pipe_temp = [pipeline_sets.con;pipeline_sets.fix;pipeline_sets.ind(ksub,:);pipeline_sets.min; pipeline_sets.max;];
+            pipe_temp = [pipeline_sets.con;pipeline_sets.fix;pipeline_sets.ind(kopt,:);pipeline_sets.min; pipeline_sets.max;];
 
             %% Save optimum parameters for each subject in the pipeline
             SV.pipeline_sets = pipeline_sets;
-            SV.pipeline_sets.ind = pipeline_sets.ind(ksub,:);
-            SV.pipeline_sets.ind = pipeline_sets.ind(ksub,:);
+            SV.pipeline_sets.ind = pipeline_sets.ind(kopt,:);
+            SV.pipeline_sets.ind = pipeline_sets.ind(kopt,:);
             SV.pipeline_sets.ind_for_the_group = pipeline_sets.ind;
             %SV.METRIC_opt = METRIC_opt;
             for metric_counter = 1:length(metric_names)
                 if (~strcmp(metric_names{metric_counter},'artifact_prior') && ~strcmp(metric_names{metric_counter},'cond_struc'))
-                    SV.METRIC_opt.con.(metric_names{metric_counter})=METRIC_opt.con.(metric_names{metric_counter})(ksub,1);
-                    SV.METRIC_opt.fix.(metric_names{metric_counter})=METRIC_opt.fix.(metric_names{metric_counter})(ksub,1);
-                    SV.METRIC_opt.ind.(metric_names{metric_counter})=METRIC_opt.ind.(metric_names{metric_counter})(ksub,1);
-                    SV.METRIC_opt.min.(metric_names{metric_counter})=METRIC_opt.min.(metric_names{metric_counter})(ksub,1);
-                    SV.METRIC_opt.max.(metric_names{metric_counter})=METRIC_opt.max.(metric_names{metric_counter})(ksub,1);
+                    SV.METRIC_opt.con.(metric_names{metric_counter})=METRIC_opt.con.(metric_names{metric_counter})(kopt,1);
+                    SV.METRIC_opt.fix.(metric_names{metric_counter})=METRIC_opt.fix.(metric_names{metric_counter})(kopt,1);
+                    SV.METRIC_opt.ind.(metric_names{metric_counter})=METRIC_opt.ind.(metric_names{metric_counter})(kopt,1);
+                    SV.METRIC_opt.min.(metric_names{metric_counter})=METRIC_opt.min.(metric_names{metric_counter})(kopt,1);
+                    SV.METRIC_opt.max.(metric_names{metric_counter})=METRIC_opt.max.(metric_names{metric_counter})(kopt,1);
                 end
             end
 
             SV.SPM_opt  = SPM_opt{ksub};
             SV.TEMP_opt = TEMP_opt{ksub};
             SV.nii_mask = MM;
-            SV.ksub     = ksub;
+            SV.ksub     = kopt;
             save([InputStruct(ksub).run(1).Output_nifti_file_path,'/optimization_results/matfiles/opt_' optimize_metric InputStruct(ksub).run(1).subjectprefix '.mat'],'-struct','SV','-v7');
             save([InputStruct(ksub).run(1).Output_nifti_file_path,'/optimization_results/matfiles/opt_' optimize_metric InputStruct(ksub).run(1).subjectprefix '.mat'],'CODE_PROPERTY','-append');
 
@@ -675,16 +754,13 @@ if(length(METRIC_set)>1) %% if more than one pipeline found, we do optimization.
                 end
             end
         end
-        save(strcat(InputStruct(1).run(1).Output_nifti_file_path,'/optimization_results/matfiles/optimization_summary.mat'),'SPM_opt','TEMP_opt', 'METRIC_opt','pipeline_sets','CODE_PROPERTY','-v7');
+        % the summary of all the subjects is saved by the SUMMARY job
+        if ~strcmp(stage,'SUBJECT')
+            save(strcat(InputStruct(1).run(1).Output_nifti_file_path,'/optimization_results/matfiles/optimization_summary.mat'),'SPM_opt','TEMP_opt', 'METRIC_opt','pipeline_sets','CODE_PROPERTY','-v7');
+        end
     end
 
-else %% If only 1 pipeline being tested, this becomes the default output
-    
-
-    pipeline_sets.pipe1 = pipeset; %
-    %  save pipeline names / representative characters
-    pipeline_sets.pipechars = pipechars;
-    pipeline_sets.pipenames = pipenames;
+else
 
     %% [IV] NOW GENERATE PREPROCESSED DATA
 
@@ -692,6 +768,21 @@ else %% If only 1 pipeline being tested, this becomes the default output
 
         for ksub = 1:Nsubject
 
+            % index of the subject among those the pipelines were selected on
+            kopt = find( strcmp( subject_prefixes, InputStruct(ksub).run(1).subjectprefix ), 1 );
+            if isempty(kopt)
+                error('%s is not among the subjects the pipelines were selected on - rerun the optimization.', InputStruct(ksub).run(1).subjectprefix);
+            end
+
+            if strcmp(stage,'SUMMARY')
+                % outputs of the subject, produced by its own job
+                SV = load([InputStruct(ksub).run(1).Output_nifti_file_path,'/optimization_results/matfiles/opt_' optimize_metric InputStruct(ksub).run(1).subjectprefix '.mat']);
+                SPM_opt{ksub}    = SV.SPM_opt;
+                TEMP_opt{ksub}   = SV.TEMP_opt;
+                METRIC_opt{ksub} = SV.METRIC_opt{kopt};
+                continue;
+            end
+
             % Read the subject directory
             MM = load_untouch_nii( InputStruct(ksub).run(1).subjectmask );
             load([InputStruct(ksub).run(1).Output_nifti_file_path, '/intermediate_metrics/res0_params/params' InputStruct(ksub).run(1).subjectprefix '.mat']);        
@@ -704,7 +795,7 @@ else %% If only 1 pipeline being tested, this becomes the default output
             % load optimal data (spms+timeseries) into cell arrays
             SPM_opt{ksub}.pipe1     = IMAGE_set{1};
             TEMP_opt{ksub}.pipe1    = TEMP_set{1};
-            METRIC_opt{ksub}.pipe1 = METRIC_set{1};
+            METRIC_opt{kopt}.pipe1 = METRIC_set{1};
 
 
             SPMs = [SPM_opt{ksub}.pipe1];
@@ -729,7 +820,7 @@ else %% If only 1 pipeline being tested, this becomes the default output
             SV.METRIC_opt = METRIC_opt;
             
             SV.nii_mask = MM;
-            SV.ksub     = ksub;
+            SV.ksub     = kopt;
             save([InputStruct(ksub).run(1).Output_nifti_file_path,'/optimization_results/matfiles/opt_' optimize_metric InputStruct(ksub).run(1).subjectprefix '.mat'],'-struct','SV','-v7');
             save([InputStruct(ksub).run(1).Output_nifti_file_path,'/optimization_results/matfiles/opt_' optimize_metric InputStruct(ksub).run(1).subjectprefix '.mat'],'CODE_PROPERTY','-append');
 
@@ -795,7 +886,10 @@ else %% If only 1 pipeline being tested, this becomes the default output
                 end
             end
         end
-        save(strcat(InputStruct(1).run(1).Output_nifti_file_path,'/optimization_results/matfiles/optimization_summary.mat'),'SPM_opt','TEMP_opt', 'METRIC_opt','pipeline_sets','CODE_PROPERTY','-v7');
+        % the summary of all the subjects is saved by the SUMMARY job
+        if ~strcmp(stage,'SUBJECT')
+            save(strcat(InputStruct(1).run(1).Output_nifti_file_path,'/optimization_results/matfiles/optimization_summary.mat'),'SPM_opt','TEMP_opt', 'METRIC_opt','pipeline_sets','CODE_PROPERTY','-v7');
+        end
     else
         disp('You ran 1 pipeline, and chose not to create outputs? Why are you running this step again?');    
     end
@@ -1,4 +1,10 @@
-function [pipeset_half, detSet, mprSet, tskSet, phySet, gsSet, lpSet, Nhalf, Nfull] = get_pipe_list( filename )
+function [pipeset_half, detSet, mprSet, tskSet, phySet, gsSet, lpSet, Nhalf, Nfull, selSet] = get_pipe_list( filename )
+%
+% When the pipeline file lists the combinations selected (SELECTED=[...;...],
+% see select_pipelines), only those of the combinations of the options are
+% kept: pipeset_half only has the AFNI-based steps of some of them, Nfull
+% counts them, and selSet holds their first 10 choices (as in pipeset_full
+% of Pipeline_PART1), to skip the others. selSet is empty otherwise.
 
 % ------------------------------------------------------------------------%
 % Authors: Nathan Churchill, University of Toronto
@@ -187,3 +193,23 @@ end
 
 
 Nfull = Nhalf * length(detSet) * length(mprSet) * length(tskSet) * length(gsSet) * length(lpSet);
+
+% combinations selected
+selSet = [];
+iSel = strfind( upper(pipelinelist), 'SELECTED=' );
+if ~isempty(iSel)
+    bleft  = ileft (ileft >iSel(1));   bleft= bleft(1);
+    bright = iright(iright>iSel(1));  bright=bright(1);
+    selected = str2num( pipelinelist(bleft:bright) );
+    % only those among the combinations of the options
+    inGrid = ismember(selected(:,1),pipeset_half(:,1)) & ismember(selected(:,2),pipeset_half(:,2)) & ...
+             ismember(selected(:,3),pipeset_half(:,3)) & ismember(selected(:,4),pipeset_half(:,4)) & ...
+             ismember(selected(:,5),pipeset_half(:,5)) & ismember(selected(:,6),detSet) & ...
+             ismember(selected(:,7),mprSet) & ismember(selected(:,8),tskSet) & ...
+             ismember(selected(:,9),gsSet)  & ismember(selected(:,10),lpSet);
+    selSet = unique( selected(inGrid,1:10), 'rows' );
+
+    pipeset_half = pipeset_half( ismember( pipeset_half, selSet(:,1:5), 'rows' ), : );
+    Nhalf = size( pipeset_half, 1 );
+    Nfull = size( selSet, 1 );
+end
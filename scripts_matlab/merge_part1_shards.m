@@ -0,0 +1,161 @@
+function merge_part1_shards( InputStruct, input_pipeset, num_shards, niiout )
+%
+%==========================================================================
+% MERGE_PART1_SHARDS: merges the outputs of the shards Part 1 of each
+% subject is split into, each computing the metrics of a subset of the
+% pipeline combinations
+%==========================================================================
+%
+% SYNTAX:
+%
+%   merge_part1_shards( InputStruct, input_pipeset, num_shards, niiout )
+%
+% INPUT:
+%
+%   InputStruct    = string specifying the "input" textfile (path/name)
+%   input_pipeset  = string specifying the "pipeline" textfile of all the
+%                    combinations, which the shards split between them
+%   num_shards     = number of shards. The output matfiles of shard k (of N)
+%                    are saved by Pipeline_PART1 with the suffix _shard<k>of<N>
+%   niiout         = binary value, 1 to save the activation maps as niftis too,
+%                    as in Pipeline_PART1
+%
+% The params, spms, temp and stats matfiles of each subject are written as
+% Pipeline_PART1 would processing all the combinations at once, with the
+% pipelines in the same order, and the matfiles of the shards are removed.
+%
+% ------------------------------------------------------------------------%
+
+global CODE_PROPERTY
+read_version;
+
+if ischar(num_shards)
+    num_shards = str2double(num_shards);
+end
+if nargin<4 || isempty(niiout)
+    niiout = 0;
+elseif ischar(niiout)
+    niiout = str2double(niiout);
+end
+
+%% Read Inputfiles
+if ~isstruct(InputStruct)
+    [InputStruct] = Read_Input_File(InputStruct);
+end
+
+%% all the pipelines, in the order of Pipeline_PART1
+[pipeset_half, detSet, mprSet, tskSet, phySet, gsSet, lpSet, Nhalf, Nfull] = get_pipe_list(input_pipeset);
+pipeset_full = zeros( Nfull, 10 );
+kall = 0;
+for i=1:Nhalf
+    for DET = detSet
+        for MPR = mprSet
+            for TASK = tskSet
+                for GS  = gsSet
+                    for LP = lpSet
+                        kall = kall + 1;
+                        pipeset_full(kall,:) = [pipeset_half(i,:) DET MPR TASK GS LP];
+                    end
+                end
+            end
+        end
+    end
+end
+if( length(phySet) > 1 ) all_pipeset = [ pipeset_full zeros(Nfull,1); pipeset_full ones(Nfull,1) ];
+elseif( phySet == 0 )    all_pipeset = [ pipeset_full zeros(Nfull,1) ];
+elseif( phySet == 1 )    all_pipeset = [ pipeset_full ones(Nfull,1) ];
+end
+
+suffixes = cell( num_shards, 1 );
+for(k=1:num_shards)
+    suffixes{k} = sprintf('_shard%dof%d', k, num_shards);
+end
+
+for ksub = 1:numel(InputStruct)
+
+    Subject_OutputDirIntermed = [InputStruct(ksub).run(1).Output_nifti_file_path '/intermediate_metrics'];
+    Subject_OutputDirOptimize = [InputStruct(ksub).run(1).Output_nifti_file_path '/optimization_results'];
+    subjectprefix = InputStruct(ksub).run(1).subjectprefix;
+
+    params_file = [Subject_OutputDirIntermed '/res0_params/params' subjectprefix];
+    spms_file   = [Subject_OutputDirIntermed '/res1_spms/spms'     subjectprefix];
+    temp_file   = [Subject_OutputDirIntermed '/res2_temp/temp'     subjectprefix];
+    stats_file  = [Subject_OutputDirIntermed '/res3_stats/stats'   subjectprefix];
+
+    if ~exist([params_file suffixes{1} '.mat'],'file') && exist([params_file '.mat'],'file')
+        disp(['skipped merging the shards of ',subjectprefix,' --> merged already!']);
+        continue;
+    end
+    disp(['merging the ',num2str(num_shards),' shards of ',subjectprefix,'.']);
+
+    % no metrics without an analysis model, only the params
+    has_stats = exist([stats_file suffixes{1} '.mat'],'file');
+    if has_stats
+
+        IMAGE_set  = {};
+        TEMP_set   = {};
+        METRIC_set = {};
+        shard_pipeset = [];
+        for(k=1:num_shards)
+            spms  = load([spms_file  suffixes{k} '.mat']);
+            temp  = load([temp_file  suffixes{k} '.mat']);
+            stats = load([stats_file suffixes{k} '.mat']);
+            IMAGE_set     = [IMAGE_set;  spms.IMAGE_set(:)];
+            TEMP_set      = [TEMP_set;   temp.TEMP_set(:)];
+            METRIC_set    = [METRIC_set; stats.METRIC_set(:)];
+            shard_pipeset = [shard_pipeset; stats.pipeset];
+        end
+        clear spms temp
+
+        [found, loc] = ismember( all_pipeset, shard_pipeset, 'rows' );
+        if ~all(found)
+            error('The shards of %s lack %d of the pipelines of %s - rerun its Part 1.', subjectprefix, sum(~found), input_pipeset);
+        end
+        IMAGE_set  = IMAGE_set(loc);
+        TEMP_set   = TEMP_set(loc);
+        METRIC_set = METRIC_set(loc);
+        pipeset    = all_pipeset;
+
+        pipechars      = stats.pipechars;
+        pipenames      = stats.pipenames;
+        modeltype      = stats.modeltype;
+        analysis_model = stats.analysis_model;
+        modelparam     = stats.modelparam;
+
+        if  ~exist('OCTAVE_VERSION','builtin')
+            save([spms_file  '.mat'],'IMAGE_set','modelparam','CODE_PROPERTY');
+            save([temp_file  '.mat'],'TEMP_set','modelparam','CODE_PROPERTY');
+            save([stats_file '.mat'],'METRIC_set', 'pipechars', 'pipenames', 'pipeset','modeltype','analysis_model','CODE_PROPERTY','modelparam');
+        else
+            save([spms_file  '.mat'],'IMAGE_set','modelparam','CODE_PROPERTY','-mat7-binary');
+            save([temp_file  '.mat'],'TEMP_set','modelparam','CODE_PROPERTY', '-mat7-binary');
+            save([stats_file '.mat'],'METRIC_set', 'pipechars', 'pipenames', 'pipeset','modeltype','analysis_model','CODE_PROPERTY','modelparam', '-mat7-binary');
+        end
+
+        if (niiout>0)
+            if numel(InputStruct(ksub).run)>1
+                 aligned_suffix = '_aligned';
+            else aligned_suffix = '';
+            end
+            MM = load_untouch_nii( InputStruct(ksub).run(1).subjectmask );
+            VV = load_untouch_nii( [InputStruct(ksub).run(1).Output_nifti_file_path '/intermediate_processed/afni_processed/' InputStruct(ksub).run(1).Output_nifti_file_prefix '_baseproc' aligned_suffix '.nii'] );
+            save_pipeline_spms(IMAGE_set, Nfull, modeltype, double(MM.img), VV, Subject_OutputDirOptimize, subjectprefix);
+            clear MM VV
+        end
+        clear IMAGE_set TEMP_set METRIC_set
+    end
+
+    % the params do not depend on the pipelines: those of the first shard are kept,
+    % last, as the merge is done once they are in place
+    movefile([params_file suffixes{1} '.mat'], [params_file '.mat'], 'f');
+    for(k=1:num_shards)
+        if k > 1
+            delete([params_file suffixes{k} '.mat']);
+        end
+        if has_stats
+            delete([spms_file  suffixes{k} '.mat']);
+            delete([temp_file  suffixes{k} '.mat']);
+            delete([stats_file suffixes{k} '.mat']);
+        end
+    end
+end
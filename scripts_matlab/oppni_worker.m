@@ -0,0 +1,195 @@
+function oppni_worker( queue_dir, max_idle_sec, sentinel_dir )
+%
+%==========================================================================
+% OPPNI_WORKER: persistent worker, which starts the MATLAB/MCR runtime once
+% and runs the step invocations queued by OPPNI until the queue drains
+%==========================================================================
+%
+% SYNTAX:
+%
+%   oppni_worker( queue_dir, max_idle_sec, sentinel_dir )
+%
+% INPUT:
+%
+%   queue_dir    = string specifying the work queue folder, containing the
+%                  subfolders pending, running, done and failed
+%   max_idle_sec = seconds to keep waiting on tasks blocked by tasks still
+%                  running elsewhere, before giving up (default 1800)
+%   sentinel_dir = (optional) folder to record the completion sentinel of
+%                  each task in, named after the task, as the jobs do
+%
+% Each task is a textfile in queue_dir/pending: the first line lists the
+% tasks it depends on (separated by spaces, possibly empty), the second
+% line the function to run, and each of the remaining lines one argument.
+% A task is claimed by moving it to running, and moved to done or failed
+% once it finishes. Tasks depending on a failed task fail as well.
+%
+% ------------------------------------------------------------------------%
+
+global OPPNI_WORKER
+% errors in the steps must not terminate the worker (see sge_exit)
+OPPNI_WORKER = 1;
+
+if nargin < 2 || isempty(max_idle_sec)
+    max_idle_sec = 1800;
+end
+if ischar(max_idle_sec)
+    max_idle_sec = str2double(max_idle_sec);
+end
+if nargin < 3
+    sentinel_dir = '';
+end
+
+poll_sec  = 10;
+idle_sec  = 0;
+num_tasks = 0;
+num_fail  = 0;
+
+while true
+    pending = dir( fullfile(queue_dir,'pending','*.task') );
+    if isempty(pending)
+        break;
+    end
+
+    claimed = 0;
+    for(t=1:length(pending))
+        task_name = pending(t).name;
+        [depends_on, step_cmd, args] = read_task( fullfile(queue_dir,'pending',task_name) );
+        if isempty(step_cmd)
+            % being written, or claimed by another worker meanwhile
+            continue;
+        end
+
+        dep_status = check_dependencies( queue_dir, depends_on );
+        if dep_status < 0
+            % no point running it, as one of its dependencies failed
+            if movefile( fullfile(queue_dir,'pending',task_name), fullfile(queue_dir,'failed',task_name) )
+                write_error( queue_dir, task_name, 'one of its dependencies failed.' );
+                num_fail = num_fail + 1;
+                fprintf('task %s skipped: one of its dependencies failed.\n', task_name);
+            end
+            continue;
+        elseif dep_status == 0
+            continue;
+        end
+
+        % moving the task is atomic: only one of the workers succeeds in claiming it
+        if ~movefile( fullfile(queue_dir,'pending',task_name), fullfile(queue_dir,'running',task_name) )
+            continue;
+        end
+
+        claimed   = 1;
+        num_tasks = num_tasks + 1;
+        fprintf('task %s started: %s\n', task_name, step_cmd);
+        write_sentinel( sentinel_dir, task_name, 'null', 'null' );
+        tic;
+        try
+            feval( step_cmd, args{:} );
+            movefile( fullfile(queue_dir,'running',task_name), fullfile(queue_dir,'done',task_name) );
+            write_sentinel( sentinel_dir, task_name, '0', sprintf('%d',round(toc)) );
+            fprintf('task %s done in %.1f sec.\n', task_name, toc);
+        catch ME
+            movefile( fullfile(queue_dir,'running',task_name), fullfile(queue_dir,'failed',task_name) );
+            write_error( queue_dir, task_name, ME.message );
+            write_sentinel( sentinel_dir, task_name, '1', sprintf('%d',round(toc)) );
+            num_fail = num_fail + 1;
+            fprintf('task %s failed after %.1f sec: %s\n', task_name, toc, ME.message);
+        end
+        % the state of the queue has changed since the listing
+        break;
+    end
+
+    if claimed
+        idle_sec = 0;
+    else
+        % all the remaining tasks wait on tasks running in other workers
+        if idle_sec >= max_idle_sec
+            fprintf('giving up after waiting %d sec on the blocked tasks.\n', idle_sec);
+            break;
+        end
+        pause(poll_sec);
+        idle_sec = idle_sec + poll_sec;
+    end
+end
+
+fprintf('worker finished: %d tasks run, %d failed.\n', num_tasks, num_fail);
+OPPNI_WORKER = [];
+if num_fail > 0
+    % so the failure is visible in the exit status of the worker
+    error('%d of the tasks failed - check %s', num_fail, fullfile(queue_dir,'failed'));
+end
+
+%%
+function [depends_on, step_cmd, args] = read_task( task_path )
+% parses a task file, returning an empty step_cmd when it can not be read
+
+depends_on = {};
+step_cmd   = '';
+args       = {};
+
+fid = fopen(task_path,'rt');
+if fid < 0
+    return;
+end
+dep_line = fgetl(fid);
+cmd_line = fgetl(fid);
+newline  = fgetl(fid);
+while ischar(newline)
+    args{end+1} = newline;
+    newline     = fgetl(fid);
+end
+fclose(fid);
+
+if ~ischar(dep_line) || ~ischar(cmd_line)
+    return;
+end
+[tok, rem] = strtok(dep_line);
+while ~isempty(tok)
+    depends_on{end+1} = tok;
+    [tok, rem] = strtok(rem);
+end
+step_cmd = strtrim(cmd_line);
+
+%%
+function dep_status = check_dependencies( queue_dir, depends_on )
+% 1 if all dependencies are done, 0 if some are yet to finish, -1 if any failed
+% dependencies unknown to the queue were completed previously
+
+dep_status = 1;
+for(d=1:length(depends_on))
+    dep_task = [depends_on{d} '.task'];
+    if exist( fullfile(queue_dir,'failed',dep_task), 'file' )
+        dep_status = -1;
+        return;
+    elseif exist( fullfile(queue_dir,'pending',dep_task), 'file' ) || exist( fullfile(queue_dir,'running',dep_task), 'file' )
+        dep_status = 0;
+    end
+end
+
+%%
+function write_error( queue_dir, task_name, message )
+
+[~, name] = fileparts(task_name);
+fid = fopen( fullfile(queue_dir,'failed',[name '.error']), 'wt' );
+if fid >= 0
+    fprintf(fid, '%s\n', message);
+    fclose(fid);
+end
+
+%%
+function write_sentinel( sentinel_dir, task_name, exit_code, wall_time_sec )
+% records the completion of a task like the jobs do, replacing the previous record atomically
+
+if isempty(sentinel_dir)
+    return;
+end
+[~, name] = fileparts(task_name);
+[~, host] = system('hostname');
+sentinel  = fullfile(sentinel_dir,[name '.json']);
+fid = fopen( [sentinel '.tmp'], 'wt' );
+if fid >= 0
+    fprintf(fid, '{"job": "%s", "exit_code": %s, "wall_time_sec": %s, "peak_rss_kb": null, "finished": "%s", "host": "%s", "output_sizes": {}}\n', ...
+            name, exit_code, wall_time_sec, datestr(now,'yyyy-mm-dd HH:MM:SS'), strtrim(host));
+    fclose(fid);
+    movefile( [sentinel '.tmp'], sentinel, 'f' );
+end
@@ -13,14 +13,29 @@ if strcmpi(proc,'PART1')
     if nargin < 11
         error('Insufficient number of arguments for Part 1 - must supply:\n InputStruct,input_pipeset, analysis_model, modelparam, niiout,     contrast_list_str, dospnormfirst, DEOBLIQUE,  TPATTERN,   TOFWHM');
     end
-    Pipeline_PART1(varargin{1},varargin{2},  varargin{3},   varargin{4},  varargin{5},varargin{6},      varargin{7},    varargin{8},varargin{9},varargin{10});
-    % Pipeline_PART1(InputStruct,input_pipeset, analysis_model, modelparam, niiout,     contrast_list_str, dospnormfirst, DEOBLIQUE,  TPATTERN,   TOFWHM)
-elseif strcmpi(proc,'PART2')
+    if nargin < 12
+        Pipeline_PART1(varargin{1},varargin{2},  varargin{3},   varargin{4},  varargin{5},varargin{6},      varargin{7},    varargin{8},varargin{9},varargin{10});
+    else
+        % resubmission, limiting the AFNI-based preprocessing to the missing pipeline combinations
+        Pipeline_PART1(varargin{1},varargin{2},  varargin{3},   varargin{4},  varargin{5},varargin{6},      varargin{7},    varargin{8},varargin{9},varargin{10},varargin{11});
+    end
+    % Pipeline_PART1(InputStruct,input_pipeset, analysis_model, modelparam, niiout,     contrast_list_str, dospnormfirst, DEOBLIQUE,  TPATTERN,   TOFWHM, [afni_pipeset])
+elseif strcmpi(proc,'BASE') || strncmpi(proc,'SHARD',5)
+    % Part 1 split into shards: its AFNI-based preprocessing (base), or the metrics of a subset of the pipelines
+    % Pipeline_PART1(InputStruct,input_pipeset, analysis_model, modelparam, niiout, contrast_list_str, dospnormfirst, DEOBLIQUE, TPATTERN, TOFWHM, afni_pipeset, shard)
+    Pipeline_PART1(varargin{:});
+
+elseif strcmpi(proc,'MERGE')
+    % merge_part1_shards(InputStruct, input_pipeset, num_shards, niiout)
+    merge_part1_shards(varargin{:});
+
+elseif strcmpi(proc,'PART2') || strcmpi(proc,'PART2SEL') || strcmpi(proc,'PART2SUB')
     if nargin < 7
          error('Insufficient number of arguments for Part 2 - must supply:\n InputStruct, optimize_metric, mot_gs_control, process_out, keepmean,   whichpipes');
     end
-	% Pipeline_PART2(InputStruct, optimize_metric, mot_gs_control, process_out, keepmean,   whichpipes)
-    Pipeline_PART2(varargin{1},  varargin{2},		varargin{3},	varargin{4},varargin{5},varargin{6});
+	% Pipeline_PART2(InputStruct, optimize_metric, mot_gs_control, process_out, keepmean,   whichpipes, [stage, selection_file])
+	% (PART2SEL, PART2SUB and PART2 are the selection, per-subject and summary stages, when split into jobs)
+    Pipeline_PART2(varargin{:});
     
 elseif strcmpi(proc,'SPNORM')
     if nargin < 6
@@ -40,11 +55,23 @@ elseif strcmpi(proc,'QC1') || strcmpi(proc,'QC2')
     % first argument coming from compiled code is an integer indicating step
     QC_wrapper(varargin{1}, varargin{2},varargin{3}, varargin{4});
 
+elseif strcmpi(proc,'WORKER')
+    % oppni_worker(queue_dir, max_idle_sec, sentinel_dir)
+    oppni_worker(varargin{:});
+
+elseif strcmpi(proc,'PRUNE')
+    % prune_pipelines(InputStruct, input_pipeset, output_pipeset, optimize_metric)
+    prune_pipelines(varargin{:});
+
+elseif strcmpi(proc,'SELECT')
+    % select_pipelines(InputStruct, input_pipeset, output_pipeset, optimize_metric, mot_gs_control, whichpipes)
+    select_pipelines(varargin{:});
+
 % elseif strcmpi(proc,'QC0')
 %     QC_wrapper(0, varargin{1},varargin{2},varargin{3}); 
 
 else
-    error('Unrecognized part name: must be one of PART1, PART2, SPNORM, GMASK, QC1 and QC2.');
+    error('Unrecognized part name: must be one of PART1, BASE, SHARD<k>, MERGE, PART2, PART2SEL, PART2SUB, SPNORM, GMASK, QC1, QC2, WORKER, PRUNE and SELECT.');
 end
 
 
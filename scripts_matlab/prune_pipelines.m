@@ -0,0 +1,122 @@
+function prune_pipelines( InputStruct, input_pipeset, output_pipeset, optimize_metric )
+%
+%==========================================================================
+% PRUNE_PIPELINES: one round of the adaptive search over the pipeline
+% combinations, which drops the losing options of the preprocessing steps
+% until about half of the combinations remain
+%==========================================================================
+%
+% SYNTAX:
+%
+%   prune_pipelines( InputStruct, input_pipeset, output_pipeset, optimize_metric )
+%
+% INPUT:
+%
+%   InputStruct     = string specifying the "input" textfile of the pilot
+%                     subjects, whose Part 1 is done for (at least) all the
+%                     combinations in input_pipeset
+%   input_pipeset   = string specifying the "pipeline" textfile of the
+%                     combinations evaluated in this round
+%   output_pipeset  = string specifying the "pipeline" textfile written with
+%                     the combinations surviving this round
+%   optimize_metric = metric the pipelines are compared on (dPR, P or R),
+%                     as in Pipeline_PART2. Higher is better
+%
+% Each combination is scored by its metric averaged over the pilot subjects,
+% after removing the median of each subject (as subjects differ in their
+% overall performance). Each step option is then scored by the average of
+% the combinations including it. Options are dropped one at a time, the one
+% trailing the best option of its step by the most first, until at most
+% half of the combinations remain (or every step has a single option).
+%
+% ------------------------------------------------------------------------%
+
+if nargin < 4 || isempty(optimize_metric)
+    optimize_metric = 'dPR';
+end
+
+%% Read Inputfiles
+if ~isstruct(InputStruct)
+    [InputStruct] = Read_Input_File(InputStruct);
+end
+[step_names, step_options] = read_pipeline_file( input_pipeset );
+
+%% metric of each combination evaluated, for each pilot subject
+pipeset = [];
+scores  = [];
+for ksub = 1:numel(InputStruct)
+    stats_file = strcat(InputStruct(ksub).run(1).Output_nifti_file_path, '/intermediate_metrics/res3_stats/stats', InputStruct(ksub).run(1).subjectprefix, '.mat');
+    stats = load( stats_file );
+
+    % the subjects of earlier rounds were evaluated on more combinations than this round
+    keep = true( size(stats.pipeset,1), 1 );
+    for(k=1:length(stats.pipenames))
+        s = find( strcmpi( step_names, stats.pipenames{k} ) );
+        if ~isempty(s)
+            keep = keep & ismember( stats.pipeset(:,k), step_options{s} );
+        end
+    end
+    sub_pipeset = stats.pipeset(keep,:);
+    sub_metric  = zeros( size(sub_pipeset,1), 1 );
+    ikeep       = find(keep);
+    for(n=1:length(ikeep))
+        if ~isfield( stats.METRIC_set{ikeep(n)}, optimize_metric )
+            error(['The metric ', optimize_metric, ' is not an output in this dataset. Choose another!']);
+        end
+        sub_metric(n) = mean( stats.METRIC_set{ikeep(n)}.(optimize_metric) );
+    end
+    sub_metric = sub_metric - median(sub_metric);
+
+    if ksub == 1
+        pipeset   = sub_pipeset;
+        pipenames = stats.pipenames;
+        scores    = zeros( size(pipeset,1), numel(InputStruct) );
+    end
+    [found, loc] = ismember( pipeset, sub_pipeset, 'rows' );
+    if ~all(found)
+        error('The stats of %s lack some of the combinations of %s - rerun its Part 1.', stats_file, input_pipeset);
+    end
+    scores(:,ksub) = sub_metric(loc);
+end
+score = mean( scores, 2 );
+
+%% dropping the losing options, one at a time
+Ncomb   = size(pipeset,1);
+alive   = true( Ncomb, 1 );
+target  = ceil( Ncomb/2 );
+fprintf('pruning %d combinations on %s, over %d pilot subjects:\n', Ncomb, optimize_metric, numel(InputStruct));
+while sum(alive) > target
+    worst_gap = -Inf; worst_col = 0; worst_val = NaN;
+    for(k=1:size(pipeset,2))
+        vals = unique( pipeset(alive,k) );
+        if length(vals) < 2
+            continue;
+        end
+        opt_score = zeros( length(vals), 1 );
+        for(v=1:length(vals))
+            opt_score(v) = mean( score( alive & pipeset(:,k)==vals(v) ) );
+        end
+        [min_score, imin] = min( opt_score );
+        if max(opt_score) - min_score > worst_gap
+            worst_gap = max(opt_score) - min_score;
+            worst_col = k;
+            worst_val = vals(imin);
+        end
+    end
+    if worst_col == 0
+        % a single option left in every step
+        break;
+    end
+    alive( pipeset(:,worst_col)==worst_val ) = false;
+    fprintf('\tdropped %s=%s (trailing the best option by %.4f)\n', pipenames{worst_col}, num2str(worst_val), worst_gap);
+end
+fprintf('%d of the %d combinations survive.\n', sum(alive), Ncomb);
+
+%% writing the surviving options, in the order of the input pipeline file
+for(s=1:length(step_names))
+    k = find( strcmpi( pipenames, step_names{s} ) );
+    if ~isempty(k)
+        step_options{s} = unique( pipeset(alive,k) )';
+    end
+end
+write_pipeline_file( output_pipeset, step_names, step_options );
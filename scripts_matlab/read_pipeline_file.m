@@ -0,0 +1,23 @@
+function [step_names, step_options] = read_pipeline_file( filename )
+%
+% READ_PIPELINE_FILE: steps of a "pipeline" textfile, in their order in the
+% file, and the options of each (cell array of row vectors)
+%
+% ------------------------------------------------------------------------%
+
+step_names   = {};
+step_options = {};
+fid = fopen(filename,'rt');
+if fid < 0
+    error('Unable to read the pipeline file %s', filename);
+end
+newline = fgetl(fid);
+while ischar(newline)
+    tok = regexp( newline, '^\s*([A-Za-z0-9]+)\s*=\s*\[([^\]]*)\]', 'tokens', 'once' );
+    if ~isempty(tok)
+        step_names{end+1}   = upper(tok{1});
+        step_options{end+1} = str2num( ['[' tok{2} ']'] );
+    end
+    newline = fgetl(fid);
+end
+fclose(fid);
@@ -0,0 +1,52 @@
+function save_pipeline_spms( IMAGE_set, Nfull, modeltype, mask, VV, Subject_OutputDirOptimize, subjectprefix )
+%
+% SAVE_PIPELINE_SPMS: saves the activation maps of the pipelines of a subject
+% (IMAGE_set of Pipeline_PART1) as niftis in <Subject_OutputDirOptimize>/spms,
+% in the space of mask, with the header of nifti VV. A single 4D volume of all
+% the pipelines for models with one image per pipeline, otherwise a 4D volume
+% per pipeline
+%
+% ------------------------------------------------------------------------%
+
+global CODE_PROPERTY
+
+if( strcmp( modeltype, 'one_component') )
+
+    disp('Only 1 image per pipeline. Concatenating all NIFTIS into single 4D matrix');
+
+    TMPVOL = zeros( [size(mask), Nfull] );
+
+    for(n=1:Nfull )
+        tmp=mask;tmp(tmp>0)=IMAGE_set{n};
+        TMPVOL(:,:,:,n) = tmp;
+    end
+
+    nii=VV;
+    nii.img = TMPVOL;
+    nii.hdr.dime.datatype = 16;
+    nii.hdr.hist = VV.hdr.hist;
+    nii.hdr.dime.dim(5) = Nfull;
+    nii.hdr.hist.descrip = CODE_PROPERTY.NII_HEADER;
+    save_untouch_nii(nii,strcat(Subject_OutputDirOptimize,'/spms/rSPM_',subjectprefix,'_pipelines_all.nii'));
+else
+
+    disp('Multiple images per pipeline. Producing 4D volume for each pipeline');
+
+    for(n=1:Nfull )
+
+        TMPVOL = zeros( [size(mask), size(IMAGE_set{n},2)] );
+
+        for(p=1:size(IMAGE_set{n},2) )
+            tmp=mask;tmp(tmp>0)=IMAGE_set{n}(:,p);
+            TMPVOL(:,:,:,p) = tmp;
+        end
+
+        nii=VV;
+        nii.img = TMPVOL;
+        nii.hdr.dime.datatype = 16;
+        nii.hdr.hist = VV.hdr.hist;
+        nii.hdr.dime.dim(5) = size(IMAGE_set{n},2);
+        nii.hdr.hist.descrip = CODE_PROPERTY.NII_HEADER;
+        save_untouch_nii(nii,strcat(Subject_OutputDirOptimize,'/spms/rSPM_',subjectprefix,'_pipeline_',num2str(n),'_',num2str(p),'vols.nii'));
+    end
+end
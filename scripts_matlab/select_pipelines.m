@@ -0,0 +1,71 @@
+function select_pipelines( InputStruct, input_pipeset, output_pipeset, optimize_metric, mot_gs_control, whichpipes )
+%
+%==========================================================================
+% SELECT_PIPELINES: selects the fixed pipelines on a pilot subset of the
+% subjects, to process the rest of them with those only
+%==========================================================================
+%
+% SYNTAX:
+%
+%   select_pipelines( InputStruct, input_pipeset, output_pipeset, optimize_metric, mot_gs_control, whichpipes )
+%
+% INPUT:
+%
+%   InputStruct     = string specifying the "input" textfile of the pilot
+%                     subjects, whose Part 1 is done for all the
+%                     combinations in input_pipeset
+%   input_pipeset   = string specifying the "pipeline" textfile of all the
+%                     combinations
+%   output_pipeset  = string specifying the "pipeline" textfile written with
+%                     the combinations selected (see get_pipe_list)
+%   optimize_metric, mot_gs_control, whichpipes = as in Pipeline_PART2
+%                     (whichpipes is FIX or CON)
+%
+% The optimal fixed (FIX) and conservative (CON) pipelines are selected as
+% in Pipeline_PART2, without writing any of its outputs. Both are kept,
+% whichever is requested, as QC compares the others to the CON pipeline. The
+% pipeline file written lists the options of either pipeline for each step,
+% and only these two combinations of them (SELECTED). PHYCAA+ is computed
+% along with the pipeline it is applied to, so both of its options are kept
+% when the two pipelines differ on it.
+%
+% ------------------------------------------------------------------------%
+
+if nargin < 6 || isempty(whichpipes)
+    whichpipes = 'FIX';
+end
+
+%% Read Inputfiles
+if ~isstruct(InputStruct)
+    [InputStruct] = Read_Input_File(InputStruct);
+end
+[step_names, step_options] = read_pipeline_file( input_pipeset );
+
+%% optimal pipelines of the pilot subjects (process_out=0, writing nothing)
+pipeline_sets = Pipeline_PART2( InputStruct, optimize_metric, mot_gs_control, '0', '0', whichpipes );
+if ~isfield( pipeline_sets, 'fix' )
+    % a single pipeline, nothing to select
+    selected = pipeline_sets.pipe1;
+else
+    selected = [pipeline_sets.fix; pipeline_sets.con];
+end
+fprintf('selected on %d pilot subjects:\n', numel(InputStruct));
+if isfield( pipeline_sets, 'fix' )
+    fprintf('\tFIX: %s\n', num2str(pipeline_sets.fix));
+    fprintf('\tCON: %s\n', num2str(pipeline_sets.con));
+end
+
+%% writing the options of the pipelines selected, in the order of the input pipeline file
+% (the GSPC1 column of the stats codes both GSPC1 and CUSTOMREG, as in get_pipe_list)
+k_gs = find( strcmpi( pipeline_sets.pipenames, 'GSPC1' ) );
+for(s=1:length(step_names))
+    k = find( strcmpi( pipeline_sets.pipenames, step_names{s} ) );
+    if strcmpi( step_names{s}, 'GSPC1' )
+        step_options{s} = unique( mod( selected(:,k_gs), 2 ) )';
+    elseif strcmpi( step_names{s}, 'CUSTOMREG' )
+        step_options{s} = unique( floor( selected(:,k_gs)/2 ) )';
+    elseif ~isempty(k)
+        step_options{s} = unique( selected(:,k) )';
+    end
+end
+write_pipeline_file( output_pipeset, step_names, step_options, unique( selected, 'rows' ) );
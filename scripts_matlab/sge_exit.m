@@ -14,7 +14,10 @@ if nargin==1
     str = 'ERROR';
 end
     
-if (usejava('desktop') || usejava('jvm'))
+global OPPNI_WORKER
+
+% within a persistent worker, only the current task must fail (see oppni_worker)
+if (usejava('desktop') || usejava('jvm') || ~isempty(OPPNI_WORKER))
     error(str);
 else
     display(str);
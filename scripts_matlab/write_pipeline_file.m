@@ -0,0 +1,28 @@
+function write_pipeline_file( filename, step_names, step_options, selected )
+%
+% WRITE_PIPELINE_FILE: writes a "pipeline" textfile with the options of each
+% step (as read by read_pipeline_file). It is written under a different name
+% first, so a partial file is never picked up
+%
+% selected (optional) = rows of pipeline choices, as in the stats of Part 1,
+% limiting the combinations of the options to those listed (see get_pipe_list)
+%
+% ------------------------------------------------------------------------%
+
+fid = fopen( [filename '.tmp'], 'wt' );
+if fid < 0
+    error('Unable to write the pipeline file %s', filename);
+end
+for(s=1:length(step_names))
+    option_strs = arrayfun( @num2str, step_options{s}, 'UniformOutput', false );
+    fprintf(fid, '%s=[%s]\n', step_names{s}, strjoin(option_strs, ','));
+end
+if nargin > 3 && ~isempty(selected)
+    row_strs = cell(size(selected,1),1);
+    for(r=1:size(selected,1))
+        row_strs{r} = strjoin( arrayfun( @num2str, selected(r,:), 'UniformOutput', false ), ',' );
+    end
+    fprintf(fid, 'SELECTED=[%s]\n', strjoin(row_strs', ';'));
+end
+fclose(fid);
+movefile( [filename '.tmp'], filename, 'f' );